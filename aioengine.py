@@ -0,0 +1,554 @@
+"""
+asyncio networking engine.
+
+An alternative to the threaded listener: a single event loop accepts and reads every
+connection, and all outbound RPCs of the fan-out operations (peer validation, discovery,
+file listing) run as coroutines on the same loop. The Application handlers are shared
+with the threaded engine: they are blocking (disk I/O, call-backs to the client), so they
+run on a bounded executor and talk to the peer through AsyncConnection, which marshals
+their writes onto the loop. Handlers that only build a small response from memory
+(INLINE_MESSAGES) run directly on the loop. Threads are used per in-flight blocking
+request, never per socket.
+
+Outbound RPCs go over an AsyncConnectionPool, the asyncio counterpart of connpool.py, whose
+connections are read by tasks on the loop. The code that stays blocking, like the
+membership protocol and the DHT, uses it through a LoopPool, which has the interface of
+connpool.ConnectionPool, so no connection has a reader thread in this mode.
+
+Both engines speak the same wire protocol and interoperate.
+"""
+
+from peer import Peer
+from protocol import HEADER, MAX_MESSAGE_SIZE, Message, MessageType, ProtocolError, RemoteError, accept_flags, accepted_codec, check_reply, compress_payload, decode_header, encode_header, encode_json
+from compress import available_codecs, choose_codec
+from connpool import CONNECTION_IDLE_TIMEOUT, CONNECTIONS_PER_PEER, MAX_IN_FLIGHT_PER_CONNECTION, RequestNotSent, can_retry
+from fanout import FANOUT_CONCURRENCY, FANOUT_DEADLINE
+from subscriptions import SUBSCRIPTION_RENEW
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import itertools
+import threading
+import time
+
+INLINE_MESSAGES = (
+    MessageType.HELLO, MessageType.BROADCASTREQUEST, MessageType.FILELIST, MessageType.SUBSCRIBE,
+    MessageType.FILELISTUPDATE, MessageType.PING, MessageType.DHT_FIND_NODE, MessageType.DHT_FIND_VALUE,
+    MessageType.DHT_STORE, MessageType.STATS,
+)
+
+class AsyncConnection:
+    """
+    Gives the handlers the Connection interface on top of asyncio streams, for the
+    response to one request.
+
+    Called from executor threads, the methods block until the loop has written the data.
+    Called from the loop itself, they buffer the data in the transport. Like protocol.Reply,
+    the response is stamped with the request id and holds the connection's lock from the
+    first write until release(), so streamed responses are never interleaved. Large
+    payloads are compressed with the `codec` the request accepts.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter, lock: asyncio.Lock, request_id: int, codec: str = None) -> None:
+        self.loop = loop
+        self.writer = writer
+        self.lock = lock
+        self.request_id = request_id
+        self.codec = codec
+        self.started = False
+        # Bytes written, for the metrics.
+        self.sent = 0
+    def _on_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+    async def _write(self, data: bytes) -> None:
+        self.writer.write(data)
+        await self.writer.drain()
+    def _begin(self) -> None:
+        if not self.started:
+            self._call(self.lock.acquire())
+            self.started = True
+    def release(self) -> None:
+        """
+        Releases the connection lock. Must be called on the loop.
+        """
+        if self.started:
+            self.lock.release()
+            self.started = False
+    def getpeername(self) -> (str, int):
+        return self.writer.get_extra_info('peername')[:2]
+    def sendall(self, data: bytes) -> None:
+        self.sent += len(data)
+        if self._on_loop():
+            # Handlers running on the loop are only called once the lock is held for them.
+            self.writer.write(data)
+        else:
+            self._begin()
+            self._call(self._write(data))
+    def send(self, msg_type: MessageType, payload: bytes = b'', flags: int = 0) -> None:
+        payload, flags = compress_payload(payload, flags, self.codec)
+        self.sendall(encode_header(msg_type, len(payload), flags, self.request_id) + payload)
+    def send_json(self, msg_type: MessageType, obj, flags: int = 0) -> None:
+        self.send(msg_type, encode_json(obj), flags)
+    def send_header(self, msg_type: MessageType, length: int, flags: int = 0) -> None:
+        self.sendall(encode_header(msg_type, length, flags, self.request_id))
+    def sendfile(self, f, offset: int, count: int) -> int:
+        """
+        Streams part of a file with the loop's sendfile, which is zero-copy where supported.
+        """
+        if count == 0:
+            return 0
+        self._begin()
+        sent = self._call(self.loop.sendfile(self.writer.transport, f, offset, count))
+        self.sent += sent
+        if sent != count:
+            raise ConnectionError(f'Sent {sent} of {count} bytes.')
+        return sent
+
+async def read_message(reader: asyncio.StreamReader) -> Message:
+    msg_type, flags, request_id, length = decode_header(await reader.readexactly(HEADER.size))
+    if length > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f'Message of {length} bytes over the limit of {MAX_MESSAGE_SIZE}.')
+    payload = await reader.readexactly(length)
+    return Message(msg_type, payload, flags, request_id)
+
+async def arequest(address: (str, int), msg_type: MessageType, payload: bytes = b'', timeout: float = None, flags: int = 0) -> Message:
+    """
+    Coroutine version of protocol.request: sends a single message and returns the response.
+    """
+    async def exchange() -> Message:
+        reader, writer = await asyncio.open_connection(address[0], address[1])
+        try:
+            writer.write(encode_header(msg_type, len(payload), flags) + payload)
+            await writer.drain()
+            rsp = await read_message(reader)
+            check_reply(rsp.type, rsp.payload)
+            return rsp
+        finally:
+            writer.close()
+    return await asyncio.wait_for(exchange(), timeout)
+
+class AsyncPooledConnection:
+    """
+    A long-lived connection to one peer with request/response multiplexing, like
+    connpool.PooledConnection, read by a task on the loop. Must be used on the loop.
+    """
+    def __init__(self, address: (str, int), reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self.last_used = time.time()
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_loop())
+    @classmethod
+    async def open(cls, address: (str, int), timeout: float) -> 'AsyncPooledConnection':
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(address[0], address[1]), timeout)
+        return cls(address, reader, writer)
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+    async def call(self, msg_type: MessageType, payload: bytes, timeout: float, flags: int = 0) -> Message:
+        """
+        Sends a request and waits for the response with the same request id.
+        """
+        if self.closed or self.writer.is_closing():
+            raise RequestNotSent('Connection closed.')
+        request_id = next(self._ids) % 0xFFFFFFFF + 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self.last_used = time.time()
+        try:
+            # A single write, so requests sent concurrently are never interleaved.
+            self.writer.write(encode_header(msg_type, len(payload), flags, request_id) + payload)
+            try:
+                await asyncio.wait_for(self.writer.drain(), timeout)
+            except (OSError, asyncio.TimeoutError):
+                self.close()
+                raise
+            rsp = await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+        self.last_used = time.time()
+        check_reply(rsp.type, rsp.payload)
+        return rsp
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Connection closed.'))
+    async def wait_closed(self) -> None:
+        await asyncio.gather(self._reader_task, return_exceptions=True)
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                msg = await read_message(self.reader)
+                future = self._pending.get(msg.request_id)
+                if future is not None and not future.done():
+                    future.set_result(msg)
+        except Exception:
+            pass
+        finally:
+            self.close()
+
+class AsyncConnectionPool:
+    """
+    Per-peer pool of AsyncPooledConnection objects, like connpool.ConnectionPool. Must be
+    used on the loop.
+
+    Usage:
+    ```
+    pool = AsyncConnectionPool(timeout)
+    rsp = await pool.request((ip, port), MessageType.HELLO)
+    pool.close_idle()
+    await pool.close_all()
+    ```
+    """
+    def __init__(self, timeout: float, idle_timeout: float = CONNECTION_IDLE_TIMEOUT, per_peer: int = CONNECTIONS_PER_PEER) -> None:
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.per_peer = per_peer
+        self._connections = {}
+        # Address -> connections being opened, counted against per_peer.
+        self._opening = {}
+    async def _acquire(self, address: (str, int), reuse: bool = True) -> AsyncPooledConnection:
+        """
+        Returns the least busy open connection to the peer, or a new one if they are all
+        busy, or `reuse` is False, and the peer has fewer than per_peer connections.
+        """
+        conns = [c for c in self._connections.get(address, []) if not c.closed]
+        self._connections[address] = conns
+        full = len(conns) + self._opening.get(address, 0) >= self.per_peer
+        if conns and (reuse or full):
+            best = min(conns, key=lambda c: c.in_flight)
+            if full or best.in_flight < MAX_IN_FLIGHT_PER_CONNECTION:
+                return best
+        self._opening[address] = self._opening.get(address, 0) + 1
+        try:
+            conn = await AsyncPooledConnection.open(address, self.timeout)
+        finally:
+            self._opening[address] -= 1
+            if not self._opening[address]:
+                del self._opening[address]
+        self._connections.setdefault(address, []).append(conn)
+        return conn
+    async def request(self, address: (str, int), msg_type: MessageType, payload: bytes = b'', timeout: float = None, flags: int = 0) -> Message:
+        """
+        Sends a request over a pooled connection to the peer and returns the response.
+        `timeout` overrides the pool's timeout for sending and waiting on the response.
+
+        If the connection turns out to have been closed by the peer, the request is sent
+        once more over another connection, when that is safe, see connpool.can_retry.
+        """
+        address = tuple(address)
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return await (await self._acquire(address)).call(msg_type, payload, timeout, flags)
+        except ConnectionError as e:
+            if not can_retry(msg_type, e):
+                raise
+            return await (await self._acquire(address, reuse=False)).call(msg_type, payload, timeout, flags)
+    def close_idle(self) -> None:
+        """
+        Closes connections without requests in flight that were not used for idle_timeout seconds.
+        """
+        now = time.time()
+        for address, conns in self._connections.items():
+            keep = []
+            for conn in conns:
+                if conn.closed:
+                    continue
+                if conn.in_flight == 0 and now - conn.last_used > self.idle_timeout:
+                    conn.close()
+                else:
+                    keep.append(conn)
+            self._connections[address] = keep
+    def close_peer(self, address: (str, int)) -> None:
+        for conn in self._connections.pop(tuple(address), []):
+            conn.close()
+    async def close_all(self) -> None:
+        conns = [c for cs in self._connections.values() for c in cs]
+        self._connections = {}
+        for conn in conns:
+            conn.close()
+        await asyncio.gather(*(conn.wait_closed() for conn in conns))
+
+class LoopPool:
+    """
+    The blocking interface of connpool.ConnectionPool on top of the pool of an AsyncEngine,
+    for the code running on other threads. Must not be used on the loop.
+    """
+    def __init__(self, engine: 'AsyncEngine') -> None:
+        self.engine = engine
+    def request(self, address: (str, int), msg_type: MessageType, payload: bytes = b'', timeout: float = None, flags: int = 0) -> Message:
+        return self.engine.run(self.engine._arequest(tuple(address), msg_type, payload, flags, timeout))
+    def close_idle(self) -> None:
+        self.engine.loop.call_soon_threadsafe(self.engine.pool.close_idle)
+    def close_peer(self, address: (str, int)) -> None:
+        self.engine.loop.call_soon_threadsafe(self.engine.pool.close_peer, address)
+    def close_all(self) -> None:
+        self.engine.run(self.engine.pool.close_all())
+
+class AsyncEngine:
+    """
+    Runs the node's networking on an event loop in a dedicated thread.
+
+    Usage:
+    ```
+    engine = AsyncEngine(ctx, workers, queue_size, timeout, idle_timeout, log)
+    engine.start()
+    engine.run(engine.refresh_network_index())
+    engine.stop()
+    ```
+    """
+    def __init__(self, ctx: 'Application', workers: int, queue_size: int, timeout: float, idle_timeout: float, log=None) -> None:
+        self.ctx = ctx
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.loop = asyncio.new_event_loop()
+        self._log = log or (lambda msg: None)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='aio-handler')
+        self._in_flight = 0
+        self._server = None
+        self._tasks = []
+        self._connections = {}
+        # Outbound RPCs, see AsyncConnectionPool; `blocking_pool` is its interface for other threads.
+        self.pool = AsyncConnectionPool(timeout)
+        self.blocking_pool = LoopPool(self)
+        self._thread = threading.Thread(target=self.loop.run_forever, name='aio-loop')
+    def start(self) -> None:
+        self._thread.start()
+        self.run(self._start_server())
+    def stop(self) -> None:
+        self.run(self._stop_server())
+        # The handlers still running write through the loop, so they finish before it stops.
+        self._executor.shutdown()
+        self.run(self._settle())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+    def run(self, coro):
+        """
+        Runs a coroutine on the engine's loop from another thread and returns its result.
+        Raises RuntimeError on the loop itself, where waiting for the result would block it.
+        """
+        if threading.current_thread() is self._thread:
+            raise RuntimeError('Cannot wait for a coroutine on the event loop.')
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+    def every(self, interval: float, func) -> None:
+        """
+        Schedules a blocking callable to run on the executor every `interval` seconds.
+        """
+        async def periodic() -> None:
+            while True:
+                try:
+                    await self.loop.run_in_executor(self._executor, func)
+                except Exception as e:
+                    self._log(f'Periodic task {func.__name__} failed: {e}')
+                await asyncio.sleep(interval)
+        self.loop.call_soon_threadsafe(lambda: self._tasks.append(self.loop.create_task(periodic())))
+    def every_async(self, interval: float, coro_func) -> None:
+        """
+        Schedules a coroutine function to run on the loop every `interval` seconds.
+        """
+        async def periodic() -> None:
+            while True:
+                try:
+                    await coro_func()
+                except Exception as e:
+                    self._log(f'Periodic task {coro_func.__name__} failed: {e}')
+                await asyncio.sleep(interval)
+        self.loop.call_soon_threadsafe(lambda: self._tasks.append(self.loop.create_task(periodic())))
+    async def _start_server(self) -> None:
+        host, port = self.ctx.network_address
+        self._server = await asyncio.start_server(self._serve, host, port, backlog=1024)
+    async def _stop_server(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._server.close()
+        # Closing the transports ends the read loops of the open connections.
+        for writer in self._connections.values():
+            writer.close()
+        await self.pool.close_all()
+        await asyncio.gather(*self._tasks, *self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+    async def _settle(self) -> None:
+        """
+        Waits, up to the engine's timeout, for the tasks of the connections being closed.
+        """
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=self.timeout)
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serves one connection until the peer closes it or it stays idle for idle_timeout.
+
+        Every request is handled in its own task, so requests on the same connection may be
+        answered out of order.
+        """
+        addr = writer.get_extra_info('peername')
+        lock = asyncio.Lock()
+        tasks = set()
+        current = asyncio.current_task()
+        self._connections[current] = writer
+        try:
+            while True:
+                message = await asyncio.wait_for(read_message(reader), self.idle_timeout)
+                task = self.loop.create_task(self._handle(addr, writer, lock, message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            self._log(f'Error reading from {addr}: {e}')
+        finally:
+            self._connections.pop(current, None)
+            if tasks:
+                await asyncio.wait(tasks)
+            writer.close()
+    async def _handle(self, addr: tuple, writer: asyncio.StreamWriter, lock: asyncio.Lock, message: Message) -> None:
+        conn = AsyncConnection(self.loop, writer, lock, message.request_id, accepted_codec(message.flags))
+        try:
+            if message.type in INLINE_MESSAGES:
+                async with lock:
+                    self.ctx.handle_message(conn, message)
+                    await writer.drain()
+                return
+            if self._in_flight >= self.workers + self.queue_size:
+                self._log(f'Handler queue full, shedding {message} from {addr}.')
+                async with lock:
+                    writer.write(encode_header(MessageType.BUSY, 0, 0, message.request_id))
+                    await writer.drain()
+                return
+            self._in_flight += 1
+            try:
+                await self.loop.run_in_executor(self._executor, self.ctx.handle_message, conn, message)
+            finally:
+                self._in_flight -= 1
+        except Exception as e:
+            self._log(f'Error handling {message} from {addr}: {e}')
+            if conn.started:
+                # Half of a response was written, the stream cannot be recovered.
+                writer.transport.abort()
+            else:
+                async with lock:
+                    writer.write(encode_header(MessageType.ERROR, len(str(e).encode()), 0, message.request_id) + str(e).encode())
+        finally:
+            conn.release()
+    async def _gather(self, coros) -> list:
+        """
+        Runs the coroutines concurrently, at most FANOUT_CONCURRENCY at a time, within one
+        overall FANOUT_DEADLINE. Exceptions, including the deadline's TimeoutError, are
+        returned in place of results.
+        """
+        semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+        end = self.loop.time() + FANOUT_DEADLINE
+        async def bounded(coro):
+            async with semaphore:
+                return await asyncio.wait_for(coro, max(0, end - self.loop.time()))
+        return await asyncio.gather(*(bounded(c) for c in coros), return_exceptions=True)
+    async def _arequest(self, address: (str, int), msg_type: MessageType, payload: bytes = b'', flags: int = 0, timeout: float = None) -> Message:
+        """
+        Sends a request over the engine's pool, with the engine's timeout by default,
+        recorded in the node's metrics and peer stats.
+        """
+        start = time.monotonic()
+        rsp = None
+        try:
+            rsp = await self.pool.request(address, msg_type, payload, timeout, flags)
+            self.ctx.peer_stats.record_rpc(address, True, time.monotonic() - start)
+            return rsp
+        except RemoteError:
+            # The peer answered, with an error about the request.
+            self.ctx.peer_stats.record_rpc(address, True, time.monotonic() - start)
+            raise
+        except Exception:
+            self.ctx.peer_stats.record_rpc(address, False)
+            raise
+        finally:
+            self.ctx.metrics.observe_rpc(
+                msg_type.name, f'{address[0]}:{address[1]}', time.monotonic() - start, rsp is not None,
+                HEADER.size + len(payload), rsp.size if rsp is not None else 0,
+            )
+    async def validate_address(self, host: str, port: int) -> bool:
+        try:
+            rsp = await self._arequest((host, port), MessageType.HELLO)
+            return rsp.type == MessageType.HELLOBACK
+        except Exception:
+            return False
+    async def manual_peer_add(self, ip: str, port: int) -> bool:
+        try:
+            payload = encode_json({'uid': self.ctx.uid, 'port': self.ctx.network_address[1], 'codecs': available_codecs()})
+            rsp = await self._arequest((ip, port), MessageType.ADDME, payload)
+            if rsp.type == MessageType.ACK:
+                data = rsp.json()
+                self.ctx.codecs[(ip, port)] = choose_codec([data.get('codec')])
+                self.ctx.add_known_peer(Peer(data['uid'], ip, port))
+                return True
+            return False
+        except Exception:
+            return False
+    async def codec_for(self, address: (str, int)) -> str:
+        """
+        Coroutine version of Application.codec_for.
+        """
+        address = tuple(address)
+        if address not in self.ctx.codecs:
+            try:
+                rsp = await self._arequest(address, MessageType.HELLO, encode_json({'codecs': available_codecs()}))
+            except Exception:
+                return None
+            self.ctx.codecs[address] = choose_codec([rsp.json().get('codec')]) if rsp.payload else None
+        return self.ctx.codecs[address]
+    async def request(self, address: (str, int), msg_type: MessageType, payload: bytes = b'') -> Message:
+        """
+        Coroutine version of Application.request.
+        """
+        codec = await self.codec_for(address)
+        payload, flags = compress_payload(payload, accept_flags(codec), codec)
+        return await self._arequest(address, msg_type, payload, flags)
+    async def update_peer_list(self) -> None:
+        """
+        Sends HELLO to every known peer concurrently and suspects the ones that do not answer.
+        Peers not reached before the deadline are left alone.
+        """
+        peers = list(self.ctx.known_peers.values())
+        alive = await self._gather(self.validate_address(peer.ip, peer.port) for peer in peers)
+        for peer, ok in zip(peers, alive):
+            if ok is False:
+                self.ctx.membership.suspect(peer.uid)
+    async def broadcast_peer_discovery(self) -> None:
+        peers = self.ctx.rank_peers()
+        responses = await self._gather(
+            self.request((peer.ip, peer.port), MessageType.BROADCASTREQUEST) for peer in peers
+        )
+        candidates = {}
+        for rsp in responses:
+            if isinstance(rsp, Message) and rsp.type == MessageType.BROADCASTRESPONSE:
+                for uid, ip, port in rsp.json():
+                    if uid not in self.ctx.known_peers and uid != self.ctx.uid:
+                        candidates[uid] = (ip, port)
+        await self._gather(self.manual_peer_add(ip, port) for ip, port in candidates.values())
+    async def refresh_network_index(self, max_age: float = SUBSCRIPTION_RENEW) -> None:
+        """
+        Coroutine version of Application.refresh_network_index.
+        """
+        known_peers = self.ctx.known_peers
+        self.ctx.netindex.expire(known_peers)
+        peers = self.ctx.rank_peers([peer for peer in known_peers.values() if self.ctx.netindex.needs_refresh(peer.uid, max_age)])
+        responses = await self._gather(
+            self.request((peer.ip, peer.port), MessageType.SUBSCRIBE, self.ctx.subscribe_request(peer.uid))
+            for peer in peers
+        )
+        for peer, rsp in zip(peers, responses):
+            if isinstance(rsp, Message) and rsp.type == MessageType.FILELISTRESPONSE:
+                self.ctx.netindex.apply(peer.uid, rsp.json(), subscribed=True)
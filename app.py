@@ -1,19 +1,48 @@
-from base64 import b64decode, b64encode
 from peer import Peer
 from menu import Menu, MenuState
+from protocol import Connection, Message, MessageType, PeerBusyError, ProtocolError, Reply, HEADER, MAX_MESSAGE_SIZE, RECV_CHUNK_SIZE, FLAG_ERROR, FLAG_CHUNKED, CODEC_SHIFT, FILE_RANGE, STREAM_LENGTH, BATCH_ENTRY, decode_header, encode_header, encode_json, request, accept_flags, accepted_codec, compress_payload, send_compressed_stream
+from transfer import PartialDownload, TransferError, TransferResult, BatchResult, request_batch, request_delta, request_piece_tree, request_range, BUSY_RETRY_DELAY, BATCH_INLINE_SIZE
+from swarm import SwarmDownloader, PIECE_SIZE
+from server import WorkerPool, PRIORITY_BULK, PRIORITY_CONTROL
+from aioengine import AsyncEngine
+from fanout import fan_out
+from connpool import ConnectionPool
+from fileindex import FileIndex
+from netindex import NetworkIndex
+from subscriptions import Publisher, SUBSCRIPTION_LEASE, SUBSCRIPTION_RENEW
+from membership import Membership
+from dht import DHT
+from watcher import create_watcher
+from throttle import UploadScheduler, UPLOAD_SLOTS, UPLOAD_QUEUE
+from compress import available_codecs, choose_codec, codec_id, is_compressible, COMPRESS_MIN_SIZE
+from logger import log, Preview, DEBUG, WARNING, ERROR
+from metrics import Metrics, MetricsServer
+from peerstats import PeerStats
+from downloads import DownloadManager, DOWNLOADS_FILENAME, DOWNLOAD_SLOTS, PEER_DOWNLOAD_SLOTS
+import logger
+import delta
+import fnmatch
 import uuid
 import threading
 import os
 import time
-import json
-import socket, socketserver
+import socket
+import selectors
 from datetime import datetime
 
-MESSAGE_SEPARATOR = b'|||'
 LISTENER_TIMEOUT = 1.0
-PEERUPDATE_TIMEOUT = 2.0
+PEERUPDATE_TIMEOUT = 1.0
 FILEUPDATE_TIMEOUT = 2.0
-NETWORK_BUFFER_SIZE = 1024
+DOWNLOAD_RETRIES = 3
+LISTENER_WORKERS = 8
+LISTENER_QUEUE_SIZE = 64
+ENGINES = ('threaded', 'asyncio')
+# Longer than the client pool's idle timeout, so clients normally close their idle connections first.
+SERVER_IDLE_TIMEOUT = 60.0
+# Requests streaming file data, handled after the control messages and holding an upload slot.
+BULK_MESSAGES = (MessageType.FILEGET, MessageType.PIECEHASHES, MessageType.FILEBATCH, MessageType.DELTA)
+# Local copies smaller than this are replaced with a full transfer rather than a delta.
+DELTA_MIN_SIZE = 1024 * 1024
 
 def generate_uid() -> str:
     return uuid.uuid4().hex.upper()[:8]
@@ -82,58 +111,160 @@ def set_network_ip(ctx: 'Application', ip: str) -> None:
 def set_network_address(ctx: 'Application', ip: str, port: int) -> None:
     ctx.network_address = (ip, port)
     
-def get_files(ctx: 'Application') -> [str]:
-    if not os.path.exists(ctx.file_dir):
-        os.makedirs(ctx.file_dir)
-    files = os.listdir(ctx.file_dir)
-    return files
-
 def validate_address(host: str, port: int) -> bool:
     """
     Validates if the given address is valid and available.
     A valid address can handle the 'HELLO' message.
     """
-    clsck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    clsck.settimeout(LISTENER_TIMEOUT)
     try:
-        clsck.connect((host, port))
-        clsck.sendall(b'HELLO')
-        rsp = b''
-        while True:
-            data = clsck.recv(NETWORK_BUFFER_SIZE)
-            rsp += data
-            if len(data) < NETWORK_BUFFER_SIZE:
-                break
-        if rsp != b'HELLOBACK':
+        rsp = request((host, port), MessageType.HELLO, timeout=LISTENER_TIMEOUT)
+        if rsp.type != MessageType.HELLOBACK:
             raise Exception('Invalid response.')
-        clsck.close()
         return True
     except:
-        clsck.close()
         return False
 
-def log(start: float, msg: str, *args, **kwargs) -> None:
-    end = time.time()
-    content = f'[{end - start:.3f}s] {msg}'
-    with open('log.txt', 'a') as f:
-        f.write(content + '\n')
-    # print(content, *args, **kwargs)
+class ServerConnection:
+    """
+    State of an accepted connection, which may carry many requests over its lifetime.
+    """
+    def __init__(self, conn: Connection, addr: tuple) -> None:
+        self.conn = conn
+        self.addr = addr
+        self.last_active = time.time()
+        self.in_flight = 0
+        self.closing = False
+        # Bytes received but not yet making up a whole message.
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+    def read_messages(self) -> [Message]:
+        """
+        Reads what the socket holds, once, without waiting for more, and returns the whole
+        messages received so far. Raises ConnectionError if the peer closed the connection,
+        or ProtocolError for a broken frame.
+        """
+        data = self.conn.sock.recv(RECV_CHUNK_SIZE)
+        if not data:
+            raise ConnectionError('Connection closed by peer.')
+        self._buffer += data
+        self.last_active = time.time()
+        messages = []
+        while len(self._buffer) >= HEADER.size:
+            msg_type, flags, request_id, length = decode_header(self._buffer[:HEADER.size])
+            if length > MAX_MESSAGE_SIZE:
+                raise ProtocolError(f'Message of {length} bytes over the limit of {MAX_MESSAGE_SIZE}.')
+            end = HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            messages.append(Message(msg_type, bytes(self._buffer[HEADER.size:end]), flags, request_id))
+            del self._buffer[:end]
+        return messages
+    def begin_request(self) -> None:
+        with self._lock:
+            self.in_flight += 1
+            self.last_active = time.time()
+    def end_request(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.last_active = time.time()
+            close = self.closing and self.in_flight == 0
+        if close:
+            self.conn.close()
+    def close(self) -> None:
+        """
+        Closes the connection now, or once its requests in flight have been answered.
+        """
+        with self._lock:
+            self.closing = True
+            close = self.in_flight == 0
+        if close:
+            self.conn.close()
+    def abort(self) -> None:
+        """
+        Shuts the connection down from a worker; the listener notices and releases it.
+        """
+        try:
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 class Application:
-    def __init__(self) -> None:
+    def __init__(self, listener_workers: int = LISTENER_WORKERS, listener_queue_size: int = LISTENER_QUEUE_SIZE, engine: str = 'threaded', dht: bool = False, upload_slots: int = UPLOAD_SLOTS, upload_rate: int = None, peer_upload_rate: int = None, metrics_file: str = None, metrics_port: int = None, file_dir: str = None, download_slots: int = DOWNLOAD_SLOTS, peer_download_slots: int = PEER_DOWNLOAD_SLOTS) -> None:
+        """
+        Parameters:
+        - listener_workers: Number of threads handling incoming requests.
+        - listener_queue_size: Number of accepted requests that may wait for a worker before
+          new ones are answered with BUSY.
+        - engine: 'threaded' runs the listener, file update and peer update on their own threads;
+          'asyncio' runs all of them, the network-wide queries and every outbound RPC on a single
+          event loop.
+        - dht: Joins the DHT overlay, publishing the shared files and looking up files that
+          no known peer lists.
+        - upload_slots: Number of files sent at once, see throttle.py. Should stay below
+          listener_workers, so control messages always find a free worker.
+        - upload_rate: Upload bandwidth limit in bytes per second, None for unlimited.
+        - peer_upload_rate: Upload bandwidth limit per peer in bytes per second.
+        - metrics_file: File the metrics are written to in the Prometheus text format,
+          every PEERUPDATE_TIMEOUT seconds, see metrics.py.
+        - metrics_port: Port serving the metrics over HTTP in the same format.
+        - file_dir: Directory of the shared files, get_file_dir() by default.
+        - download_slots: Number of queued downloads run at once, see downloads.py.
+        - peer_download_slots: Number of queued downloads run at once from the same peer.
+        """
+        if engine not in ENGINES:
+            raise Exception(f'Unknown engine {engine}.')
         self._start = time.time()
+        self.metrics = Metrics()
+        self.metrics_file = metrics_file
+        self._metrics_server = None
+        if metrics_port is not None:
+            self._metrics_server = MetricsServer(self.metrics, metrics_port)
+            self._metrics_server.start()
+        # RTT, throughput and error rate of every peer, ranking the peers, see peerstats.py.
+        self.peer_stats = PeerStats()
+        self.pool = ConnectionPool(LISTENER_TIMEOUT, metrics=self.metrics, stats=self.peer_stats)
         log(self._start, '-' * 40)
-        log(self._start, f'Today is {time.strftime("%d/%m/%Y")} at {time.strftime("%H:%M:%S")}')
+        log(self._start, 'Today is %s at %s', time.strftime('%d/%m/%Y'), time.strftime('%H:%M:%S'))
         self.uid = generate_uid()
         self._knownpeers_lock = threading.Lock()
         self.known_peers = {}
         self._fileupdate_lock = threading.Lock()
-        self.file_dir = get_file_dir()
-        self.update_file_list()
+        self.codecs = {}
+        self.publisher = Publisher(self.uid, lambda: self.index, self.request, lambda msg: log(self._start, msg))
+        self.publisher.start()
+        self._watcher = None
+        self.netindex = NetworkIndex()
+        self.uploads = UploadScheduler(upload_slots, UPLOAD_QUEUE, upload_rate, peer_upload_rate, LISTENER_TIMEOUT)
+        self.set_file_dir(file_dir or get_file_dir())
         self.network_address = get_network_address()
         self.friendly_network_host = get_friendly_network_host()
-        log(self._start, f'Network address: {self.network_address[0]}:{self.network_address[1]}')
+        log(self._start, 'Network address: %s:%s', *self.network_address)
+        self._engine = None
+        if engine == 'asyncio':
+            self._engine = AsyncEngine(self, listener_workers, listener_queue_size, LISTENER_TIMEOUT, SERVER_IDLE_TIMEOUT, lambda msg: log(self._start, msg))
+            # Every RPC goes over the engine's connections, read on its loop rather than by a thread each.
+            self.pool = self._engine.blocking_pool
+        self.membership = Membership(self.uid, self.network_address[1], self.pool.request, self.add_known_peer, self._peer_died, PEERUPDATE_TIMEOUT, lambda msg: log(self._start, msg))
+        self.dht = None
+        self._provider_keys = (None, set())
+        if dht:
+            self.dht = DHT(self.uid, self.network_address[1], self.pool.request, self.provider_keys, lambda msg: log(self._start, msg))
+            self.dht.start()
+        # The queue stays in the file directory the node started with.
+        self.downloads = DownloadManager(self, os.path.join(self.file_dir, DOWNLOADS_FILENAME), download_slots, peer_download_slots, lambda msg: log(self._start, msg))
+        if self._engine is not None:
+            self._engine.start()
+            self._engine.every(FILEUPDATE_TIMEOUT, self.update_file_list)
+            self._engine.every(PEERUPDATE_TIMEOUT, self.membership.tick)
+            self._engine.every_async(PEERUPDATE_TIMEOUT, self._engine.refresh_network_index)
+            self._engine.every(PEERUPDATE_TIMEOUT, self.pool.close_idle)
+            if self.metrics_file is not None:
+                self._engine.every(PEERUPDATE_TIMEOUT, self.write_metrics)
+            self.downloads.start()
+            return
         self._listen = True
+        self._listener_pool = WorkerPool(self._serve_request, listener_workers, listener_queue_size, 'listener')
+        self._listener_pool.start()
         self._listener_thread = threading.Thread(target=self._listener)
         self._listener_thread.start()
         self._fileupdate_enabled = True
@@ -142,27 +273,43 @@ class Application:
         self._peerupdate_enabled = True
         self._peerupdate_thread = threading.Thread(target=self._peerupdate)
         self._peerupdate_thread.start()
+        self.downloads.start()
     def run(self) -> None:
         try:
             log(self._start, 'Validating network address.')
             if validate_address(self.network_address[0], self.network_address[1]) != True:
-                log(self._start, 'Could not validate network address.')
+                log(self._start, 'Could not validate network address.', level=ERROR)
                 raise Exception('Already in use or invalid network address.')
             log(self._start, 'Initializing application.')
             self.menuloop()
             log(self._start, 'Stopping application.')
             self.stop()
         except Exception as e:
-            log(self._start, f'Error: {e}')
+            log(self._start, 'Error: %s', e, level=ERROR)
             self.stop()
             raise e
     def stop(self) -> None:
-        self._listen = False
-        self._fileupdate_enabled = False
-        self._peerupdate_enabled = False
-        self._listener_thread.join()
-        self._fileupdate_thread.join()
-        self._peerupdate_thread.join()
+        self.downloads.stop()
+        self.publisher.stop()
+        if self.dht is not None:
+            self.dht.stop()
+        self.pool.close_all()
+        if self._engine is not None:
+            self._engine.stop()
+        else:
+            self._listen = False
+            self._fileupdate_enabled = False
+            self._peerupdate_enabled = False
+            self._listener_thread.join()
+            self._listener_pool.stop()
+            self._fileupdate_thread.join()
+            self._peerupdate_thread.join()
+        FileIndex.shutdown()
+        self._watcher.close()
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+        self.write_metrics()
+        logger.flush()
     def add_known_peer(self, peer: Peer) -> None:
         """
         Add peer to known peers list.
@@ -179,6 +326,9 @@ class Application:
         self._knownpeers_lock.acquire()
         self.known_peers[peer.uid] = peer
         self._knownpeers_lock.release()
+        self.membership.add(peer.uid, peer.ip, peer.port)
+        if self.dht is not None:
+            self.dht.add_contact(peer.uid, peer.ip, peer.port)
     def remove_known_peer(self, uid: str) -> None:
         """
         Remove peer from known peers list.
@@ -193,8 +343,45 @@ class Application:
         - None
         """
         self._knownpeers_lock.acquire()
-        del self.known_peers[uid]
+        peer = self.known_peers.pop(uid, None)
+        if peer is None:
+            # Already removed, by another thread or the membership layer.
+            self._knownpeers_lock.release()
+            return
+        self.netindex.drop(uid)
+        self._knownpeers_lock.release()
+        self.membership.remove(uid)
+    def remove_known_peers(self, uids: [str]) -> None:
+        """
+        Remove several peers from the known peers list at once, ignoring unknown IDs.
+        
+        The lock is held only while the new dictionary is swapped in.
+        
+        Parameters:
+        - uids: Peer IDs to be removed.
+        
+        Returns:
+        - None
+        """
+        uids = set(uids)
+        if len(uids) == 0:
+            return
+        self._knownpeers_lock.acquire()
+        self.known_peers = {uid: peer for uid, peer in self.known_peers.items() if uid not in uids}
+        for uid in uids:
+            self.netindex.drop(uid)
         self._knownpeers_lock.release()
+    def _peer_died(self, uid: str) -> None:
+        """
+        Called by the membership layer when a peer is declared dead.
+        """
+        peer = self.known_peers.get(uid)
+        self.remove_known_peers([uid])
+        if peer is not None:
+            self.pool.close_peer((peer.ip, peer.port))
+            # It may come back with another build, negotiate again then, and measure it afresh.
+            self.codecs.pop((peer.ip, peer.port), None)
+            self.peer_stats.forget((peer.ip, peer.port))
     def get_known_peer(self, uid: str) -> Peer:
         """
         Retrieve a peer from the known peers list.
@@ -212,12 +399,34 @@ class Application:
         peer = self.known_peers[uid]
         self._knownpeers_lock.release()
         return peer
+    def rank_peers(self, peers: [Peer] = None, size: int = None) -> [Peer]:
+        """
+        Orders peers from the fastest healthy one to the slowest, by their measured RTT,
+        throughput and error rate, see peerstats.py. Downloads, queries and discovery go
+        to the peers in this order.
+        
+        Parameters:
+        - peers: Peers to be ranked, all known peers by default.
+        - size: Bytes to be downloaded from the chosen peer, None to rank by RTT only.
+        
+        Returns:
+        - List of the peers, best first.
+        """
+        if peers is None:
+            peers = list(self.known_peers.values())
+        return self.peer_stats.rank(peers, size)
     def _listener(self) -> None:
         """
         Listener thread.
         
-        The listener thread is responsible for receiving messages from other peers, handling
-        them and responding accordingly. The messages are handled by the handle_message method.
+        The listener thread accepts connections from other peers and keeps them open, waiting
+        on all of them with a selector. A ready connection is read once, without waiting for
+        the rest of a message, so a slow or large sender does not hold up the others; every
+        request completed is handed to a bounded pool of worker
+        threads, which handle and respond to it through the handle_message method; responses
+        carry the request id, so requests on one connection may be answered out of order.
+        When the pool's queue is full the request is answered with BUSY, so a burst of slow
+        requests cannot stall the listener. Connections idle for SERVER_IDLE_TIMEOUT are closed.
         
         Usage:
         ```
@@ -226,78 +435,202 @@ class Application:
         ```
         """
         srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        srv.settimeout(LISTENER_TIMEOUT)
         srv.bind(self.network_address)
         srv.listen()
+        srv.setblocking(False)
+        sel = selectors.DefaultSelector()
+        sel.register(srv, selectors.EVENT_READ, None)
+        clients = {}
         while self._listen == True:
-            try:
-                conn, addr = srv.accept()
-                msg = b''
-                while True:
-                    data = conn.recv(NETWORK_BUFFER_SIZE)
-                    msg += data
-                    if len(data) < NETWORK_BUFFER_SIZE:
-                        break
-                self.handle_message(conn, msg)
-                conn.close()
-            except socket.timeout:
-                pass
+            for key, _ in sel.select(LISTENER_TIMEOUT):
+                if key.data is None:
+                    try:
+                        sock, addr = srv.accept()
+                    except BlockingIOError:
+                        continue
+                    sock.settimeout(LISTENER_TIMEOUT)
+                    client = ServerConnection(Connection(sock), addr)
+                    clients[sock] = client
+                    sel.register(sock, selectors.EVENT_READ, client)
+                    continue
+                client = key.data
+                try:
+                    messages = client.read_messages()
+                except Exception:
+                    # Closed by the peer, or a broken frame: the connection cannot be used anymore.
+                    sel.unregister(key.fileobj)
+                    del clients[key.fileobj]
+                    client.close()
+                    continue
+                for message in messages:
+                    client.begin_request()
+                    priority = PRIORITY_BULK if message.type in BULK_MESSAGES else PRIORITY_CONTROL
+                    if not self._listener_pool.submit((client, message), priority):
+                        self._shed_request(client, message)
+                        client.end_request()
+            now = time.time()
+            for sock, client in list(clients.items()):
+                if client.in_flight == 0 and now - client.last_active > SERVER_IDLE_TIMEOUT:
+                    sel.unregister(sock)
+                    del clients[sock]
+                    client.close()
+        for client in clients.values():
+            client.close()
+        sel.close()
         srv.close()
-    def handle_message(self, connection: socket.socket, message: bytes) -> None:
+    def _serve_request(self, item: (ServerConnection, Message)) -> None:
         """
-        Maps the message header to the appropriate handler.
+        Worker pool handler: handles one request and writes its response.
+        
+        If the handler fails before responding, the client gets an ERROR response;
+        if it fails half-way through a response, the connection is shut down.
+        """
+        client, message = item
+        reply = Reply(client.conn, message.request_id, accepted_codec(message.flags))
+        try:
+            self.handle_message(reply, message)
+        except Exception as e:
+            log(self._start, 'Error handling %s from %s: %s', message, client.addr, e, level=WARNING)
+            if reply.started:
+                client.abort()
+            else:
+                try:
+                    reply.send(MessageType.ERROR, str(e).encode())
+                except OSError:
+                    client.abort()
+        finally:
+            reply.close()
+            client.end_request()
+    def _shed_request(self, client: ServerConnection, message: Message) -> None:
+        """
+        Answers a request with BUSY without handling it.
+        
+        The listener must never wait on a response being streamed on the same connection,
+        so if one is in progress the BUSY is skipped and the client times out instead.
+        """
+        log(self._start, 'Listener queue full, shedding %s from %s.', message, client.addr, level=WARNING)
+        if not client.conn.send_lock.acquire(blocking=False):
+            return
+        try:
+            client.conn.send(MessageType.BUSY, b'', 0, message.request_id)
+        except OSError:
+            client.abort()
+        finally:
+            client.conn.send_lock.release()
+    def handle_message(self, connection: Connection, message: Message) -> None:
+        """
+        Maps the message type to the appropriate handler.
         Receives a message and calls the appropriate handler.
         
         Parameters:
-        - connection: Socket connection object.
-        - message: Message bytes.
+        - connection: Framed connection object.
+        - message: Decoded message.
         
         Returns:
         - None
         """
-        log(self._start, f'Received message: {message}')
-        header = message.split(MESSAGE_SEPARATOR)[0]
+        log(self._start, 'Received message: %s %s', message, Preview(message.payload), level=DEBUG)
         switcher = {
-            b'HELLO': self.handle_hello,
-            b'ADDME': self.handle_addme,
-            b'BROADCASTREQUEST': self.handle_broadcast_request,
-            b'FILELIST': self.handle_filelist,
-            b'FILEGET': self.handle_fileget,
+            MessageType.HELLO: self.handle_hello,
+            MessageType.ADDME: self.handle_addme,
+            MessageType.BROADCASTREQUEST: self.handle_broadcast_request,
+            MessageType.FILELIST: self.handle_filelist,
+            MessageType.FILEGET: self.handle_fileget,
+            MessageType.FILEBATCH: self.handle_filebatch,
+            MessageType.DELTA: self.handle_delta,
+            MessageType.PIECEHASHES: self.handle_piecehashes,
+            MessageType.SUBSCRIBE: self.handle_subscribe,
+            MessageType.FILELISTUPDATE: self.handle_filelistupdate,
+            MessageType.PING: self.handle_ping,
+            MessageType.PINGREQ: self.handle_pingreq,
+            MessageType.STATS: self.handle_stats,
         }
-        switcher[header](connection, message)
-    def handle_hello(self, connection: socket.socket, message: bytes) -> None:
+        if self.dht is not None:
+            switcher[MessageType.DHT_FIND_NODE] = self.handle_dht
+            switcher[MessageType.DHT_FIND_VALUE] = self.handle_dht
+            switcher[MessageType.DHT_STORE] = self.handle_dht
+        if message.type not in switcher:
+            raise Exception(f'Unexpected message type {message.type.name}.')
+        start = time.monotonic()
+        ok = False
+        try:
+            switcher[message.type](connection, message)
+            ok = True
+        finally:
+            self.metrics.observe_request(message.type.name, connection.getpeername()[0], time.monotonic() - start, message.size, connection.sent, ok)
+    def handle_hello(self, connection: Connection, message: Message) -> None:
         """
         Handles the HELLO message.
         Hello messages are used to validate if the peer is available.
+        The request may carry the `codecs` the peer supports, in which case the response
+        carries the `codec` chosen for the compression of our exchanges, see compress.py.
+        """
+        if not message.payload:
+            connection.send(MessageType.HELLOBACK)
+            return
+        codec = choose_codec(message.json().get('codecs', []))
+        connection.send_json(MessageType.HELLOBACK, {'codec': codec})
+    def handle_ping(self, connection: Connection, message: Message) -> None:
+        """
+        Handles the PING message.
+        Ping messages are the membership probes, carrying piggybacked membership updates.
+        Response is a PINGACK message with our own updates.
         """
-        msg = b'HELLOBACK'
-        connection.send(msg)
-    def handle_addme(self, connection: socket.socket, message: bytes) -> None:
+        payload = self.membership.handle_ping(connection.getpeername()[0], message.json())
+        connection.send(MessageType.PINGACK, payload)
+    def handle_pingreq(self, connection: Connection, message: Message) -> None:
+        """
+        Handles the PINGREQ message.
+        PingReq messages ask us to probe the `target` peer on behalf of a peer that could
+        not reach it. Response is PINGACK if the target answered, NACK otherwise.
+        """
+        payload = self.membership.handle_pingreq(connection.getpeername()[0], message.json())
+        if payload is None:
+            connection.send(MessageType.NACK)
+        else:
+            connection.send(MessageType.PINGACK, payload)
+    def handle_stats(self, connection: Connection, message: Message) -> None:
+        """
+        Handles the STATS message.
+        Stats messages request our metrics, see metrics.py.
+        Response is a STATSRESPONSE message with Metrics.snapshot().
+        """
+        connection.send_json(MessageType.STATSRESPONSE, self.metrics.snapshot())
+    def handle_dht(self, connection: Connection, message: Message) -> None:
+        """
+        Handles the DHT_FIND_NODE, DHT_FIND_VALUE and DHT_STORE messages, see dht.py.
+        Only registered when the node joined the DHT.
+        """
+        msg_type, payload = self.dht.handle(message.type, connection.getpeername()[0], message.json())
+        connection.send(msg_type, payload)
+    def handle_addme(self, connection: Connection, message: Message) -> None:
         """
         Handles the ADDME message.
         AddMe messages are used to add a peer to the known peers. The peer must respond with ACK or NACK, depending on the validation result.
         ACK means the peer was added successfully.
         NACK means the peer was not added due to validation issues, like NAT or firewall.
+        The compression codec is negotiated like in handle_hello.
         """
         addr = connection.getpeername()
-        client_uid = message.split(MESSAGE_SEPARATOR)[1].decode()
+        request = message.json()
+        client_uid = request['uid']
         client_ip = addr[0]
-        client_port = int(message.split(MESSAGE_SEPARATOR)[2].decode())
+        client_port = int(request['port'])
         # Try connecting back to prevent NAT issues.
         res = validate_address(client_ip, client_port)
         if res != True:
-            log(self._start, f'Client {client_uid} ({client_ip}:{client_port}) could not be validated.')
-            msg = b'NACK'
-            connection.send(msg)
-            log(self._start, f'Sent: {msg}')
+            log(self._start, 'Client %s (%s:%s) could not be validated.', client_uid, client_ip, client_port, level=WARNING)
+            connection.send(MessageType.NACK)
+            log(self._start, 'Sent: NACK', level=DEBUG)
         else:
-            log(self._start, f'Client {client_uid} ({client_ip}:{client_port}) connected. Adding to known peers.')
+            log(self._start, 'Client %s (%s:%s) connected. Adding to known peers.', client_uid, client_ip, client_port)
             peer = Peer(client_uid, client_ip, client_port)
+            codec = choose_codec(request.get('codecs', []))
+            self.codecs[(client_ip, client_port)] = codec
             self.add_known_peer(peer)
-            msg = b'ACK' + MESSAGE_SEPARATOR + self.uid.encode()
-            connection.send(msg)
-            log(self._start, f'Sent: {msg}')
-    def handle_broadcast_request(self, connection: socket.socket, message: bytes) -> None:
+            connection.send_json(MessageType.ACK, {'uid': self.uid, 'codec': codec})
+            log(self._start, 'Sent: ACK', level=DEBUG)
+    def handle_broadcast_request(self, connection: Connection, message: Message) -> None:
         """
         Handles the BROADCASTREQUEST message.
         BroadcastRequest messages are used to request the known peers list.
@@ -308,33 +641,233 @@ class Application:
             my_peers.append(
                 (peer.uid, peer.ip, peer.port)
             )
-        peerstr = json.dumps(my_peers)
-        msg = b'BROADCASTRESPONSE' + MESSAGE_SEPARATOR + peerstr.encode()
-        connection.send(msg)
-    def handle_filelist(self, connection: socket.socket, message: bytes) -> None:
+        connection.send_json(MessageType.BROADCASTRESPONSE, my_peers)
+    def handle_filelist(self, connection: Connection, message: Message) -> None:
         """
         Handles the FILELIST message.
         FileList messages are used to request the file list.
+        Response is a FILELISTRESPONSE message with the name, size and SHA-256 of every
+        shared file. The hash is None while a large file is still being hashed.
+        The request may carry the `epoch` and `since` version of a list received earlier,
+        in which case only the files `added` and `removed` since then are sent, when possible.
+        """
+        request = message.json() if message.payload else {}
+        data = self.index.changes_since(request.get('epoch'), request.get('since'))
+        data['uid'] = self.uid
+        connection.send_json(MessageType.FILELISTRESPONSE, data)
+    def handle_subscribe(self, connection: Connection, message: Message) -> None:
+        """
+        Handles the SUBSCRIBE message.
+        Subscribe messages ask for the file list, like FILELIST, and for the changes to it to
+        be pushed to the subscriber's `port` with FILELISTUPDATE for the next `lease` seconds.
         Response is a FILELISTRESPONSE message.
         """
-        filestr = json.dumps(self.files)
-        msg = b'FILELISTRESPONSE' + MESSAGE_SEPARATOR + self.uid.encode() + MESSAGE_SEPARATOR + filestr.encode()
-        connection.send(msg)
-    def handle_fileget(self, connection: socket.socket, message: bytes) -> None:
+        addr = connection.getpeername()
+        request = message.json()
+        data = self.index.changes_since(request.get('epoch'), request.get('since'))
+        lease = request.get('lease', SUBSCRIPTION_LEASE)
+        self.publisher.subscribe(request['uid'], (addr[0], int(request['port'])), data['epoch'], data['version'], lease)
+        data['uid'] = self.uid
+        connection.send_json(MessageType.FILELISTRESPONSE, data)
+    def handle_filelistupdate(self, connection: Connection, message: Message) -> None:
+        """
+        Handles the FILELISTUPDATE message.
+        FileListUpdate messages push the changes to the file list of a peer we subscribed to.
+        Response is ACK, or NACK if the peer is unknown or changes were missed, which ends
+        the subscription until the next refresh subscribes again.
+        """
+        data = message.json()
+        if data['uid'] not in self.known_peers or not self.netindex.apply(data['uid'], data):
+            connection.send(MessageType.NACK)
+            return
+        connection.send(MessageType.ACK)
+    def handle_fileget(self, connection: Connection, message: Message) -> None:
         """
         Handles the FILEGET message.
-        FileGet messages are used to request a file from the peer.
-        Response is a FILEGETRESPONSE message.
-        """
-        filename = message.split(MESSAGE_SEPARATOR)[1].decode()
-        if filename in self.files:
-            with open(self.file_dir + filename, 'rb') as f:
-                filedata = b64encode(f.read())
-            msg = b'FILEGETRESPONSE' + MESSAGE_SEPARATOR + b'OK' + MESSAGE_SEPARATOR + filedata
-            connection.send(msg)
+        FileGet messages are used to request a file, or a byte range of it, from the peer.
+        The file is requested by `name` or by content `hash`, so a file can be fetched from
+        peers that named it differently.
+        The request may carry an `offset` and a `length`; by default the whole file is sent.
+        Response is a FILEGETRESPONSE message starting with the served offset and the total
+        file size, followed by the raw file bytes streamed from disk with sendfile.
+        If the request accepts a compression codec and sampling shows the file compresses,
+        the response is chunked instead, see send_compressed_stream.
+        If the file is not shared or the range is invalid, the response has the error flag set.
+        The response is sent within an upload slot and the bandwidth limits, see throttle.py;
+        if no slot frees up in time, the response is BUSY.
+        """
+        request = message.json()
+        filename = self._requested_file(request)
+        if filename is None:
+            connection.send(MessageType.FILEGETRESPONSE, b'File not found.', FLAG_ERROR)
+            return
+        slot = self.uploads.acquire(connection.getpeername()[0])
+        if slot is None:
+            connection.send(MessageType.BUSY)
+            return
+        with slot, open(os.path.join(self.file_dir, filename), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = int(request.get('offset', 0))
+            if offset < 0 or offset > size:
+                connection.send(MessageType.FILEGETRESPONSE, b'Invalid range.', FLAG_ERROR)
+                return
+            count = size - offset
+            if request.get('length') is not None:
+                count = max(0, min(count, int(request['length'])))
+            codec = connection.codec
+            if codec is not None and count >= COMPRESS_MIN_SIZE and is_compressible(f):
+                flags = FLAG_CHUNKED | codec_id(codec) << CODEC_SHIFT
+                connection.send(MessageType.FILEGETRESPONSE, FILE_RANGE.pack(offset, size) + STREAM_LENGTH.pack(count), flags)
+                send_compressed_stream(connection, f, offset, count, codec, slot.throttle, slot.chunk_size)
+                return
+            connection.send_header(MessageType.FILEGETRESPONSE, FILE_RANGE.size + count)
+            connection.sendall(FILE_RANGE.pack(offset, size))
+            slot.sendfile(connection, f, offset, count)
+    def handle_filebatch(self, connection: Connection, message: Message) -> None:
+        """
+        Handles the FILEBATCH message.
+        FileBatch messages request many files at once by `names`, each a file name or a glob
+        pattern like `*.txt`, so a directory of small files is fetched over one connection
+        instead of with one FILEGET each.
+        Response is one FILEBATCHENTRY per matching file, streamed back-to-back, then a
+        FILEBATCHRESPONSE with the `missing` names that matched no file, see protocol.py.
+        Files up to BATCH_INLINE_SIZE are read whole, and compressed if the request accepts
+        a codec and they compress; larger ones are streamed raw with sendfile. The whole
+        batch is sent within one upload slot and the bandwidth limits.
+        """
+        names = message.json().get('names')
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            connection.send(MessageType.FILEBATCHRESPONSE, b'Invalid request.', FLAG_ERROR)
+            return
+        matched, missing = self._match_files(names)
+        slot = self.uploads.acquire(connection.getpeername()[0])
+        if slot is None:
+            connection.send(MessageType.BUSY)
+            return
+        with slot:
+            for filename in matched:
+                try:
+                    f = open(os.path.join(self.file_dir, filename), 'rb')
+                except OSError:
+                    missing.append(filename)
+                    continue
+                with f:
+                    st = os.fstat(f.fileno())
+                    header = encode_json({'name': filename, 'size': st.st_size, 'sha256': self._indexed_hash(filename, st)})
+                    prefix = BATCH_ENTRY.pack(len(header)) + header
+                    if st.st_size > BATCH_INLINE_SIZE:
+                        connection.send_header(MessageType.FILEBATCHENTRY, len(prefix) + st.st_size)
+                        connection.sendall(prefix)
+                        slot.sendfile(connection, f, 0, st.st_size)
+                        continue
+                    data = f.read(st.st_size)
+                    if len(data) != st.st_size:
+                        missing.append(filename)
+                        continue
+                    payload, flags = prefix + data, 0
+                    if len(data) >= COMPRESS_MIN_SIZE and is_compressible(f):
+                        payload, flags = compress_payload(payload, flags, connection.codec)
+                    slot.sendall(connection, encode_header(MessageType.FILEBATCHENTRY, len(payload), flags, message.request_id) + payload)
+            connection.send_json(MessageType.FILEBATCHRESPONSE, {'missing': missing})
+    def handle_delta(self, connection: Connection, message: Message) -> None:
+        """
+        Handles the DELTA message.
+        Delta messages request a file, by `name` or content `hash` like FILEGET, as a delta
+        against the `block_size` signatures of the requester's older copy, see delta.py.
+        Response is a DELTARESPONSE message with the `size` and `sha256` of our version,
+        then DELTADATA messages with the delta operations, ended by an empty DELTADATA.
+        If the file is not shared or the request is invalid, the response has the error flag set.
+        The delta is sent within an upload slot and the bandwidth limits, and compressed
+        like FILEGET if the request accepts a codec and the file compresses.
+        """
+        try:
+            request, packed = delta.decode_request(message.payload)
+            block_size = int(request['block_size'])
+            if not delta.BLOCK_MIN <= block_size <= delta.BLOCK_MAX:
+                raise delta.DeltaError('Invalid block size.')
+            table = delta.signature_table(packed)
+        except (delta.DeltaError, KeyError, TypeError, ValueError):
+            connection.send(MessageType.DELTARESPONSE, b'Invalid request.', FLAG_ERROR)
+            return
+        filename = self._requested_file(request)
+        if filename is None:
+            connection.send(MessageType.DELTARESPONSE, b'File not found.', FLAG_ERROR)
+            return
+        slot = self.uploads.acquire(connection.getpeername()[0])
+        if slot is None:
+            connection.send(MessageType.BUSY)
+            return
+        with slot, open(os.path.join(self.file_dir, filename), 'rb') as f:
+            st = os.fstat(f.fileno())
+            connection.send_json(MessageType.DELTARESPONSE, {'size': st.st_size, 'sha256': self._indexed_hash(filename, st)})
+            compressed = connection.codec is not None and is_compressible(f)
+            for frame in delta.encode_frames(delta.compute_delta(f, block_size, table)):
+                frame, flags = compress_payload(frame, 0, connection.codec) if compressed else (frame, 0)
+                slot.sendall(connection, encode_header(MessageType.DELTADATA, len(frame), flags, message.request_id) + frame)
+            connection.send(MessageType.DELTADATA)
+    def _indexed_hash(self, filename: str, st: os.stat_result) -> str:
+        """
+        Returns the indexed hash of a shared file if it is of the version `st` describes,
+        None otherwise.
+        """
+        entry = self.index.get(filename)
+        if entry is None or (entry.size, entry.mtime_ns) != (st.st_size, st.st_mtime_ns):
+            return None
+        return entry.sha256
+    def _match_files(self, names: [str]) -> ([str], [str]):
+        """
+        Matches file names and glob patterns against the shared files.
+        
+        Returns:
+        - Tuple (matching file names, each once and in request order, names and patterns
+          that matched no file).
+        """
+        files = self.files
+        matched = []
+        seen = set()
+        missing = []
+        for name in names:
+            if any(c in name for c in '*?['):
+                hits = sorted(n for n in files if fnmatch.fnmatchcase(n, name))
+            else:
+                hits = [name] if name in files else []
+            if not hits:
+                missing.append(name)
+            for hit in hits:
+                if hit not in seen:
+                    seen.add(hit)
+                    matched.append(hit)
+        return (matched, missing)
+    def handle_piecehashes(self, connection: Connection, message: Message) -> None:
+        """
+        Handles the PIECEHASHES message.
+        PieceHashes messages request the piece hashes of a file, by `name` or content `hash`
+        like FILEGET, so the downloader can verify every piece as it lands, see merkle.py.
+        Response is a PIECEHASHESRESPONSE message with the file `size`, the `piece_size`, the
+        `pieces` hashes and their Merkle `root`, or the error flag set if the file is not shared
+        or its piece hashes are not available yet; the file is never hashed while the
+        requester waits, see FileIndex.piece_tree.
+        """
+        filename = self._requested_file(message.json())
+        if filename is None:
+            connection.send(MessageType.PIECEHASHESRESPONSE, b'File not found.', FLAG_ERROR)
+            return
+        tree = self.index.piece_tree(filename)
+        if tree is None:
+            connection.send(MessageType.PIECEHASHESRESPONSE, b'Piece hashes not available.', FLAG_ERROR)
+            return
+        connection.send_json(MessageType.PIECEHASHESRESPONSE, tree.to_dict())
+    def _requested_file(self, request: dict) -> str:
+        """
+        Returns the name of the shared file a FILEGET or PIECEHASHES asks for, or None.
+        """
+        if request.get('hash') is not None:
+            filename = self.index.name_for_hash(request['hash'])
         else:
-            msg = b'FILEGETRESPONSE' + MESSAGE_SEPARATOR + b'NOK'
-            connection.send(msg)
+            filename = request['name']
+        if filename is None or filename not in self.files:
+            return None
+        return filename
     def manual_peer_add(self, ip: str, port: int) -> bool:
         """
         Manually adds a peer to the known peers list.
@@ -342,92 +875,172 @@ class Application:
         It sends the ADDME message to the peer and waits for the response.
         If the response is ACK, the peer is added to the known peers list.
         """
-        clsck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        clsck.settimeout(LISTENER_TIMEOUT)
+        if self._engine is not None:
+            return self._engine.run(self._engine.manual_peer_add(ip, port))
         try:
-            clsck.connect((ip, port))
-            msg = b'ADDME' + MESSAGE_SEPARATOR + self.uid.encode() + MESSAGE_SEPARATOR + str(self.network_address[1]).encode()
-            clsck.sendall(msg)
-            rsp = b''
-            while True:
-                data = clsck.recv(NETWORK_BUFFER_SIZE)
-                rsp += data
-                if len(data) < NETWORK_BUFFER_SIZE:
-                    break
-            log(self._start, f'Received message: {rsp}')
-            if rsp.split(MESSAGE_SEPARATOR)[0] == b'ACK':
-                clsck.close()
-                uid = rsp.split(MESSAGE_SEPARATOR)[1].decode()
+            payload = encode_json({'uid': self.uid, 'port': self.network_address[1], 'codecs': available_codecs()})
+            rsp = self.pool.request((ip, port), MessageType.ADDME, payload)
+            log(self._start, 'Received message: %s %s', rsp, Preview(rsp.payload), level=DEBUG)
+            if rsp.type == MessageType.ACK:
+                data = rsp.json()
+                uid = data['uid']
+                self.codecs[(ip, port)] = choose_codec([data.get('codec')])
                 peer = Peer(uid, ip, port)
                 self.add_known_peer(peer)
                 return True
-            elif rsp.split(MESSAGE_SEPARATOR)[0] == b'NACK':
-                clsck.close()
+            elif rsp.type == MessageType.NACK:
                 return False
             else:
                 raise Exception('Invalid response.')
         except Exception as e:
-            clsck.close()
             return False
     def broadcast_peer_discovery(self) -> None:
         """
         Broadcasts a peer discovery message to all known peers.
         If a peer responds with ACK, add it to the known peers.
+        All peers are queried concurrently, the fastest first, then every new peer is added
+        concurrently.
         """
-        known_peers = self.known_peers.copy()
-        for peer in known_peers.values():
-            clsck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            clsck.settimeout(LISTENER_TIMEOUT)
-            try:
-                clsck.connect((peer.ip, peer.port))
-                msg = b'BROADCASTREQUEST'
-                clsck.sendall(msg)
-                rsp = b''
-                while True:
-                    data = clsck.recv(NETWORK_BUFFER_SIZE)
-                    rsp += data
-                    if len(data) < NETWORK_BUFFER_SIZE:
-                        break
-                log(self._start, f'Received message: {rsp}')
-                if rsp.split(MESSAGE_SEPARATOR)[0] == b'BROADCASTRESPONSE':
-                    clsck.close()
-                    peer_list = json.loads(rsp.split(MESSAGE_SEPARATOR)[1].decode())
-                    for peer_data in peer_list:
-                        if peer_data[0] not in self.known_peers:
-                            self.manual_peer_add(peer_data[1], peer_data[2])
-            except Exception as e:
-                clsck.close()
-                pass
+        if self._engine is not None:
+            return self._engine.run(self._engine.broadcast_peer_discovery())
+        known_peers = self.rank_peers()
+        query = lambda peer: self.request((peer.ip, peer.port), MessageType.BROADCASTREQUEST)
+        candidates = {}
+        for peer, rsp, error in fan_out(query, known_peers):
+            if error is not None:
+                continue
+            log(self._start, 'Received message: %s %s', rsp, Preview(rsp.payload), level=DEBUG)
+            if rsp.type == MessageType.BROADCASTRESPONSE:
+                for uid, ip, port in rsp.json():
+                    if uid not in self.known_peers and uid != self.uid:
+                        candidates[uid] = (ip, port)
+        for _ in fan_out(lambda address: self.manual_peer_add(*address), list(candidates.values())):
+            pass
+    def iter_files_on_network(self, peers: [Peer] = None):
+        """
+        Requests the file list from the given peers, all known peers by default, concurrently,
+        the fastest first.
+        
+        The request also subscribes to the changes of every peer's list, see handle_subscribe.
+        The lists are kept in the network index between calls, so peers only send the
+        changes since the previous call.
+        
+        Returns:
+        - Generator of (peer uid, file entries) tuples, in the order the peers answer.
+          Each entry is a dict with the name, size and sha256 of a file.
+        """
+        peers = self.rank_peers(peers)
+        query = lambda peer: self.request((peer.ip, peer.port), MessageType.SUBSCRIBE, self.subscribe_request(peer.uid))
+        for peer, rsp, error in fan_out(query, peers):
+            if error is not None:
+                continue
+            log(self._start, 'Received message: %s %s', rsp, Preview(rsp.payload), level=DEBUG)
+            if rsp.type == MessageType.FILELISTRESPONSE:
+                self.netindex.apply(peer.uid, rsp.json(), subscribed=True)
+                yield (peer.uid, self.netindex.replica(peer.uid).entries())
+    def subscribe_request(self, uid: str) -> bytes:
+        """
+        Returns the SUBSCRIBE payload for a peer, asking for the changes since the version
+        of its list in the network index.
+        """
+        request = self.netindex.replica(uid).request()
+        request.update({'uid': self.uid, 'port': self.network_address[1], 'lease': SUBSCRIPTION_LEASE})
+        return encode_json(request)
+    def refresh_network_index(self, max_age: float = SUBSCRIPTION_RENEW) -> None:
+        """
+        Subscribes again to the known peers whose cached list, or subscription, is older
+        than `max_age` seconds, and drops the expired lists and those of peers no longer known.
+        Between refreshes, the lists are kept current by the peers' pushes.
+        """
+        if self._engine is not None:
+            return self._engine.run(self._engine.refresh_network_index(max_age))
+        known_peers = self.known_peers
+        self.netindex.expire(known_peers)
+        stale = [peer for peer in known_peers.values() if self.netindex.needs_refresh(peer.uid, max_age)]
+        for _ in self.iter_files_on_network(stale):
+            pass
     def list_files_on_network(self) -> dict:
         """
-        Requests the file list from all known peers.
+        Returns the file lists of all known peers from the network index, after refreshing
+        the stale ones.
+        
+        Returns:
+        - Dict of peer uid to the peer's file entries, see iter_files_on_network.
+        """
+        self.refresh_network_index()
+        return self.netindex.snapshot()
+    def find_file_on_network(self, filename: str) -> dict:
         """
-        file_list = {}
-        known_peers = self.known_peers.copy()
-        for peer in known_peers.values():
-            clsck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            clsck.settimeout(LISTENER_TIMEOUT)
-            try:
-                clsck.connect((peer.ip, peer.port))
-                msg = b'FILELIST'
-                clsck.sendall(msg)
-                rsp = b''
-                while True:
-                    data = clsck.recv(NETWORK_BUFFER_SIZE)
-                    rsp += data
-                    if len(data) < NETWORK_BUFFER_SIZE:
-                        break
-                log(self._start, f'Received message: {rsp}')
-                if rsp.split(MESSAGE_SEPARATOR)[0] == b'FILELISTRESPONSE':
-                    clsck.close()
-                    peer_uid = rsp.split(MESSAGE_SEPARATOR)[1].decode()
-                    peer_file_list = json.loads(rsp.split(MESSAGE_SEPARATOR)[2].decode())
-                    file_list[peer_uid] = peer_file_list
-            except Exception as e:
-                clsck.close()
-                pass
-        return file_list
-            
+        Looks up the peers holding a file by name in the network index, without any request.
+        
+        If no known peer lists the file and the node joined the DHT, the providers of the
+        file are looked up in the DHT, added to the known peers and their lists fetched.
+        
+        Returns:
+        - Dict of peer uid to its entry for the file.
+        """
+        holders = self.netindex.lookup_name(filename)
+        if len(holders) > 0 or self.dht is None:
+            return holders
+        providers = self.dht.find_providers(f'name:{filename}')
+        for peer in providers:
+            if peer.uid not in self.known_peers:
+                self.add_known_peer(peer)
+        if len(providers) > 0:
+            self.refresh_network_index()
+        return self.netindex.lookup_name(filename)
+    def find_content_on_network(self, sha256: str) -> dict:
+        """
+        Looks up the peers holding a content hash under any name in the network index.
+        
+        Returns:
+        - Dict of peer uid to its entry for the content.
+        """
+        return self.netindex.lookup_hash(sha256)
+    def find_sources(self, filename: str, sha256: str = None) -> (dict, [str]):
+        """
+        Looks up the peers a file can be downloaded from, after refreshing the stale file
+        lists: every peer holding the chosen version of the file, whatever name it gave it.
+        
+        Parameters:
+        - filename: Name of the file.
+        - sha256: Version of the file, by default the one held by the most peers.
+        
+        Returns:
+        - Tuple (entry of the chosen version, with its name, size and sha256, or None if no
+          peer holds it; uids of the holders, best ranked first, see rank_peers).
+        """
+        self.refresh_network_index()
+        versions = {}
+        for peeruid, entry in self.find_file_on_network(filename).items():
+            versions.setdefault(entry['sha256'], {})[peeruid] = entry
+        if sha256 is None and len(versions) > 0:
+            sha256 = max(versions, key=lambda h: len(versions[h]))
+        holders = dict(versions.get(sha256, {}))
+        if sha256 is not None:
+            for peeruid, entry in self.find_content_on_network(sha256).items():
+                holders.setdefault(peeruid, entry)
+        known_peers = self.known_peers
+        peers = [known_peers[uid] for uid in holders if uid in known_peers]
+        if len(peers) == 0:
+            return (None, [])
+        entry = next(iter(holders.values()))
+        return (entry, [peer.uid for peer in self.rank_peers(peers, entry['size'])])
+    def provider_keys(self) -> set:
+        """
+        Returns the DHT keys this node provides: the name and content hash of every shared file.
+        The set is rebuilt only when the file index changed.
+        """
+        index = self.index
+        version = (index.epoch, index.version)
+        if self._provider_keys[0] != version:
+            keys = set()
+            for entry in index.describe():
+                keys.add(f'name:{entry["name"]}')
+                if entry['sha256'] is not None:
+                    keys.add(f'hash:{entry["sha256"]}')
+            self._provider_keys = (version, keys)
+        return self._provider_keys[1]
     def _fileupdate(self) -> None:
         """
         File Update thread.
@@ -441,70 +1054,366 @@ class Application:
         """
         Peer Update thread.
         
-        Updates the known peers list periodically.
+        Runs one membership protocol period, then updates the network index.
         """
         while self._peerupdate_enabled == True:
-            self.update_peer_list()
+            self.membership.tick()
+            self.refresh_network_index()
+            self.pool.close_idle()
+            self.write_metrics()
             time.sleep(PEERUPDATE_TIMEOUT)
     def update_peer_list(self) -> None:
         """
-        When called, it will remove all invalid peers from the known peers list.
-        It sends a HELLO message to all known peers and removes the ones that do not respond.
+        When called, it checks every known peer at once, instead of waiting for the membership
+        layer to probe them in turn.
+        It sends a HELLO message to all known peers and suspects the ones that do not respond;
+        they are removed if they do not refute the suspicion in time, see membership.py.
+        The peers are contacted concurrently, so the sweep takes about as long as the slowest
+        peer. Peers that were not reached before the fan-out deadline are left alone.
         """
-        new_peers = {}
-        self._knownpeers_lock.acquire()
-        for peer in self.known_peers.values():
-            if validate_address(peer.ip, peer.port) == True:
-                new_peers[peer.uid] = peer
-        self.known_peers = new_peers
-        self._knownpeers_lock.release()
+        if self._engine is not None:
+            return self._engine.run(self._engine.update_peer_list())
+        known_peers = list(self.known_peers.values())
+        for peer, alive, error in fan_out(lambda peer: self.ping(peer.ip, peer.port), known_peers):
+            if alive != True:
+                self.membership.suspect(peer.uid)
+    def ping(self, ip: str, port: int) -> bool:
+        """
+        Sends HELLO over the connection pool.
+        
+        Returns:
+        - True if the peer answered HELLOBACK.
+        """
+        try:
+            return self.pool.request((ip, port), MessageType.HELLO).type == MessageType.HELLOBACK
+        except Exception:
+            return False
+    def set_upload_limits(self, slots: int, rate: int = None, peer_rate: int = None) -> None:
+        """
+        Changes the upload limits while the node runs, see throttle.py.
+        
+        Parameters:
+        - slots: Number of files sent at once.
+        - rate: Upload bandwidth limit in bytes per second, None for unlimited.
+        - peer_rate: Upload bandwidth limit per peer in bytes per second, None for unlimited.
+        """
+        self.uploads.set_limits(slots, UPLOAD_QUEUE, rate, peer_rate)
+        log(self._start, 'Upload limits: %s', self.uploads.limits())
+    def codec_for(self, address: (str, int)) -> str:
+        """
+        Returns the compression codec negotiated with the peer at `address`.
+        
+        Peers added with ADDME negotiate it in the handshake; for the others, learned
+        through gossip or the DHT, it is negotiated with a HELLO on first use.
+        
+        Returns:
+        - Codec name, or None if the exchanges with the peer are not compressed.
+        """
+        address = tuple(address)
+        if address not in self.codecs:
+            try:
+                rsp = self.pool.request(address, MessageType.HELLO, encode_json({'codecs': available_codecs()}))
+            except Exception:
+                return None
+            self.codecs[address] = choose_codec([rsp.json().get('codec')]) if rsp.payload else None
+        return self.codecs[address]
+    def request(self, address: (str, int), msg_type: MessageType, payload: bytes = b'', timeout: float = None) -> Message:
+        """
+        Sends a request over the connection pool, compressing it and accepting a compressed
+        response with the codec negotiated with the peer.
+        """
+        codec = self.codec_for(address)
+        payload, flags = compress_payload(payload, accept_flags(codec), codec)
+        return self.pool.request(address, msg_type, payload, timeout, flags)
+    def request_stats(self, peeruid: str) -> dict:
+        """
+        Requests the metrics of a known peer.
+        
+        Returns:
+        - Dict in the format of Metrics.snapshot().
+        """
+        peer = self.get_known_peer(peeruid)
+        rsp = self.request((peer.ip, peer.port), MessageType.STATS)
+        if rsp.type != MessageType.STATSRESPONSE:
+            raise Exception('Invalid response.')
+        return rsp.json()
+    def write_metrics(self) -> None:
+        """
+        Writes the metrics to metrics_file, if set.
+        """
+        if self.metrics_file is None:
+            return
+        try:
+            self.metrics.write_prometheus(self.metrics_file)
+        except OSError as e:
+            log(self._start, 'Could not write metrics to %s: %s', self.metrics_file, e, level=WARNING)
     def update_file_list(self) -> None:
         """
         When called, updates the file list.
+        
+        Only the files reported as changed by the directory watcher are looked at. The
+        `files` dict is replaced, never modified, so readers can iterate it without the lock.
+        Changes to the index are pushed to the subscribed peers.
         """
         self._fileupdate_lock.acquire()
-        self.files = get_files(self)
+        changes = self._watcher.poll()
+        changed = len(changes) > 0
+        if self.index.update(changes):
+            self.publisher.notify()
+        if changed:
+            self.files = dict(self._watcher.files)
         self._fileupdate_lock.release()
     def set_file_dir(self, path: str) -> None:
         """
         When called, sets the file directory and updates the file list.
         """
         self._fileupdate_lock.acquire()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if self._watcher is not None:
+            self._watcher.close()
         self.file_dir = path
-        self.files = get_files(self)
+        self._watcher = create_watcher(path)
+        self.index = FileIndex(path)
+        self.index.update(self._watcher.poll())
+        self.publisher.notify()
+        self.files = dict(self._watcher.files)
         self._fileupdate_lock.release()
-    def receive_file_from_network(self, peeruid: str, filename: str) -> None:
+    def receive_file_from_network(self, peeruid: str, filename: str, retries: int = DOWNLOAD_RETRIES, sha256: str = None, delta_sync: bool = False) -> TransferResult:
         """
         When called, receives a file from a peer.
+        
+        The file is streamed into a hidden part file in the file directory, with a sidecar
+        recording the byte ranges already received. A dropped connection is retried up to
+        `retries` times, each retry requesting only the missing ranges; an interrupted
+        download also resumes from the sidecar the next time it is requested. The part file
+        is atomically renamed to its final name once complete, so an interrupted transfer
+        never leaves a half-written file behind.
+        
+        When a content hash is given and its holders advertise the Merkle root of its piece
+        hashes, see advertised_root, the piece hashes are requested first, and every piece is
+        checked once on disk, including those of a resumed download. Corrupt pieces count as a
+        failed attempt and only they are requested again.
+        
+        With `delta_sync`, an older copy of the file in the file directory is updated in
+        place with only the changes, see delta.py, falling back to a full transfer if the
+        delta fails. It is off by default, so an existing copy is replaced by a download of
+        the whole file.
+        
+        Parameters:
+        - peeruid: ID of the peer holding the file.
+        - filename: Name of the file to be received.
+        - retries: Number of times a failed connection is retried.
+        - sha256: Expected content hash. When given, the file is requested by hash and
+          verified before it is moved to its final name.
+        - delta_sync: Updates an older local copy with a delta instead.
+        
+        Returns:
+        - TransferResult with the size, duration and throughput of the transfer.
+        Raises an exception if the transfer fails.
         """
+        if os.path.basename(filename) != filename or filename.startswith('.'):
+            raise TransferError('Invalid file name.')
         peer = self.get_known_peer(peeruid)
-        clsck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        clsck.settimeout(LISTENER_TIMEOUT)
+        if delta_sync:
+            result = self._receive_delta(peer, filename, sha256)
+            if result is not None:
+                return result
+        partial = PartialDownload(self.file_dir, filename)
+        tree = self._request_piece_tree(peer, filename, sha256)
+        if tree is not None:
+            partial.prepare(tree.size)
+        start = time.time()
+        received = 0
+        attempt = 0
+        while True:
+            try:
+                if tree is not None:
+                    # Pieces left unverified by an interrupted attempt or an earlier run.
+                    partial.verify_pieces(tree)
+                received += self._receive_missing_ranges(peer, partial, sha256, tree)
+                break
+            except TransferError:
+                raise
+            except OSError as e:
+                attempt += 1
+                log(self._start, 'Transfer of %s from %s interrupted (%s), %s bytes on disk.', filename, peer, e, partial.covered(), level=WARNING)
+                if attempt > retries:
+                    raise
+                if isinstance(e, PeerBusyError):
+                    # All of the peer's upload slots are taken, give them time to free up.
+                    time.sleep(BUSY_RETRY_DELAY * 2 ** (attempt - 1))
+        partial.finish(sha256)
+        result = TransferResult(filename, peeruid, partial.size, time.time() - start, received)
+        log(self._start, 'Received file: %s', result)
+        return result
+    def swarm_receive_file_from_network(self, peeruids: [str], filename: str, sha256: str = None, delta_sync: bool = False, progress=None) -> TransferResult:
+        """
+        When called, receives a file from every given peer in parallel.
+        
+        Each peer serves different pieces of the file, faster peers serve more of them,
+        and the file is assembled once. Progress is kept in the same part file and sidecar
+        as receive_file_from_network, so either method can resume the other's download.
+        With `delta_sync`, an older local copy is updated with a delta from the best ranked
+        peer instead, like in receive_file_from_network. The peers are ranked by the time they are expected to
+        take for a piece, see rank_peers.
+        
+        Parameters:
+        - peeruids: IDs of the peers holding the file.
+        - filename: Name of the file to be received.
+        - sha256: Expected content hash, see receive_file_from_network.
+        - delta_sync: Updates an older local copy with a delta instead.
+        - progress: Callable given the number of bytes of every piece written.
+        
+        Returns:
+        - TransferResult for the whole file. Raises an exception if the transfer fails.
+        """
+        if os.path.basename(filename) != filename or filename.startswith('.'):
+            raise TransferError('Invalid file name.')
+        peers = self.rank_peers([self.get_known_peer(uid) for uid in peeruids], PIECE_SIZE)
+        if delta_sync and peers:
+            # A delta is small, one peer serves it.
+            result = self._receive_delta(peers[0], filename, sha256)
+            if result is not None:
+                return result
+        downloader = SwarmDownloader(self.file_dir, filename, peers, LISTENER_TIMEOUT, log=lambda msg: log(self._start, msg), sha256=sha256, root=self.advertised_root(sha256), codec_for=lambda peer: self.codec_for((peer.ip, peer.port)), metrics=self.metrics, stats=self.peer_stats, progress=progress)
+        result = downloader.run()
+        log(self._start, 'Received file: %s', result)
+        return result
+    def receive_files_from_network(self, peeruid: str, names: [str]) -> BatchResult:
+        """
+        When called, receives many files from a peer over a single connection.
+        
+        Each file is written as soon as it arrives, to a hidden file renamed once complete
+        and verified against its hash, see request_batch. Meant for many small files, which
+        would each pay a connection and a round trip with receive_file_from_network.
+        
+        Parameters:
+        - peeruid: ID of the peer to receive the files from.
+        - names: File names or glob patterns, like `*.txt`.
+        
+        Returns:
+        - BatchResult with the files received, the corrupt ones and the names that matched
+          no file. Raises an exception if the transfer fails; the files already received
+          are kept.
+        """
+        peer = self.get_known_peer(peeruid)
+        codec = self.codec_for((peer.ip, peer.port))
+        start = time.time()
+        with Connection.open((peer.ip, peer.port), LISTENER_TIMEOUT) as conn:
+            files, failed, missing, size = request_batch(conn, self.file_dir, names, codec)
+        self.metrics.add_transfer(f'{peer.ip}:{peer.port}', received=size)
+        self.peer_stats.record_transfer((peer.ip, peer.port), size, time.time() - start)
+        result = BatchResult(peeruid, files, failed, missing, size, time.time() - start)
+        log(self._start, 'Received batch from %s: %s', peer, result)
+        return result
+    def _receive_delta(self, peer: Peer, filename: str, sha256: str = None) -> TransferResult:
+        """
+        Updates the local copy of a file from a peer with a delta, see request_delta.
+        
+        Returns:
+        - TransferResult, or None if there is no local copy of at least DELTA_MIN_SIZE or
+          the delta failed, in which case the file should be transferred whole.
+        """
+        path = os.path.join(self.file_dir, filename)
         try:
-            clsck.connect((peer.ip, peer.port))
-            msg = b'FILEGET' + MESSAGE_SEPARATOR + filename.encode()
-            clsck.sendall(msg)
-            rsp = b''
-            while True:
-                data = clsck.recv(NETWORK_BUFFER_SIZE)
-                rsp += data
-                if len(data) < NETWORK_BUFFER_SIZE:
-                    break
-            log(self._start, f'Received message: len({rsp}), {rsp[:16]}...')
-            if rsp.split(MESSAGE_SEPARATOR)[0] == b'FILEGETRESPONSE':
-                if rsp.split(MESSAGE_SEPARATOR)[1] == b'OK':
-                    filedata = rsp.split(MESSAGE_SEPARATOR)[2]
-                    with open(os.path.join(self.file_dir, filename), 'wb') as f:
-                        f.write(b64decode(filedata))
-                elif rsp.split(MESSAGE_SEPARATOR)[1] == b'NOK':
-                    raise Exception('File not found.')
-                else:
-                    raise Exception('Invalid response.')
-            else:
-                raise Exception('Invalid response.')
+            if os.path.getsize(path) < DELTA_MIN_SIZE:
+                return None
+        except OSError:
+            return None
+        start = time.time()
+        codec = self.codec_for((peer.ip, peer.port))
+        try:
+            with Connection.open((peer.ip, peer.port), LISTENER_TIMEOUT) as conn:
+                size, received = request_delta(conn, path, filename, sha256, codec)
         except Exception as e:
-            clsck.close()
-            pass
+            log(self._start, 'Delta of %s from %s failed (%s), transferring it whole.', filename, peer, e, level=WARNING)
+            return None
+        # Progress of an earlier full transfer is obsolete.
+        PartialDownload(self.file_dir, filename).discard()
+        self.metrics.add_transfer(f'{peer.ip}:{peer.port}', received=received)
+        result = TransferResult(filename, peer.uid, size, time.time() - start, received, delta=True)
+        log(self._start, 'Received file by delta: %s', result)
+        return result
+    def advertised_root(self, sha256: str) -> str:
+        """
+        Returns the Merkle root of the piece hashes advertised with a content hash in the
+        file lists, see merkle.py.
+        
+        The root comes from the same entries as the hash, and is only trusted if every
+        holder advertising one agrees on it, so a single peer cannot make the others' pieces
+        look corrupt. Without it, a download is only verified as a whole.
+        
+        Returns:
+        - Hex root, or None if the hash is not given, not advertised with a root, or
+          advertised with different roots.
+        """
+        if sha256 is None:
+            return None
+        roots = {entry.get('root') for entry in self.find_content_on_network(sha256).values()}
+        roots.discard(None)
+        return roots.pop() if len(roots) == 1 else None
+    def _request_piece_tree(self, peer: Peer, filename: str, sha256: str = None):
+        """
+        Requests the piece hashes of a file from a peer, see advertised_root.
+        
+        Returns:
+        - PieceTree, or None if no root is advertised for the content hash or the peer
+          could not provide matching hashes, in which case the download is only verified as
+          a whole, when its hash is known.
+        """
+        root = self.advertised_root(sha256)
+        if root is None:
+            return None
+        codec = self.codec_for((peer.ip, peer.port))
+        try:
+            with Connection.open((peer.ip, peer.port), LISTENER_TIMEOUT) as conn:
+                return request_piece_tree(conn, filename, root, sha256, codec)
+        except (OSError, TransferError) as e:
+            log(self._start, 'No piece hashes for %s from %s (%s), pieces will not be verified.', filename, peer, e, level=WARNING)
+            return None
+    def _receive_missing_ranges(self, peer: Peer, partial: PartialDownload, sha256: str = None, tree=None) -> int:
+        """
+        Requests every range of the file that is not on disk yet, verifying the pieces of
+        each range against `tree` when given.
+        
+        Returns:
+        - Number of bytes received.
+        """
+        received = 0
+        if partial.size is None:
+            gaps = [(0, None)]
+        else:
+            gaps = partial.missing()
+        for gap_start, gap_end in gaps:
+            length = None if gap_end is None else gap_end - gap_start
+            codec = self.codec_for((peer.ip, peer.port))
+            started = time.time()
+            try:
+                with Connection.open((peer.ip, peer.port), LISTENER_TIMEOUT) as conn:
+                    offset, size, count, stream = request_range(conn, partial.filename, gap_start, length, sha256, codec)
+                    log(self._start, 'Receiving %s [%s, %s) of %s bytes.', partial.filename, offset, offset + count, size, level=DEBUG)
+                    if tree is not None and size != tree.size:
+                        raise TransferError(f'{partial.filename} changed on the peer during the download.')
+                    if partial.size != size:
+                        partial.prepare(size)
+                        if gap_end is not None:
+                            # The file changed on the peer, previous progress was discarded.
+                            raise OSError('File size changed on the peer.')
+                    n = partial.receive(stream, offset, count)
+            except OSError:
+                self.peer_stats.record_transfer((peer.ip, peer.port), 0, time.time() - started, ok=False)
+                raise
+            received += n
+            self.metrics.add_transfer(f'{peer.ip}:{peer.port}', received=n)
+            self.peer_stats.record_transfer((peer.ip, peer.port), n, time.time() - started)
+            if tree is not None:
+                bad = partial.verify_pieces(tree)
+                if bad:
+                    log(self._start, '%s corrupt pieces of %s from %s, requesting them again.', len(bad), partial.filename, peer, level=WARNING)
+        if partial.missing():
+            raise OSError('Incomplete transfer.')
+        return received
     def menuloop(self) -> None:
         """
         Function to handle the menu loop.
@@ -524,6 +1433,8 @@ class Application:
                     state = MenuState.FILEMANAGEMENT
                 elif option == 3:
                     state = MenuState.SYSTEMINFO
+                elif option == 4:
+                    state = MenuState.UPLOADLIMITS
             elif state == MenuState.PEERMANAGEMENT:
                 option = Menu.menu_peermanagement(self)
                 if option == 0:
@@ -548,6 +1459,8 @@ class Application:
                     state = MenuState.FILESEARCH
                 elif option == 4:
                     state = MenuState.FILESETDIR
+                elif option == 5:
+                    state = MenuState.DOWNLOADS
             elif state == MenuState.PEERLIST:
                 option = Menu.menu_listpeers(self)
                 if option == 0:
@@ -596,5 +1509,13 @@ class Application:
                 option = Menu.menu_listremotefiles(self)
                 if option == 0:
                     state = MenuState.FILEMANAGEMENT
+            elif state == MenuState.UPLOADLIMITS:
+                option = Menu.menu_uploadlimits(self)
+                if option == 0:
+                    state = MenuState.MAIN
+            elif state == MenuState.DOWNLOADS:
+                option = Menu.menu_downloads(self)
+                if option == 0:
+                    state = MenuState.FILEMANAGEMENT
             else:
                 raise Exception('Invalid MenuState')
\ No newline at end of file
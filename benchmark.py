@@ -0,0 +1,234 @@
+"""
+Loopback benchmarks of a network of nodes.
+
+Starts N headless Application nodes on 127.0.0.1, each with its own file directory under a
+temporary root and its own port from get_network_port, connects them in a topology and
+measures:
+
+- fileget: FILEGET throughput between two nodes, per file size.
+- discovery: broadcast_peer_discovery, list_files_on_network and a full file list query
+  (iter_files_on_network) latency, per number of nodes.
+- sweep: update_peer_list time with some of the peers killed.
+- listener: HELLO requests per second and their latency, with concurrent clients each
+  on its own connection.
+
+Results are written as JSON, every measurement with its percentiles, so that runs can be
+compared over time.
+
+Usage:
+```
+python benchmark.py --nodes 2,4,8 --sizes 1,16,64 --out results.json
+```
+"""
+
+from app import Application, ENGINES
+from peer import Peer
+from protocol import Connection, MessageType
+import logger
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+
+TOPOLOGIES = ('full', 'star', 'ring')
+DEFAULT_NODES = (2, 4, 8)
+DEFAULT_SIZES = (1, 16, 64)
+DEFAULT_REPEATS = 5
+DEFAULT_CLIENTS = 8
+LISTENER_REQUESTS = 500
+SWEEP_NODES = 8
+SWEEP_KILLED = 2
+
+def percentiles(samples: [float]) -> dict:
+    """
+    Returns the count, mean, min, max and p50, p90 and p99 of the samples, nearest-rank.
+    """
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    rank = lambda q: ordered[min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.5) - 1))]
+    return {
+        'count': len(ordered), 'mean': sum(ordered) / len(ordered), 'min': ordered[0],
+        'p50': rank(0.5), 'p90': rank(0.9), 'p99': rank(0.99), 'max': ordered[-1],
+    }
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+class Cluster:
+    """
+    N nodes on loopback, each knowing the others according to the topology.
+
+    Usage:
+    ```
+    with Cluster(4, root, topology='star') as cluster:
+        cluster.nodes[1].broadcast_peer_discovery()
+        cluster.kill(3)
+    ```
+    """
+    def __init__(self, n: int, root: str, engine: str = 'threaded', topology: str = 'full') -> None:
+        if topology not in TOPOLOGIES:
+            raise Exception(f'Unknown topology {topology}.')
+        self.root = root
+        self.nodes = []
+        self.alive = []
+        try:
+            for i in range(n):
+                self.nodes.append(Application(engine=engine, file_dir=os.path.join(root, f'node{i}', '')))
+                self.alive.append(True)
+        except:
+            self.stop()
+            raise
+        for i, node in enumerate(self.nodes):
+            for j in self.neighbours(i, topology):
+                node.add_known_peer(self.peer(j))
+    def neighbours(self, i: int, topology: str) -> [int]:
+        n = len(self.nodes)
+        if topology == 'full':
+            return [j for j in range(n) if j != i]
+        if topology == 'star':
+            return [0] if i != 0 else list(range(1, n))
+        return [(i + 1) % n] if n > 1 else []
+    def peer(self, i: int) -> Peer:
+        node = self.nodes[i]
+        return Peer(node.uid, '127.0.0.1', node.network_address[1])
+    def add_file(self, i: int, name: str, size: int) -> None:
+        """
+        Writes a file of random, incompressible bytes to a node and indexes it.
+        """
+        node = self.nodes[i]
+        with open(os.path.join(node.file_dir, name), 'wb') as f:
+            for _ in range(0, size, 1024 * 1024):
+                f.write(os.urandom(min(1024 * 1024, size)))
+            f.truncate(size)
+        node.update_file_list()
+    def kill(self, i: int) -> None:
+        if self.alive[i]:
+            self.alive[i] = False
+            self.nodes[i].stop()
+    def stop(self) -> None:
+        for i in range(len(self.nodes)):
+            self.kill(i)
+    def __enter__(self) -> 'Cluster':
+        return self
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+def bench_fileget(root: str, engine: str, sizes: [int], repeats: int) -> list:
+    results = []
+    with Cluster(2, root, engine) as cluster:
+        server, client = cluster.nodes
+        for size in sizes:
+            name = f'bench-{size}.bin'
+            cluster.add_file(0, name, size)
+            seconds = []
+            for _ in range(repeats):
+                seconds.append(timed(lambda: client.receive_file_from_network(server.uid, name)))
+                os.remove(os.path.join(client.file_dir, name))
+            results.append({
+                'size': size, 'seconds': percentiles(seconds),
+                'mib_per_second': percentiles([size / s / 1024 / 1024 for s in seconds]),
+            })
+    return results
+
+def bench_discovery(root: str, engine: str, node_counts: [int], repeats: int, topology: str) -> list:
+    results = []
+    for n in node_counts:
+        with Cluster(n, os.path.join(root, f'discovery{n}'), engine, topology) as cluster:
+            for i in range(n):
+                cluster.add_file(i, f'node{i}.bin', 1024)
+            node = cluster.nodes[-1]
+            broadcast = [timed(node.broadcast_peer_discovery) for _ in range(repeats)]
+            listing = [timed(node.list_files_on_network) for _ in range(repeats)]
+            query = [timed(lambda: list(node.iter_files_on_network())) for _ in range(repeats)]
+            results.append({
+                'nodes': n, 'topology': topology, 'known_peers': len(node.known_peers),
+                'broadcast_peer_discovery': percentiles(broadcast),
+                'list_files_on_network': percentiles(listing),
+                'iter_files_on_network': percentiles(query),
+            })
+    return results
+
+def bench_sweep(root: str, engine: str, n: int, killed: int, repeats: int) -> dict:
+    with Cluster(n, root, engine) as cluster:
+        node = cluster.nodes[0]
+        alive = [timed(node.update_peer_list) for _ in range(repeats)]
+        for i in range(n - killed, n):
+            cluster.kill(i)
+        # Measured right away, before the membership layer notices the killed peers.
+        dead = [timed(node.update_peer_list) for _ in range(repeats)]
+    return {'nodes': n, 'killed': killed, 'all_alive': percentiles(alive), 'with_killed': percentiles(dead)}
+
+def bench_listener(root: str, engine: str, clients: int, requests: int) -> dict:
+    with Cluster(1, root, engine) as cluster:
+        address = ('127.0.0.1', cluster.nodes[0].network_address[1])
+        latencies = [[] for _ in range(clients)]
+        errors = [0] * clients
+        def client(i: int) -> None:
+            with Connection.open(address, 5.0) as conn:
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    try:
+                        conn.send(MessageType.HELLO)
+                        conn.recv()
+                    except OSError:
+                        errors[i] += 1
+                        continue
+                    latencies[i].append(time.perf_counter() - start)
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    samples = [s for ls in latencies for s in ls]
+    return {
+        'clients': clients, 'requests': clients * requests, 'errors': sum(errors),
+        'requests_per_second': len(samples) / elapsed, 'latency': percentiles(samples),
+    }
+
+def run(engine: str, node_counts: [int], sizes: [int], repeats: int, clients: int, topology: str, root: str) -> dict:
+    """
+    Runs every benchmark and returns the results, with the parameters of the run.
+    """
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'engine': engine, 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'repeats': repeats, 'topology': topology,
+        },
+    }
+    results['fileget'] = bench_fileget(os.path.join(root, 'fileget'), engine, sizes, repeats)
+    results['discovery'] = bench_discovery(os.path.join(root, 'discovery'), engine, node_counts, repeats, topology)
+    results['sweep'] = bench_sweep(os.path.join(root, 'sweep'), engine, max(SWEEP_NODES, SWEEP_KILLED + 1), SWEEP_KILLED, repeats)
+    results['listener'] = bench_listener(os.path.join(root, 'listener'), engine, clients, LISTENER_REQUESTS)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loopback benchmarks of a network of nodes.')
+    parser.add_argument('--engine', choices=ENGINES, default='threaded', help='networking engine')
+    parser.add_argument('--nodes', default=','.join(map(str, DEFAULT_NODES)), help='comma-separated numbers of nodes for the discovery benchmark')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help='comma-separated file sizes in MiB for the FILEGET benchmark')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help='samples per measurement')
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS, help='concurrent clients for the listener benchmark')
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='full', help='known peers of each node in the discovery benchmark')
+    parser.add_argument('--out', default='benchmark.json', help='file the JSON results are written to')
+    args = parser.parse_args()
+    logger.set_level(logger.WARNING)
+    root = tempfile.mkdtemp(prefix='p2p-bench-')
+    try:
+        results = run(
+            args.engine, [int(n) for n in args.nodes.split(',')], [int(float(s) * 1024 * 1024) for s in args.sizes.split(',')],
+            args.repeats, args.clients, args.topology, root,
+        )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.out}.')
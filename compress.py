@@ -0,0 +1,192 @@
+"""
+Compression codecs negotiated between peers.
+
+Peers tell each other the codecs they support in the HELLO and ADDME handshakes, and the
+first codec of the answering peer's PREFERENCE order that both support is used: zstd when
+the optional `zstandard` package is installed, otherwise the stdlib zlib, bz2 or lzma.
+
+A requester announces the negotiated codec in the flags of each request. Large JSON
+payloads are then compressed as a whole, and file ranges are streamed through a single
+compressor per response. Content that is already compressed, like media or archives, is
+detected by compressing a few samples of the file with fast zlib, and is sent raw with
+sendfile instead, so no CPU is spent on it. The decision is cached per file version.
+
+Decompression is bounded: a decompressor is given the most bytes its payload may expand to
+and raises ValueError past it, having never produced more, so a small malicious payload
+cannot expand into gigabytes.
+"""
+
+import bz2
+import collections
+import lzma
+import os
+import threading
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_IDS = {'zlib': 1, 'bz2': 2, 'lzma': 3, 'zstd': 4}
+PREFERENCE = ('zstd', 'zlib', 'bz2', 'lzma')
+COMPRESS_MIN_SIZE = 1024
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+SAMPLE_SIZE = 16 * 1024
+SAMPLE_COUNT = 4
+COMPRESSIBLE_RATIO = 0.9
+SAMPLE_CACHE_SIZE = 4096
+
+def available_codecs() -> list:
+    """
+    Returns the names of the codecs this node supports, in order of preference.
+    """
+    return [name for name in PREFERENCE if name != 'zstd' or zstandard is not None]
+
+def choose_codec(offered) -> str:
+    """
+    Returns our most preferred codec among those offered by the peer, or None.
+    """
+    for name in available_codecs():
+        if name in offered:
+            return name
+    return None
+
+def codec_id(name: str) -> int:
+    return CODEC_IDS[name] if name is not None else 0
+
+def codec_name(id: int) -> str:
+    """
+    Returns the name of a codec by its wire ID, None for 0. Raises ValueError for codecs
+    this node does not support.
+    """
+    if id == 0:
+        return None
+    for name in available_codecs():
+        if CODEC_IDS[name] == id:
+            return name
+    raise ValueError(f'Unsupported codec {id}.')
+
+def compressor(name: str):
+    """
+    Returns a streaming compressor, with the compress() and flush() methods of zlib's.
+    """
+    if name == 'zlib':
+        return zlib.compressobj(ZLIB_LEVEL)
+    if name == 'bz2':
+        return bz2.BZ2Compressor()
+    if name == 'lzma':
+        return lzma.LZMACompressor()
+    if name == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError(f'Unsupported codec {name}.')
+
+class _LimitedSink:
+    """
+    Collects the output of a zstd stream writer, refusing anything past `limit` bytes.
+    """
+    def __init__(self) -> None:
+        self.limit = 0
+        self.chunks = []
+        self.size = 0
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self.size > self.limit:
+            raise ValueError(f'Decompressed data exceeds {self.limit} bytes.')
+        self.chunks.append(bytes(data))
+        return len(data)
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+class Decompressor:
+    """
+    Streaming decompressor whose total output is capped at `max_length` bytes.
+
+    Usage:
+    ```
+    d = Decompressor('zlib', length)
+    data = d.decompress(chunk)
+    ```
+    """
+    def __init__(self, name: str, max_length: int) -> None:
+        self.max_length = max_length
+        self.total = 0
+        self._sink = None
+        if name == 'zlib':
+            self._d = zlib.decompressobj()
+        elif name == 'bz2':
+            self._d = bz2.BZ2Decompressor()
+        elif name == 'lzma':
+            self._d = lzma.LZMADecompressor()
+        elif name == 'zstd' and zstandard is not None:
+            # zstd decompression objects take no output limit, a stream writer is given a
+            # sink that refuses the output past it instead.
+            self._sink = _LimitedSink()
+            self._d = zstandard.ZstdDecompressor().stream_writer(self._sink, closefd=False)
+        else:
+            raise ValueError(f'Unsupported codec {name}.')
+    def decompress(self, data) -> bytes:
+        """
+        Returns the output of `data`. Raises ValueError if the total output would exceed
+        max_length.
+        """
+        remaining = self.max_length - self.total
+        if self._sink is not None:
+            self._sink.limit = remaining
+            self._d.write(data)
+            out = self._sink.take()
+        else:
+            out = self._d.decompress(data, remaining + 1)
+        if len(out) > remaining:
+            raise ValueError(f'Decompressed data exceeds {self.max_length} bytes.')
+        self.total += len(out)
+        return out
+
+def decompressor(name: str, max_length: int) -> Decompressor:
+    """
+    Returns a streaming decompressor whose output is capped at `max_length` bytes.
+    """
+    return Decompressor(name, max_length)
+
+def compress(name: str, data: bytes) -> bytes:
+    c = compressor(name)
+    return c.compress(data) + c.flush()
+
+def decompress(name: str, data: bytes, max_length: int) -> bytes:
+    """
+    Decompresses a whole payload. Raises ValueError if it expands past `max_length` bytes.
+    """
+    return decompressor(name, max_length).decompress(data)
+
+_sample_cache = collections.OrderedDict()
+_sample_lock = threading.Lock()
+
+def is_compressible(f) -> bool:
+    """
+    Tells whether an open file is worth compressing, by compressing SAMPLE_COUNT samples
+    spread over it with fast zlib. The result is cached until the file changes.
+    """
+    st = os.fstat(f.fileno())
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    with _sample_lock:
+        if key in _sample_cache:
+            _sample_cache.move_to_end(key)
+            return _sample_cache[key]
+    step = max(0, st.st_size - SAMPLE_SIZE) // max(1, SAMPLE_COUNT - 1)
+    raw = 0
+    packed = 0
+    for i in range(SAMPLE_COUNT):
+        sample = os.pread(f.fileno(), SAMPLE_SIZE, i * step)
+        raw += len(sample)
+        packed += len(zlib.compress(sample, 1))
+        if step == 0:
+            break
+    result = raw > 0 and packed < raw * COMPRESSIBLE_RATIO
+    with _sample_lock:
+        _sample_cache[key] = result
+        if len(_sample_cache) > SAMPLE_CACHE_SIZE:
+            _sample_cache.popitem(last=False)
+    return result
@@ -0,0 +1,243 @@
+"""
+Persistent, multiplexed connections to other peers.
+
+Small RPCs (HELLO, ADDME, FILELIST, ...) go over long-lived connections kept per peer
+instead of paying a TCP connect and close each time. Every request is tagged with a
+request id; a reader thread per connection hands each response to the caller waiting for
+that id, so several requests can be in flight on one connection and complete out of order.
+Bulk transfers keep using dedicated connections so they never block small RPCs.
+
+A request is sent again over another connection only if it was never written, or if
+handling it twice is harmless (IDEMPOTENT_MESSAGES): an ADDME, STORE or SUBSCRIBE whose
+connection broke after it was sent may have been handled already.
+"""
+
+from protocol import HEADER, Connection, Message, MessageType, PeerBusyError, RemoteError, check_reply
+from peerstats import PeerStats
+import itertools
+import selectors
+import socket
+import threading
+import time
+
+CONNECTION_IDLE_TIMEOUT = 30.0
+CONNECTIONS_PER_PEER = 2
+MAX_IN_FLIGHT_PER_CONNECTION = 16
+IDEMPOTENT_MESSAGES = (
+    MessageType.HELLO, MessageType.FILELIST, MessageType.PING, MessageType.PINGREQ,
+    MessageType.DHT_FIND_NODE, MessageType.DHT_FIND_VALUE, MessageType.PIECEHASHES, MessageType.STATS,
+)
+
+class RequestNotSent(ConnectionError):
+    """
+    The connection failed before the request was written whole, so the peer never handled it.
+    """
+    pass
+
+def can_retry(msg_type: MessageType, error: Exception) -> bool:
+    """
+    Tells whether a request that failed with `error` may be sent again on another connection.
+    """
+    if isinstance(error, PeerBusyError) or not isinstance(error, ConnectionError):
+        return False
+    return isinstance(error, RequestNotSent) or msg_type in IDEMPOTENT_MESSAGES
+
+class PendingReply:
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.message = None
+        self.error = None
+
+class PooledConnection:
+    """
+    A long-lived connection to one peer with request/response multiplexing.
+    """
+    def __init__(self, address: (str, int), timeout: float) -> None:
+        self.address = address
+        # The socket keeps its timeout, so a send to a stalled peer fails instead of blocking.
+        self.conn = Connection.open(address, timeout)
+        self.closed = False
+        self.last_used = time.time()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._reader = threading.Thread(target=self._read_loop, name=f'pool-reader-{address[1]}', daemon=True)
+        self._reader.start()
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+    def call(self, msg_type: MessageType, payload: bytes, timeout: float, flags: int = 0) -> Message:
+        """
+        Sends a request and waits for the response with the same request id.
+        """
+        pending = PendingReply()
+        with self._lock:
+            if self.closed:
+                raise RequestNotSent('Connection closed.')
+            request_id = next(self._ids) % 0xFFFFFFFF + 1
+            self._pending[request_id] = pending
+        self.last_used = time.time()
+        try:
+            try:
+                with self.conn.send_lock:
+                    self.conn.send(msg_type, payload, flags, request_id)
+            except OSError as e:
+                # Part of the request may be written, the stream cannot be recovered.
+                self.close()
+                raise RequestNotSent(f'Request not sent: {e}') from e
+            if not pending.event.wait(timeout):
+                raise socket.timeout('Timed out waiting for the response.')
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+        self.last_used = time.time()
+        if pending.error is not None:
+            raise pending.error
+        check_reply(pending.message.type, pending.message.payload)
+        return pending.message
+    def close(self) -> None:
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self._pending.values())
+        try:
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+        for reply in pending:
+            reply.error = ConnectionError('Connection closed.')
+            reply.event.set()
+    def _read_loop(self) -> None:
+        # A selector rather than select.select, which fails on descriptors past FD_SETSIZE.
+        selector = selectors.DefaultSelector()
+        selector.register(self.conn.sock, selectors.EVENT_READ)
+        try:
+            while True:
+                # Waits for a response without a timeout, callers time out on their own; once
+                # one starts arriving, it must arrive within the socket's timeout.
+                selector.select()
+                msg = self.conn.recv_message()
+                with self._lock:
+                    pending = self._pending.get(msg.request_id)
+                if pending is not None:
+                    pending.message = msg
+                    pending.event.set()
+        except Exception:
+            self.close()
+        finally:
+            selector.close()
+
+class ConnectionPool:
+    """
+    Per-peer pool of PooledConnection objects.
+
+    Usage:
+    ```
+    pool = ConnectionPool(timeout, metrics=metrics, stats=stats)
+    rsp = pool.request((ip, port), MessageType.HELLO)
+    pool.close_idle()
+    pool.close_all()
+    ```
+    """
+    def __init__(self, timeout: float, idle_timeout: float = CONNECTION_IDLE_TIMEOUT, per_peer: int = CONNECTIONS_PER_PEER, metrics=None, stats: PeerStats = None) -> None:
+        self.timeout = timeout
+        # Optional metrics.Metrics recording every request.
+        self.metrics = metrics
+        # RTT and failures of every request, per peer, see peerstats.py.
+        self.stats = stats if stats is not None else PeerStats()
+        self.idle_timeout = idle_timeout
+        self.per_peer = per_peer
+        self._connections = {}
+        # Address -> connections being opened, counted against per_peer.
+        self._opening = {}
+        self._lock = threading.Lock()
+    def _acquire(self, address: (str, int), reuse: bool = True) -> PooledConnection:
+        """
+        Returns the least busy open connection to the peer, or a new one if they are all
+        busy, or `reuse` is False, and the peer has fewer than per_peer connections.
+        """
+        with self._lock:
+            conns = [c for c in self._connections.get(address, []) if not c.closed]
+            self._connections[address] = conns
+            full = len(conns) + self._opening.get(address, 0) >= self.per_peer
+            if conns and (reuse or full):
+                best = min(conns, key=lambda c: c.in_flight)
+                if full or best.in_flight < MAX_IN_FLIGHT_PER_CONNECTION:
+                    return best
+            self._opening[address] = self._opening.get(address, 0) + 1
+        # Connect outside the lock so a slow peer does not stall requests to the others.
+        try:
+            conn = PooledConnection(address, self.timeout)
+        finally:
+            with self._lock:
+                self._opening[address] -= 1
+                if not self._opening[address]:
+                    del self._opening[address]
+        with self._lock:
+            self._connections.setdefault(address, []).append(conn)
+        return conn
+    def request(self, address: (str, int), msg_type: MessageType, payload: bytes = b'', timeout: float = None, flags: int = 0) -> Message:
+        """
+        Sends a request over a pooled connection to the peer and returns the response.
+        `timeout` overrides the pool's timeout for waiting on the response.
+
+        If the connection turns out to have been closed by the peer, the request is sent
+        once more over another connection, when that is safe, see can_retry.
+        """
+        address = tuple(address)
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        try:
+            try:
+                rsp = self._acquire(address).call(msg_type, payload, timeout, flags)
+            except ConnectionError as e:
+                if not can_retry(msg_type, e):
+                    raise
+                rsp = self._acquire(address, reuse=False).call(msg_type, payload, timeout, flags)
+        except Exception as e:
+            if isinstance(e, RemoteError):
+                # The peer answered, with an error about the request.
+                self.stats.record_rpc(address, True, time.time() - start)
+            else:
+                self.stats.record_rpc(address, False)
+            if self.metrics is not None:
+                self.metrics.observe_rpc(msg_type.name, f'{address[0]}:{address[1]}', time.time() - start, False, HEADER.size + len(payload))
+            raise
+        rtt = time.time() - start
+        self.stats.record_rpc(address, True, rtt)
+        if self.metrics is not None:
+            self.metrics.observe_rpc(msg_type.name, f'{address[0]}:{address[1]}', rtt, True, HEADER.size + len(payload), rsp.size)
+        return rsp
+    def close_idle(self) -> None:
+        """
+        Closes connections without requests in flight that were not used for idle_timeout seconds.
+        """
+        now = time.time()
+        idle = []
+        with self._lock:
+            for address, conns in self._connections.items():
+                keep = []
+                for conn in conns:
+                    if conn.closed:
+                        continue
+                    if conn.in_flight == 0 and now - conn.last_used > self.idle_timeout:
+                        idle.append(conn)
+                    else:
+                        keep.append(conn)
+                self._connections[address] = keep
+        for conn in idle:
+            conn.close()
+    def close_peer(self, address: (str, int)) -> None:
+        with self._lock:
+            conns = self._connections.pop(tuple(address), [])
+        for conn in conns:
+            conn.close()
+    def close_all(self) -> None:
+        with self._lock:
+            conns = [c for cs in self._connections.values() for c in cs]
+            self._connections = {}
+        for conn in conns:
+            conn.close()
@@ -0,0 +1,247 @@
+"""
+rsync-style delta encoding of a file against an older copy.
+
+The peer holding the old copy splits it into blocks and sends a signature per block: a
+weak checksum that can be rolled one byte at a time (Adler-32, computed by zlib for whole
+blocks) and a strong BLAKE2b hash. The peer holding the new copy slides a window over its
+file, looking the weak checksum up in the signatures at every offset and confirming hits
+with the strong hash, and answers with a stream of operations: COPY a run of blocks of the
+old copy, or a LITERAL run of new bytes. Only the changed fraction of the file travels.
+
+Rolling byte by byte is done in Python, so it is the costly part of a delta. Since most
+changes to large files are made in place, after a block fails to match the block at the
+next boundary is tried first, and rolling only starts when that fails too. Once more than
+GIVE_UP_RATIO of the file turned out to be literal, the rest is sent literal without
+searching.
+
+The operations are packed into frames of about FRAME_SIZE bytes, never splitting one.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import zlib
+
+BLOCK_MIN = 4 * 1024
+BLOCK_MAX = 128 * 1024
+FRAME_SIZE = 256 * 1024
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+GIVE_UP_RATIO = 0.5
+STRONG_SIZE = 16
+ADLER_MOD = 65521
+SIGNATURE = struct.Struct(f'!I{STRONG_SIZE}s')
+REQUEST_HEADER = struct.Struct('!I')
+OP_COPY = 1
+OP_LITERAL = 2
+COPY = struct.Struct('!BQI')
+LITERAL = struct.Struct('!BI')
+
+class DeltaError(Exception):
+    pass
+
+def block_size_for(size: int) -> int:
+    """
+    Returns the block size for a file of `size` bytes: about its square root, rounded up
+    to a KiB, within [BLOCK_MIN, BLOCK_MAX].
+    """
+    block = -(-int(size ** 0.5) // 1024) * 1024
+    return max(BLOCK_MIN, min(BLOCK_MAX, block))
+
+def strong_checksum(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+def signatures(f, block_size: int) -> bytes:
+    """
+    Returns the signatures of every whole block of an open binary file, packed with
+    SIGNATURE. A shorter last block has none, it is always sent literal.
+    """
+    out = bytearray()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    f.seek(0)
+    while f.readinto(buf) == block_size:
+        out += SIGNATURE.pack(zlib.adler32(view), strong_checksum(view))
+    return bytes(out)
+
+def signature_table(data: bytes) -> dict:
+    """
+    Indexes packed signatures by weak checksum.
+
+    Returns:
+    - Dict of weak checksum to a dict of strong hash to block index.
+    """
+    if len(data) % SIGNATURE.size:
+        raise DeltaError('Truncated signatures.')
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(data)):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+def encode_request(request: dict, packed_signatures: bytes) -> bytes:
+    header = json.dumps(request).encode()
+    return REQUEST_HEADER.pack(len(header)) + header + packed_signatures
+
+def decode_request(payload: bytes) -> (dict, bytes):
+    """
+    Returns:
+    - Tuple (JSON request, packed signatures). Raises DeltaError for a malformed request.
+    """
+    if len(payload) < REQUEST_HEADER.size:
+        raise DeltaError('Invalid request.')
+    length, = REQUEST_HEADER.unpack_from(payload)
+    try:
+        request = json.loads(bytes(payload[REQUEST_HEADER.size:REQUEST_HEADER.size + length]).decode())
+    except ValueError:
+        raise DeltaError('Invalid request.')
+    return (request, payload[REQUEST_HEADER.size + length:])
+
+def compute_delta(f, block_size: int, table: dict):
+    """
+    Compares an open binary file with the signatures of another copy.
+
+    Returns:
+    - Generator of (OP_COPY, first block, block count) and (OP_LITERAL, data) operations
+      that rebuild the file from the other copy. Consecutive blocks are merged in one COPY.
+    """
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+        return
+    L = block_size
+    give_up = GIVE_UP_RATIO * size
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        def lookup(start: int, weak: int) -> int:
+            strongs = table.get(weak)
+            if strongs is None:
+                return None
+            return strongs.get(strong_checksum(m[start:start + L]))
+        def literals(start: int, end: int):
+            for piece in range(start, end, FRAME_SIZE):
+                yield (OP_LITERAL, m[piece:min(end, piece + FRAME_SIZE)])
+        pending_copy = None
+        literal = 0
+        literal_start = 0
+        i = 0
+        aligned = True
+        weak = zlib.adler32(m[0:L]) if size >= L else None
+        while i + L <= size and table:
+            index = lookup(i, weak)
+            if index is None and aligned and i + 2 * L <= size:
+                # Try the next block boundary first, where an in-place change leaves the data.
+                probe = zlib.adler32(m[i + L:i + 2 * L])
+                index = lookup(i + L, probe)
+                if index is not None:
+                    i += L
+            if index is not None:
+                if literal_start < i:
+                    if pending_copy is not None:
+                        yield (OP_COPY,) + pending_copy
+                        pending_copy = None
+                    literal += i - literal_start
+                    yield from literals(literal_start, i)
+                if pending_copy is not None and pending_copy[0] + pending_copy[1] == index:
+                    pending_copy = (pending_copy[0], pending_copy[1] + 1)
+                else:
+                    if pending_copy is not None:
+                        yield (OP_COPY,) + pending_copy
+                    pending_copy = (index, 1)
+                i += L
+                literal_start = i
+                aligned = True
+                if i + L <= size:
+                    weak = zlib.adler32(m[i:i + L])
+                continue
+            if literal + i - literal_start > give_up:
+                break
+            if i - literal_start >= FRAME_SIZE:
+                # Bytes behind the window are literal whatever comes next, keep the stream going.
+                if pending_copy is not None:
+                    yield (OP_COPY,) + pending_copy
+                    pending_copy = None
+                literal += i - literal_start
+                yield from literals(literal_start, i)
+                literal_start = i
+            aligned = False
+            if i + L < size:
+                out, new = m[i], m[i + L]
+                a = ((weak & 0xFFFF) - out + new) % ADLER_MOD
+                b = ((weak >> 16) - L * out + a - 1) % ADLER_MOD
+                weak = b << 16 | a
+            i += 1
+        if pending_copy is not None:
+            yield (OP_COPY,) + pending_copy
+        yield from literals(literal_start, size)
+
+def encode_frames(operations):
+    """
+    Packs operations into frames of about FRAME_SIZE bytes. Long literals are split.
+
+    Returns:
+    - Generator of frames.
+    """
+    frame = bytearray()
+    for op in operations:
+        if op[0] == OP_COPY:
+            frame += COPY.pack(OP_COPY, op[1], op[2])
+        else:
+            data = op[1]
+            for start in range(0, len(data), FRAME_SIZE):
+                if len(frame) >= FRAME_SIZE:
+                    yield bytes(frame)
+                    frame = bytearray()
+                piece = data[start:start + FRAME_SIZE]
+                frame += LITERAL.pack(OP_LITERAL, len(piece))
+                frame += piece
+        if len(frame) >= FRAME_SIZE:
+            yield bytes(frame)
+            frame = bytearray()
+    if frame:
+        yield bytes(frame)
+
+def apply_delta(frames, base, out, block_size: int) -> int:
+    """
+    Rebuilds a file from the frames of a delta and the copy the signatures were made of.
+
+    Parameters:
+    - frames: Iterable of frames, see encode_frames.
+    - base: Open binary file, the old copy.
+    - out: Open binary file the new copy is written to.
+    - block_size: Block size of the signatures.
+
+    Returns:
+    - Number of bytes written. Raises DeltaError for a malformed delta, or one that does
+      not fit the old copy.
+    """
+    blocks = os.fstat(base.fileno()).st_size // block_size
+    written = 0
+    for frame in frames:
+        view = memoryview(frame)
+        pos = 0
+        while pos < len(view):
+            op = view[pos]
+            if op == OP_COPY and pos + COPY.size <= len(view):
+                _, first, count = COPY.unpack_from(view, pos)
+                pos += COPY.size
+                if first + count > blocks:
+                    raise DeltaError('Copy beyond the end of the file.')
+                start = first * block_size
+                end = start + count * block_size
+                while start < end:
+                    data = os.pread(base.fileno(), min(COPY_CHUNK_SIZE, end - start), start)
+                    if not data:
+                        raise DeltaError('File changed during the delta.')
+                    out.write(data)
+                    start += len(data)
+                written += count * block_size
+            elif op == OP_LITERAL and pos + LITERAL.size <= len(view):
+                _, length = LITERAL.unpack_from(view, pos)
+                pos += LITERAL.size
+                if pos + length > len(view):
+                    raise DeltaError('Truncated literal.')
+                out.write(view[pos:pos + length])
+                pos += length
+                written += length
+            else:
+                raise DeltaError('Invalid delta operation.')
+    return written
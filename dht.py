@@ -0,0 +1,297 @@
+"""
+Kademlia-style distributed hash table for finding the holders of a file.
+
+Every node gets a 160-bit ID, the SHA-1 of its uid, and keys are hashed to the same space.
+Each node keeps a routing table of at most K contacts per bit of distance (XOR metric), so
+the table stays bounded however large the network is. Finding the nodes closest to a key is
+an iterative lookup querying ALPHA nodes in parallel, each round getting at least one bit
+closer, which takes O(log N) messages.
+
+Nodes publish provider records for their shared files, by name (`name:<file name>`) and by
+content hash (`hash:<sha256>`), to the K nodes closest to each key, and republish them
+periodically; records expire if not refreshed. A file is then found by looking up its key
+instead of asking every peer for its list.
+"""
+
+from peer import Peer
+from protocol import MessageType, encode_json
+from fanout import fan_out
+import collections
+import hashlib
+import threading
+import time
+
+ID_BITS = 160
+K = 20
+ALPHA = 3
+DHT_TIMEOUT = 1.0
+DHT_TICK = 1.0
+REPUBLISH_INTERVAL = 600.0
+PROVIDER_TTL = 1800.0
+PUBLISH_BATCH = 8
+MAX_PROVIDER_KEYS = 100000
+MAX_PROVIDERS_PER_KEY = 50
+REPLACEMENT_CACHE_SIZE = K
+
+def node_id(uid: str) -> int:
+    return int.from_bytes(hashlib.sha1(uid.encode()).digest(), 'big')
+
+def key_id(key: str) -> int:
+    return int.from_bytes(hashlib.sha1(key.encode()).digest(), 'big')
+
+class Contact:
+    def __init__(self, uid: str, ip: str, port: int) -> None:
+        self.uid = uid
+        self.ip = ip
+        self.port = port
+        self.id = node_id(uid)
+    @property
+    def address(self) -> (str, int):
+        return (self.ip, self.port)
+    def to_list(self) -> list:
+        return [self.uid, self.ip, self.port]
+    def __str__(self) -> str:
+        return f'{self.uid} ({self.ip}:{self.port})'
+
+class RoutingTable:
+    """
+    One k-bucket per bit of XOR distance to our own ID, each holding at most K contacts
+    ordered from least to most recently seen, plus a small cache of replacements.
+    """
+    def __init__(self, own_id: int) -> None:
+        self.own_id = own_id
+        self._buckets = [collections.OrderedDict() for _ in range(ID_BITS)]
+        self._replacements = [collections.OrderedDict() for _ in range(ID_BITS)]
+        self._lock = threading.Lock()
+    def _bucket_index(self, id: int) -> int:
+        return (id ^ self.own_id).bit_length() - 1
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self._buckets)
+    def touch(self, contact: Contact) -> None:
+        """
+        Records that a contact was seen. A full bucket keeps its old contacts, which are
+        likely to stay up, and the new one goes to the replacement cache.
+        """
+        if contact.id == self.own_id:
+            return
+        index = self._bucket_index(contact.id)
+        with self._lock:
+            bucket = self._buckets[index]
+            if contact.uid in bucket or len(bucket) < K:
+                bucket[contact.uid] = contact
+                bucket.move_to_end(contact.uid)
+                return
+            replacements = self._replacements[index]
+            replacements[contact.uid] = contact
+            replacements.move_to_end(contact.uid)
+            if len(replacements) > REPLACEMENT_CACHE_SIZE:
+                replacements.popitem(last=False)
+    def remove(self, contact: Contact) -> None:
+        """
+        Removes a contact that failed to answer, promoting the most recent replacement.
+        """
+        index = self._bucket_index(contact.id)
+        with self._lock:
+            bucket = self._buckets[index]
+            if bucket.pop(contact.uid, None) is not None and self._replacements[index]:
+                uid, replacement = self._replacements[index].popitem()
+                bucket[uid] = replacement
+    def closest(self, id: int, count: int = K) -> [Contact]:
+        with self._lock:
+            contacts = [c for bucket in self._buckets for c in bucket.values()]
+        return sorted(contacts, key=lambda c: c.id ^ id)[:count]
+
+class ProviderStore:
+    """
+    Provider records stored on this node: key -> {provider uid: (ip, port, expiry)}.
+    """
+    def __init__(self) -> None:
+        self._records = {}
+        self._lock = threading.Lock()
+    def add(self, key: str, provider: Contact) -> None:
+        with self._lock:
+            providers = self._records.setdefault(key, {})
+            providers[provider.uid] = (provider.ip, provider.port, time.time() + PROVIDER_TTL)
+            if len(providers) > MAX_PROVIDERS_PER_KEY:
+                del providers[min(providers, key=lambda uid: providers[uid][2])]
+            if len(self._records) > MAX_PROVIDER_KEYS:
+                self._expire()
+                while len(self._records) > MAX_PROVIDER_KEYS:
+                    # Drop the key whose freshest record expires first.
+                    del self._records[min(self._records, key=lambda k: max(e for _, _, e in self._records[k].values()))]
+    def get(self, key: str) -> [Contact]:
+        now = time.time()
+        with self._lock:
+            providers = self._records.get(key, {})
+            return [Contact(uid, ip, port) for uid, (ip, port, expiry) in providers.items() if expiry > now]
+    def _expire(self) -> None:
+        now = time.time()
+        for key in list(self._records):
+            providers = {uid: r for uid, r in self._records[key].items() if r[2] > now}
+            if providers:
+                self._records[key] = providers
+            else:
+                del self._records[key]
+    def expire(self) -> None:
+        with self._lock:
+            self._expire()
+    def __len__(self) -> int:
+        return len(self._records)
+
+class DHT:
+    """
+    The DHT node of an Application.
+
+    Usage:
+    ```
+    dht = DHT(uid, port, pool.request, provider_keys)
+    dht.start()
+    dht.add_contact(uid, ip, port)
+    providers = dht.find_providers('name:file.txt')
+    dht.stop()
+    ```
+    """
+    def __init__(self, uid: str, port: int, request, provider_keys, log=None) -> None:
+        self.uid = uid
+        self.port = port
+        self.id = node_id(uid)
+        self.table = RoutingTable(self.id)
+        self.store = ProviderStore()
+        self._request = request
+        self._provider_keys = provider_keys
+        self._log = log or (lambda msg: None)
+        self._published = {}
+        self._last_expire = time.time()
+        self._bootstrapped = False
+        self._running = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='dht', daemon=True)
+    def start(self) -> None:
+        self._running = True
+        self._thread.start()
+    def stop(self) -> None:
+        self._running = False
+        self._stop.set()
+        self._thread.join()
+    def add_contact(self, uid: str, ip: str, port: int) -> None:
+        self.table.touch(Contact(uid, ip, port))
+    def _message(self, **fields) -> bytes:
+        fields.update({'uid': self.uid, 'port': self.port})
+        return encode_json(fields)
+    def _call(self, contact: Contact, msg_type: MessageType, payload: bytes):
+        try:
+            rsp = self._request(contact.address, msg_type, payload, DHT_TIMEOUT)
+        except Exception:
+            self.table.remove(contact)
+            raise
+        self.table.touch(contact)
+        return rsp
+    def handle(self, msg_type: MessageType, ip: str, request: dict) -> (MessageType, bytes):
+        """
+        Answers a DHT request, and adds the sender to the routing table.
+
+        Returns:
+        - Tuple (response type, response payload).
+        """
+        self.table.touch(Contact(request['uid'], ip, int(request['port'])))
+        if msg_type == MessageType.DHT_FIND_NODE:
+            nodes = self.table.closest(int(request['target'], 16))
+            return (MessageType.DHT_NODES, self._message(nodes=[c.to_list() for c in nodes]))
+        if msg_type == MessageType.DHT_FIND_VALUE:
+            providers = self.store.get(request['key'])
+            nodes = self.table.closest(key_id(request['key']))
+            return (MessageType.DHT_VALUE, self._message(providers=[c.to_list() for c in providers], nodes=[c.to_list() for c in nodes]))
+        if msg_type == MessageType.DHT_STORE:
+            self.store.add(request['key'], Contact(request['uid'], ip, int(request['port'])))
+            return (MessageType.ACK, self._message())
+        raise Exception(f'Unexpected DHT message {msg_type.name}.')
+    def _lookup(self, target: int, key: str = None) -> ([Contact], [Contact]):
+        """
+        Iterative lookup of the K nodes closest to `target`. With a key, FIND_VALUE is used
+        and the lookup stops at the first round that returns providers.
+
+        Returns:
+        - Tuple (K closest nodes that answered, providers found).
+        """
+        shortlist = {c.uid: c for c in self.table.closest(target)}
+        queried = set()
+        answered = {}
+        providers = {}
+        while True:
+            candidates = sorted((c for c in shortlist.values() if c.uid not in queried), key=lambda c: c.id ^ target)
+            closest_answered = sorted(answered.values(), key=lambda c: c.id ^ target)[:K]
+            if closest_answered and len(closest_answered) >= K:
+                # Done once no unqueried candidate is closer than the K-th closest answer.
+                candidates = [c for c in candidates if c.id ^ target < closest_answered[-1].id ^ target]
+            batch = candidates[:ALPHA]
+            if not batch:
+                break
+            queried.update(c.uid for c in batch)
+            if key is None:
+                query = lambda c: self._call(c, MessageType.DHT_FIND_NODE, self._message(target=format(target, 'x')))
+            else:
+                query = lambda c: self._call(c, MessageType.DHT_FIND_VALUE, self._message(key=key))
+            for contact, rsp, error in fan_out(query, batch, deadline=DHT_TIMEOUT * 2):
+                if error is not None:
+                    continue
+                answered[contact.uid] = contact
+                data = rsp.json()
+                for uid, ip, port in data.get('providers', []):
+                    providers[uid] = Contact(uid, ip, port)
+                for uid, ip, port in data.get('nodes', []):
+                    if uid != self.uid and uid not in shortlist:
+                        shortlist[uid] = Contact(uid, ip, port)
+            if providers:
+                break
+        return (sorted(answered.values(), key=lambda c: c.id ^ target)[:K], list(providers.values()))
+    def find_nodes(self, target: int) -> [Contact]:
+        return self._lookup(target)[0]
+    def find_providers(self, key: str) -> [Peer]:
+        """
+        Looks up the providers of a key, like `name:file.txt` or `hash:<sha256>`.
+        """
+        providers = self.store.get(key)
+        if not providers:
+            providers = self._lookup(key_id(key), key)[1]
+        return [Peer(c.uid, c.ip, c.port) for c in providers if c.uid != self.uid]
+    def publish(self, key: str) -> int:
+        """
+        Stores a provider record for this node on the K nodes closest to the key.
+
+        Returns:
+        - Number of nodes that stored it.
+        """
+        nodes = self.find_nodes(key_id(key))
+        payload = self._message(key=key)
+        stored = sum(1 for _, rsp, error in fan_out(lambda c: self._call(c, MessageType.DHT_STORE, payload), nodes) if error is None)
+        self._published[key] = time.time()
+        return stored
+    def tick(self) -> None:
+        """
+        Joins the network once there are contacts, then publishes up to PUBLISH_BATCH new
+        or due provider records.
+        """
+        if len(self.table) == 0:
+            return
+        if not self._bootstrapped:
+            # Looking up our own ID fills the buckets near us and announces us to those nodes.
+            self.find_nodes(self.id)
+            self._bootstrapped = True
+        now = time.time()
+        keys = self._provider_keys()
+        for key in list(self._published):
+            if key not in keys:
+                del self._published[key]
+        due = [key for key in keys if now - self._published.get(key, 0) > REPUBLISH_INTERVAL]
+        for key in due[:PUBLISH_BATCH]:
+            self.publish(key)
+        if now - self._last_expire > REPUBLISH_INTERVAL:
+            self.store.expire()
+            self._last_expire = now
+    def _run(self) -> None:
+        while self._running:
+            try:
+                self.tick()
+            except Exception as e:
+                self._log(f'DHT maintenance failed: {e}')
+            self._stop.wait(DHT_TICK)
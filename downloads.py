@@ -0,0 +1,405 @@
+"""
+Background download manager.
+
+Downloads are queued as jobs and run on their own threads, up to `slots` at once and up to
+`peer_slots` jobs per peer, so several transfers overlap instead of running one after
+another. Queued jobs start by priority, then in the order they were added. A job looks up
+the peers holding its file when it starts, ranked by Application.rank_peers, and downloads
+it with swarm_receive_file_from_network from those that have a free slot. If every holder
+is at its limit, the job waits in the queue for one to free up.
+
+A failed attempt is retried after RETRY_DELAY seconds, doubled on every attempt up to
+RETRY_MAX_DELAY, until MAX_ATTEMPTS. A TransferError, like a file that does not match its
+hash, fails the job at once. The progress of a download is kept in its part file, see
+transfer.py, so a retry only fetches what is missing.
+
+The queue is saved to a hidden `.p2p-downloads.json` in the file directory whenever a job
+changes state. Jobs that were queued or running when the node stopped are queued again
+when it starts.
+"""
+
+from transfer import PartialDownload, TransferCancelled, TransferError
+import json
+import os
+import threading
+import time
+
+DOWNLOADS_FILENAME = '.p2p-downloads.json'
+DOWNLOAD_SLOTS = 3
+PEER_DOWNLOAD_SLOTS = 2
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 2.0
+RETRY_MAX_DELAY = 60.0
+# Before looking again for a holder with a free slot.
+PEER_BUSY_DELAY = 1.0
+# Finished jobs kept in the queue, the oldest are dropped first.
+MAX_FINISHED_JOBS = 100
+STOP_TIMEOUT = 5.0
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+class DownloadCancelled(TransferCancelled):
+    pass
+
+class DownloadJob:
+    """
+    A file to be downloaded and the state of its download.
+
+    `peeruids` fixes the peers the file is downloaded from; by default they are looked up
+    on the network on every attempt.
+    """
+    def __init__(self, job_id: int, filename: str, sha256: str = None, priority: int = PRIORITY_NORMAL, peeruids: [str] = None) -> None:
+        self.id = job_id
+        self.filename = filename
+        self.sha256 = sha256
+        self.priority = priority
+        self.peeruids = peeruids
+        self.state = QUEUED
+        self.attempts = 0
+        self.error = None
+        self.result = None
+        self.size = None
+        self.received = 0
+        # Bytes already in the part file when the current attempt started.
+        self.resumed = 0
+        self.sources = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.next_attempt = 0.0
+        self.cancelled = False
+    @property
+    def progress(self) -> float:
+        """
+        Fraction of the file received, None while its size is unknown.
+        """
+        if not self.size:
+            return None
+        return min(1.0, self.received / self.size)
+    @property
+    def rate(self) -> float:
+        """
+        Average bytes per second of the download since it started.
+        """
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.time()) - self.started
+        return (self.received - self.resumed) / elapsed if elapsed > 0 else 0.0
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id, 'filename': self.filename, 'sha256': self.sha256, 'priority': self.priority,
+            'peeruids': self.peeruids, 'state': self.state, 'attempts': self.attempts, 'error': self.error,
+            'result': self.result, 'size': self.size, 'received': self.received, 'created': self.created,
+            'finished': self.finished,
+        }
+    @classmethod
+    def from_dict(cls, data: dict) -> 'DownloadJob':
+        job = cls(data['id'], data['filename'], data.get('sha256'), data.get('priority', PRIORITY_NORMAL), data.get('peeruids'))
+        job.state = data.get('state', QUEUED)
+        job.attempts = data.get('attempts', 0)
+        job.error = data.get('error')
+        job.result = data.get('result')
+        job.size = data.get('size')
+        job.received = data.get('received', 0)
+        job.created = data.get('created', job.created)
+        job.finished = data.get('finished')
+        return job
+    def __str__(self) -> str:
+        return f'Download {self.id} ({self.filename})'
+
+class DownloadManager:
+    """
+    Queue of download jobs run in the background.
+
+    Usage:
+    ```
+    downloads = DownloadManager(ctx, path)
+    downloads.start()
+    job = downloads.add('video.mp4', priority=PRIORITY_HIGH)
+    downloads.wait(job.id)
+    downloads.stop()
+    ```
+    """
+    def __init__(self, ctx: 'Application', path: str, slots: int = DOWNLOAD_SLOTS, peer_slots: int = PEER_DOWNLOAD_SLOTS, log=None) -> None:
+        self.ctx = ctx
+        self.path = path
+        self.slots = slots
+        self.peer_slots = peer_slots
+        self._log = log or (lambda msg: None)
+        self._jobs = {}
+        self._next_id = 1
+        self._active = 0
+        # Peer uid -> number of running jobs downloading from it.
+        self._peer_jobs = {}
+        self._threads = {}
+        self._running = False
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='downloads', daemon=True)
+        self._load()
+    def _load(self) -> None:
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            for item in data['jobs']:
+                job = DownloadJob.from_dict(item)
+                if job.state not in FINISHED_STATES:
+                    # Interrupted by the previous stop, started over from its part file.
+                    job.state = QUEUED
+                    job.attempts = 0
+                self._jobs[job.id] = job
+            self._next_id = max([data.get('next_id', 1)] + [job.id + 1 for job in self._jobs.values()])
+        except:
+            self._jobs = {}
+    def _save(self) -> None:
+        """
+        Writes the queue to disk. Called with the lock held.
+        """
+        finished = sorted((job for job in self._jobs.values() if job.state in FINISHED_STATES), key=lambda job: job.finished or 0)
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job.id]
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'next_id': self._next_id, 'jobs': [job.to_dict() for job in self._jobs.values()]}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self._log(f'Could not save the download queue: {e}')
+    def start(self) -> None:
+        self._running = True
+        self._thread.start()
+    def stop(self) -> None:
+        """
+        Interrupts the running downloads, which stay queued for the next start.
+        """
+        with self._changed:
+            self._running = False
+            for job in self._jobs.values():
+                if job.state == RUNNING:
+                    job.cancelled = True
+            threads = list(self._threads.values())
+            self._changed.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+        deadline = time.time() + STOP_TIMEOUT
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        with self._changed:
+            self._save()
+    def set_limits(self, slots: int, peer_slots: int) -> None:
+        """
+        Changes the number of downloads run at once, in total and per peer. Running
+        downloads are not interrupted.
+        """
+        with self._changed:
+            self.slots = max(1, slots)
+            self.peer_slots = max(1, peer_slots)
+            self._changed.notify_all()
+    @property
+    def active(self) -> int:
+        return self._active
+    def add(self, filename: str, sha256: str = None, priority: int = PRIORITY_NORMAL, peeruids: [str] = None) -> DownloadJob:
+        """
+        Queues the download of a file.
+
+        Parameters:
+        - filename: Name of the file to be downloaded.
+        - sha256: Expected content hash, see receive_file_from_network. By default, the
+          version held by the most peers when the download starts.
+        - priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW; lower values start first.
+        - peeruids: Peers to download the file from, instead of looking them up.
+
+        Returns:
+        - The new DownloadJob, or the unfinished job already downloading this file, with
+          its priority raised to `priority` if that is higher.
+        """
+        if os.path.basename(filename) != filename or filename.startswith('.'):
+            raise TransferError('Invalid file name.')
+        with self._changed:
+            for job in self._jobs.values():
+                if job.filename == filename and job.state not in FINISHED_STATES:
+                    job.priority = min(job.priority, priority)
+                    return job
+            job = DownloadJob(self._next_id, filename, sha256, priority, peeruids)
+            self._next_id += 1
+            self._jobs[job.id] = job
+            self._save()
+            self._changed.notify_all()
+        self._log(f'{job} queued.')
+        return job
+    def get(self, job_id: int) -> DownloadJob:
+        with self._changed:
+            return self._jobs.get(job_id)
+    def jobs(self) -> [DownloadJob]:
+        """
+        Returns every job: running ones first, then queued ones in the order they will
+        start, then finished ones, the most recent first.
+        """
+        with self._changed:
+            jobs = list(self._jobs.values())
+        order = {RUNNING: 0, QUEUED: 1}
+        return sorted(jobs, key=lambda job: (order.get(job.state, 2), job.priority if job.state == QUEUED else 0, -(job.finished or 0), job.id))
+    def cancel(self, job_id: int) -> bool:
+        """
+        Cancels a queued or running job. The part file of a running download is kept, so
+        adding the file again resumes it.
+
+        Returns:
+        - False if there is no such unfinished job.
+        """
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None or job.state in FINISHED_STATES:
+                return False
+            job.cancelled = True
+            if job.state == QUEUED:
+                self._finish(job, CANCELLED)
+            self._changed.notify_all()
+        return True
+    def set_priority(self, job_id: int, priority: int) -> bool:
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None or job.state in FINISHED_STATES:
+                return False
+            job.priority = priority
+            self._save()
+            self._changed.notify_all()
+        return True
+    def clear_finished(self) -> None:
+        with self._changed:
+            for job in [job for job in self._jobs.values() if job.state in FINISHED_STATES]:
+                del self._jobs[job.id]
+            self._save()
+    def wait(self, job_id: int, timeout: float = None) -> DownloadJob:
+        """
+        Waits for a job to finish, at most `timeout` seconds.
+
+        Returns:
+        - The job, whatever its state.
+        """
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                self._changed.wait_for(lambda: job.state in FINISHED_STATES, timeout)
+            return job
+    def _finish(self, job: DownloadJob, state: str, error: Exception = None) -> None:
+        """
+        Moves a job to a finished state. Called with the lock held.
+        """
+        job.state = state
+        job.finished = time.time()
+        if error is not None:
+            job.error = str(error)
+        self._save()
+        self._changed.notify_all()
+    def _run(self) -> None:
+        with self._changed:
+            while self._running:
+                self._changed.wait(self._start_due())
+    def _start_due(self) -> float:
+        """
+        Starts the queued jobs that are due, by priority, while slots are free. Called with
+        the lock held.
+
+        Returns:
+        - Seconds until the next job waiting for a retry is due, or None.
+        """
+        now = time.time()
+        delay = None
+        queued = sorted((job for job in self._jobs.values() if job.state == QUEUED), key=lambda job: (job.priority, job.id))
+        for job in queued:
+            if self._active >= self.slots:
+                break
+            if job.next_attempt > now:
+                delay = min(delay or RETRY_MAX_DELAY, job.next_attempt - now)
+                continue
+            job.state = RUNNING
+            job.attempts += 1
+            job.error = None
+            self._active += 1
+            thread = threading.Thread(target=self._download, args=(job,), name=f'download-{job.id}', daemon=True)
+            self._threads[job.id] = thread
+            thread.start()
+        return delay
+    def _sources(self, job: DownloadJob) -> [str]:
+        """
+        Returns the uids of the peers holding the file of a job, best ranked first.
+        """
+        if job.peeruids is not None:
+            peers = [self.ctx.known_peers[uid] for uid in job.peeruids if uid in self.ctx.known_peers]
+            return [peer.uid for peer in self.ctx.rank_peers(peers, job.size)]
+        entry, holders = self.ctx.find_sources(job.filename, job.sha256)
+        if entry is not None:
+            job.size = entry['size']
+            if job.sha256 is None:
+                # Sticks to this version on retries, so a resumed part file stays valid.
+                job.sha256 = entry['sha256']
+        return holders
+    def _progress(self, job: DownloadJob, n: int) -> None:
+        if job.cancelled:
+            raise DownloadCancelled('Download cancelled.')
+        with self._changed:
+            job.received += n
+    def _download(self, job: DownloadJob) -> None:
+        peers = []
+        error = None
+        try:
+            holders = self._sources(job)
+            if len(holders) == 0:
+                raise OSError('No peer holds the file.')
+            with self._changed:
+                peers = [uid for uid in holders if self._peer_jobs.get(uid, 0) < self.peer_slots]
+                for uid in peers:
+                    self._peer_jobs[uid] = self._peer_jobs.get(uid, 0) + 1
+            if peers:
+                job.sources = peers
+                job.started = time.time()
+                # A resumed download starts from what its part file already holds.
+                job.resumed = job.received = PartialDownload(self.ctx.file_dir, job.filename).covered()
+                result = self.ctx.swarm_receive_file_from_network(peers, job.filename, job.sha256, progress=lambda n: self._progress(job, n))
+                job.size = result.size
+                job.result = str(result)
+        except Exception as e:
+            error = e
+        with self._changed:
+            for uid in peers:
+                self._peer_jobs[uid] -= 1
+                if self._peer_jobs[uid] == 0:
+                    del self._peer_jobs[uid]
+            self._active -= 1
+            self._threads.pop(job.id, None)
+            if job.cancelled and not self._running:
+                # Stopped with the node, resumed by the next start.
+                job.state = QUEUED
+                job.cancelled = False
+                job.attempts -= 1
+            elif job.cancelled:
+                self._finish(job, CANCELLED)
+            elif error is None and not peers:
+                # Every holder is at its limit of jobs, wait for one to free up.
+                job.state = QUEUED
+                job.attempts -= 1
+                job.next_attempt = time.time() + PEER_BUSY_DELAY
+            elif error is None:
+                self._finish(job, DONE)
+            elif isinstance(error, TransferError) or job.attempts >= MAX_ATTEMPTS:
+                self._finish(job, FAILED, error)
+            else:
+                job.state = QUEUED
+                job.error = str(error)
+                job.next_attempt = time.time() + min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** (job.attempts - 1))
+                self._save()
+            self._changed.notify_all()
+        if job.state == DONE:
+            self._log(f'{job} done: {job.result}')
+        elif job.state == FAILED:
+            self._log(f'{job} failed after {job.attempts} attempt(s): {job.error}')
+        elif job.state == QUEUED and error is not None:
+            self._log(f'{job} attempt {job.attempts} failed ({error}), retrying in {job.next_attempt - time.time():.1f}s.')
@@ -0,0 +1,42 @@
+"""
+Concurrent fan-out of a blocking call over many peers.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+
+FANOUT_CONCURRENCY = 64
+FANOUT_DEADLINE = 5.0
+
+def fan_out(func, items: list, max_workers: int = FANOUT_CONCURRENCY, deadline: float = FANOUT_DEADLINE):
+    """
+    Calls `func(item)` for every item concurrently and yields the outcomes as they complete.
+
+    At most `max_workers` calls run at once. Once `deadline` seconds have passed, the
+    generator stops; calls still running are abandoned and their outcomes dropped.
+
+    Usage:
+    ```
+    for peer, result, error in fan_out(query, peers):
+        if error is None:
+            use(result)
+    ```
+
+    Returns:
+    - Generator of (item, result, exception) tuples; exception is None on success.
+    """
+    if len(items) == 0:
+        return
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(items)), thread_name_prefix='fanout')
+    try:
+        futures = {executor.submit(func, item): item for item in items}
+        try:
+            for future in as_completed(futures, timeout=deadline):
+                item = futures[future]
+                try:
+                    yield (item, future.result(), None)
+                except Exception as e:
+                    yield (item, None, e)
+        except TimeoutError:
+            return
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,393 @@
+"""
+Content hash index of the shared files.
+
+Every shared file gets a SHA-256, persisted in a hidden `.p2p-index.json` in the file
+directory and keyed by (name, size, mtime), so a file is hashed again only when it changes.
+Small files are hashed inline; large ones are hashed on a process pool without blocking the
+refresh, and show up without a hash until their digest is ready.
+
+Every change to the index bumps its version and is kept in a bounded change log, so peers
+can fetch only what changed since the version they last saw.
+
+The piece hashes of a file, see merkle.py, are computed in the same pass as its SHA-256,
+and their Merkle root is shared and persisted with it. The piece hashes themselves are kept
+in a small in-memory cache; one missing from it is computed again in the background.
+"""
+
+from merkle import PieceTree, PIECE_SIZE, hash_file_pieces, merkle_root
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import uuid
+
+INDEX_FILENAME = '.p2p-index.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+PROCESS_HASH_THRESHOLD = 16 * 1024 * 1024
+CHANGELOG_SIZE = 10000
+TREE_CACHE_SIZE = 256
+
+def hash_file(path: str) -> str:
+    """
+    Returns the hex SHA-256 of a file, read in fixed-size chunks.
+    """
+    digest = hashlib.sha256()
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+class FileEntry:
+    def __init__(self, name: str, size: int, mtime_ns: int, sha256: str = None, root: str = None) -> None:
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha256 = sha256
+        # Merkle root of the piece hashes, see merkle.py.
+        self.root = root
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'size': self.size, 'mtime_ns': self.mtime_ns, 'sha256': self.sha256, 'root': self.root}
+    def describe(self) -> dict:
+        """
+        The part of the entry shared with other peers.
+        """
+        return {'name': self.name, 'size': self.size, 'sha256': self.sha256, 'root': self.root}
+
+class FileIndex:
+    """
+    SHA-256 index of the files in a directory.
+
+    Usage:
+    ```
+    index = FileIndex(file_dir)
+    index.update(watcher.poll())
+    name = index.name_for_hash(sha256)
+    delta = index.changes_since(epoch, version)
+    ```
+    """
+    _executor = None
+    _executor_lock = threading.Lock()
+    def __init__(self, file_dir: str) -> None:
+        self.file_dir = file_dir
+        self.path = os.path.join(file_dir, INDEX_FILENAME)
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+        self._entries = {}
+        self._by_hash = {}
+        self._cache = {}
+        self._pending = {}
+        self._changes = collections.deque()
+        self._changes_start = 0
+        self._trees = collections.OrderedDict()
+        self._tree_jobs = {}
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._load()
+    @classmethod
+    def _get_executor(cls) -> ProcessPoolExecutor:
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+            return cls._executor
+    @classmethod
+    def shutdown(cls) -> None:
+        """
+        Stops the shared hashing process pool.
+        """
+        with cls._executor_lock:
+            if cls._executor is not None:
+                cls._executor.shutdown(wait=False, cancel_futures=True)
+                cls._executor = None
+    def _load(self) -> None:
+        """
+        Loads the hashes saved by a previous run. They are only used to skip rehashing
+        files that did not change, the index itself starts empty.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            for item in data['files']:
+                entry = FileEntry(item['name'], item['size'], item['mtime_ns'], item['sha256'], item.get('root'))
+                self._cache[entry.name] = entry
+        except:
+            self._cache = {}
+    def _save(self) -> None:
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'files': [e.to_dict() for e in self._entries.values() if e.sha256 is not None]}, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+    def _set_entry(self, name: str, entry: FileEntry) -> None:
+        old = self._entries.pop(name, None)
+        tree = self._trees.get(name)
+        if tree is not None and (entry is None or tree[0] != (entry.size, entry.mtime_ns)):
+            del self._trees[name]
+        if old is not None and old.sha256 is not None:
+            names = self._by_hash.get(old.sha256)
+            names.discard(name)
+            if not names:
+                del self._by_hash[old.sha256]
+        if entry is not None:
+            self._entries[name] = entry
+            if entry.sha256 is not None:
+                self._by_hash.setdefault(entry.sha256, set()).add(name)
+        self.version += 1
+        self._changes.append((self.version, name))
+        if len(self._changes) > CHANGELOG_SIZE:
+            self._changes_start = self._changes.popleft()[0]
+    def update(self, changes: dict) -> bool:
+        """
+        Applies the changes reported by a watcher.
+
+        Parameters:
+        - changes: Dict of file name to its (size, mtime_ns), or to None for removed files.
+
+        New or changed files are hashed, and files still being hashed in the background are
+        checked again. Files are hashed without holding the lock, so the file list stays
+        readable meanwhile; the lock is only taken to install the new entries. Every entry
+        that changes bumps the version. The index is saved to disk when anything changed.
+
+        Returns:
+        - True if the index changed.
+        """
+        # Updates are serialized, the entries only change here.
+        with self._update_lock:
+            with self._lock:
+                changes = dict(changes)
+                for name in self._pending:
+                    if name not in changes and name in self._entries:
+                        entry = self._entries[name]
+                        changes[name] = (entry.size, entry.mtime_ns)
+                current = {name: self._entries.get(name) for name in changes}
+            updates = {}
+            for name, state in changes.items():
+                if state is None:
+                    self._pending.pop(name, None)
+                    if current[name] is not None:
+                        updates[name] = (None, None)
+                    continue
+                size, mtime_ns = state
+                entry = current[name]
+                if entry is not None and (entry.size, entry.mtime_ns) == state and entry.sha256 is not None:
+                    continue
+                cached = self._cache.pop(name, None)
+                if cached is not None and (cached.size, cached.mtime_ns) == state and cached.root is not None:
+                    new, pieces = cached, None
+                else:
+                    new, pieces = self._hash_entry(name, size, mtime_ns)
+                if entry is None or entry.describe() != new.describe():
+                    updates[name] = (new, pieces)
+            if not updates:
+                return False
+            with self._lock:
+                for name, (entry, pieces) in updates.items():
+                    self._set_entry(name, entry)
+                    if pieces is not None:
+                        self._put_tree(entry, pieces)
+                self._save()
+            return True
+    def refresh(self, files: dict) -> bool:
+        """
+        Brings the index in line with a full listing of the directory.
+
+        Parameters:
+        - files: Dict of every file name to its (size, mtime_ns).
+        """
+        with self._lock:
+            changes = {name: None for name in self._entries if name not in files}
+        changes.update(files)
+        return self.update(changes)
+    def _hash_entry(self, name: str, size: int, mtime_ns: int) -> (FileEntry, [str]):
+        """
+        Returns an entry for a new or changed file and its piece hashes, hashing it now if
+        it is small. For large files, the hash is computed on the process pool and picked up
+        by a later update; until then the entry has no hash and the pieces are None.
+        """
+        path = os.path.join(self.file_dir, name)
+        if size < PROCESS_HASH_THRESHOLD:
+            try:
+                sha256, pieces = hash_file_pieces(path)
+            except OSError:
+                return FileEntry(name, size, mtime_ns), None
+        else:
+            pending = self._pending.get(name)
+            if pending is None or pending[0] != (size, mtime_ns):
+                self._pending[name] = ((size, mtime_ns), self._get_executor().submit(hash_file_pieces, path))
+                return FileEntry(name, size, mtime_ns), None
+            future = pending[1]
+            if not future.done():
+                return FileEntry(name, size, mtime_ns), None
+            del self._pending[name]
+            try:
+                sha256, pieces = future.result()
+            except Exception:
+                return FileEntry(name, size, mtime_ns), None
+        return FileEntry(name, size, mtime_ns, sha256, merkle_root(pieces)), pieces
+    def get(self, name: str) -> FileEntry:
+        with self._lock:
+            return self._entries.get(name)
+    def _put_tree(self, entry: FileEntry, pieces: [str]) -> PieceTree:
+        """
+        Caches the piece hashes of an entry, if they match its root. Called with the lock held.
+        """
+        try:
+            tree = PieceTree(entry.size, PIECE_SIZE, pieces, entry.root)
+        except ValueError:
+            return None
+        self._trees[entry.name] = ((entry.size, entry.mtime_ns), tree)
+        self._trees.move_to_end(entry.name)
+        if len(self._trees) > TREE_CACHE_SIZE:
+            self._trees.popitem(last=False)
+        return tree
+    def piece_tree(self, name: str) -> PieceTree:
+        """
+        Returns the piece hashes of a shared file, without waiting for the file to be hashed.
+
+        Trees are computed when files are indexed and kept in a bounded cache. A tree that is
+        not cached, because it was evicted or the hash came from the saved index, is computed
+        again: inline for a small file, on the process pool for a large one, in which case
+        None is returned until it is ready.
+
+        Returns:
+        - PieceTree, or None if the file is not indexed or its tree is not available yet.
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.root is None:
+                return None
+            cached = self._trees.get(name)
+            if cached is not None and cached[0] == (entry.size, entry.mtime_ns):
+                self._trees.move_to_end(name)
+                return cached[1]
+            path = os.path.join(self.file_dir, name)
+            if entry.size >= PROCESS_HASH_THRESHOLD:
+                if name in self._tree_jobs:
+                    return None
+                future = self._tree_jobs[name] = self._get_executor().submit(hash_file_pieces, path)
+        if entry.size >= PROCESS_HASH_THRESHOLD:
+            # Outside the lock, the callback runs right away if the future is already done.
+            future.add_done_callback(lambda f: self._tree_done(entry, f))
+            return None
+        try:
+            sha256, pieces = hash_file_pieces(path)
+        except OSError:
+            return None
+        return self._tree_done(entry, None, sha256, pieces)
+    def _tree_done(self, entry: FileEntry, future, sha256: str = None, pieces: [str] = None) -> PieceTree:
+        """
+        Caches a tree computed again for `entry`, unless the file changed meanwhile.
+        """
+        with self._lock:
+            if future is not None:
+                self._tree_jobs.pop(entry.name, None)
+                try:
+                    sha256, pieces = future.result()
+                except Exception:
+                    return None
+            if self._entries.get(entry.name) is not entry or sha256 != entry.sha256:
+                return None
+            return self._put_tree(entry, pieces)
+    def name_for_hash(self, sha256: str) -> str:
+        with self._lock:
+            names = self._by_hash.get(sha256)
+            return next(iter(names)) if names else None
+    def describe(self) -> [dict]:
+        """
+        Returns name, size, hash and piece root of every indexed file.
+        """
+        with self._lock:
+            return [e.describe() for e in self._entries.values()]
+    def changes_since(self, epoch: str = None, version: int = None) -> dict:
+        """
+        Returns the file list as a delta against an earlier version of this index.
+
+        If the epoch does not match, meaning the version was handed out by another index or
+        an earlier run, or the change log no longer reaches back to that version, the full
+        list is returned instead.
+
+        Returns:
+        - Dict with the `epoch` and `version` of the list, and either `files` with every
+          entry, or the `since` version the delta applies to, `added` with the new and
+          changed entries and `removed` with the names of the removed files.
+        """
+        with self._lock:
+            if epoch != self.epoch or version is None or version < self._changes_start or version > self.version:
+                return {'epoch': self.epoch, 'version': self.version, 'files': [e.describe() for e in self._entries.values()]}
+            names = set()
+            for change_version, name in reversed(self._changes):
+                if change_version <= version:
+                    break
+                names.add(name)
+            added = [self._entries[name].describe() for name in names if name in self._entries]
+            removed = [name for name in names if name not in self._entries]
+            return {'epoch': self.epoch, 'version': self.version, 'since': version, 'added': added, 'removed': removed}
+
+class FileListReplica:
+    """
+    Copy of a remote peer's file list, kept current with delta FILELIST requests.
+
+    Usage:
+    ```
+    replica = FileListReplica()
+    rsp = request(MessageType.FILELIST, replica.request())
+    replica.apply(rsp.json())
+    entries = replica.entries()
+    ```
+    """
+    def __init__(self) -> None:
+        self.epoch = None
+        self.version = None
+        self.files = {}
+        self._lock = threading.Lock()
+    def request(self) -> dict:
+        """
+        Returns the FILELIST request asking for the changes since the replica's version.
+        """
+        with self._lock:
+            if self.epoch is None:
+                return {}
+            return {'epoch': self.epoch, 'since': self.version}
+    def apply(self, data: dict) -> ([dict], [dict]):
+        """
+        Applies a FILELISTRESPONSE, full or delta.
+
+        Returns:
+        - Tuple (entries removed or replaced, entries added) by the response, or None if
+          the delta starts after the replica's version, meaning changes were missed.
+        """
+        with self._lock:
+            if 'files' in data:
+                removed = list(self.files.values())
+                self.files = {entry['name']: entry for entry in data['files']}
+                added = list(self.files.values())
+            else:
+                if data['epoch'] != self.epoch or data['version'] < self.version:
+                    # A response to an older request, the replica is already ahead of it.
+                    return ([], [])
+                if data.get('since', self.version) > self.version:
+                    return None
+                removed = []
+                for name in data['removed']:
+                    if name in self.files:
+                        removed.append(self.files.pop(name))
+                added = data['added']
+                for entry in added:
+                    if entry['name'] in self.files:
+                        removed.append(self.files[entry['name']])
+                    self.files[entry['name']] = entry
+            self.epoch = data['epoch']
+            self.version = data['version']
+            return (removed, added)
+    def entries(self) -> [dict]:
+        with self._lock:
+            return list(self.files.values())
@@ -0,0 +1,172 @@
+"""
+Leveled, asynchronous logging to log.txt.
+
+log() only compares the level and puts the record on a bounded queue. A single background
+writer formats the messages, %-style with their arguments, so a request path never pays for
+formatting or file I/O. The writer keeps the file open, flushes once the queue is drained,
+and rotates the file when it grows past LOG_MAX_BYTES, keeping LOG_BACKUPS old files. If it
+falls LOG_QUEUE_SIZE records behind, new records are dropped and counted instead of blocking.
+
+Payloads should be logged as a Preview, which is only formatted, and truncated, if the record
+is written.
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+LOG_FILENAME = 'log.txt'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 3
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 256
+PREVIEW_LENGTH = 32
+
+class Preview:
+    """
+    Lazily formatted preview of a payload: its first PREVIEW_LENGTH bytes and its length.
+    """
+    __slots__ = ('data',)
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+    def __str__(self) -> str:
+        head = bytes(self.data[:PREVIEW_LENGTH])
+        more = '...' if len(self.data) > PREVIEW_LENGTH else ''
+        return f'{head!r}{more} ({len(self.data)} bytes)'
+
+class LogWriter:
+    """
+    Background thread writing the queued records to a size-rotated file.
+    """
+    def __init__(self, path: str = LOG_FILENAME, max_bytes: int = LOG_MAX_BYTES, backups: int = LOG_BACKUPS) -> None:
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.dropped = 0
+        self._stream = None
+        self._size = 0
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+    def start(self) -> None:
+        self._thread.start()
+    def put(self, record: tuple) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+    def flush(self) -> None:
+        """
+        Waits until every queued record is written and flushed.
+        """
+        self.queue.join()
+    def _open(self) -> None:
+        self._stream = open(self.path, 'a', encoding='utf-8')
+        self._size = self._stream.tell()
+    def _rotate(self) -> None:
+        self._stream.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self._open()
+    def _write(self, line: str) -> None:
+        if self._size > 0 and self._size + len(line) > self.max_bytes:
+            self._rotate()
+        self._stream.write(line)
+        self._size += len(line)
+    @staticmethod
+    def _format(record: tuple) -> str:
+        created, start, level, msg, args = record
+        if args:
+            msg = msg % args
+        if level != INFO:
+            msg = f'{LEVEL_NAMES.get(level, level)}: {msg}'
+        return f'[{created - start:.3f}s] {msg}\n'
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < LOG_BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                if self._stream is None:
+                    self._open()
+                for record in batch:
+                    try:
+                        self._write(self._format(record))
+                    except (TypeError, ValueError) as e:
+                        self._write(f'[{record[0] - record[1]:.3f}s] ERROR: Bad log record {record[3]!r}: {e}\n')
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    self._write(f'[{time.time() - batch[-1][1]:.3f}s] WARNING: {dropped} log records dropped.\n')
+                self._stream.flush()
+            except OSError:
+                # The log is best effort, a full disk must not take the writer down.
+                self._stream = None
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+_level = INFO
+_writer = None
+_writer_lock = threading.Lock()
+
+def set_level(level: int) -> None:
+    """
+    Sets the minimum level of the records written, INFO by default.
+    """
+    global _level
+    _level = level
+
+def get_writer() -> LogWriter:
+    """
+    Returns the process-wide writer, starting it the first time.
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = LogWriter()
+                writer.start()
+                atexit.register(writer.flush)
+                _writer = writer
+    return _writer
+
+def log(start: float, msg: str, *args, level: int = INFO) -> None:
+    """
+    Logs a message, with the time elapsed since `start`.
+
+    Parameters:
+    - start: Start time of the application, from time.time().
+    - msg: Message, formatted with `args` %-style by the writer.
+    - level: DEBUG, INFO, WARNING or ERROR. Records below the level set with set_level
+      are discarded at once.
+
+    Usage:
+    ```
+    log(start, 'Received message: %s', message, level=DEBUG)
+    ```
+    """
+    if level < _level:
+        return
+    get_writer().put((time.time(), start, level, msg, args))
+
+def flush() -> None:
+    """
+    Waits until every record logged so far is written to the file.
+    """
+    if _writer is not None:
+        _writer.flush()
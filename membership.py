@@ -0,0 +1,315 @@
+"""
+SWIM-style gossip membership.
+
+Instead of sending HELLO to every known peer, each node probes one member per protocol period,
+going round-robin through a shuffled member list. If the member does not answer the PING in
+time, INDIRECT_PROBES other members are asked to probe it with PINGREQ, so a single lost
+packet or a congested link between two nodes does not condemn it. A member nobody could reach
+becomes SUSPECT, not dead: the suspicion is gossiped, and the member has a suspicion timeout,
+growing with the logarithm of the group size, to refute it by gossiping an ALIVE state with a
+higher incarnation number. Only then is it declared DEAD and removed. Only a member raises
+its own incarnation: every message sent to a member we suspect, or believe dead, carries
+that belief, so the member learns of it and refutes it even if the gossip has died down.
+
+Dead members are kept as tombstones for TOMBSTONE_TIMEOUT, so stale gossip about them cannot
+bring them back; members removed by hand ignore all gossip until then.
+
+Membership changes are not sent in dedicated messages: they are piggybacked on the PING,
+PINGREQ and PINGACK messages, each one a logarithmic number of times, so they reach the whole
+group within a few periods while the probe load per node stays constant as the group grows.
+"""
+
+from peer import Peer
+from protocol import MessageType, encode_json
+from fanout import fan_out
+import math
+import random
+import threading
+import time
+
+ALIVE = 'alive'
+SUSPECT = 'suspect'
+DEAD = 'dead'
+PROTOCOL_PERIOD = 1.0
+PING_TIMEOUT = 0.5
+INDIRECT_PROBES = 3
+SUSPICION_MULT = 4
+RETRANSMIT_MULT = 3
+MAX_PIGGYBACK = 8
+TOMBSTONE_TIMEOUT = 60.0
+
+class Member:
+    def __init__(self, uid: str, ip: str, port: int, state: str = ALIVE, incarnation: int = 0) -> None:
+        self.uid = uid
+        self.ip = ip
+        self.port = port
+        self.state = state
+        self.incarnation = incarnation
+        self.suspected_at = None
+        # Set when the member became DEAD, the tombstone is dropped TOMBSTONE_TIMEOUT later.
+        self.dead_at = None
+        # Removed by hand, gossip is ignored until the tombstone is dropped.
+        self.removed = False
+    @property
+    def address(self) -> (str, int):
+        return (self.ip, self.port)
+    def to_update(self) -> list:
+        return [self.uid, self.ip, self.port, self.state, self.incarnation]
+    def __str__(self) -> str:
+        return f'{self.uid} ({self.ip}:{self.port}, {self.state}, incarnation {self.incarnation})'
+
+class Membership:
+    """
+    Membership list and failure detector of one node.
+
+    The node's known peers are the members that are ALIVE or SUSPECT. Members learned through
+    gossip are reported with `on_alive(peer)`, members declared dead with `on_dead(uid)`.
+
+    Usage:
+    ```
+    membership = Membership(uid, port, pool.request, on_alive, on_dead)
+    membership.add(uid, ip, port)
+    membership.tick()  # once per protocol period
+    ```
+    """
+    def __init__(self, uid: str, port: int, request, on_alive, on_dead, period: float = PROTOCOL_PERIOD, log=None) -> None:
+        self.uid = uid
+        self.port = port
+        self.period = period
+        self.incarnation = 0
+        self._request = request
+        self._on_alive = on_alive
+        self._on_dead = on_dead
+        self._log = log or (lambda msg: None)
+        self._members = {}
+        self._updates = {}
+        self._probe_order = []
+        self._lock = threading.Lock()
+    @property
+    def members(self) -> [Member]:
+        with self._lock:
+            return list(self._members.values())
+    def _live(self) -> [Member]:
+        return [m for m in self._members.values() if m.state != DEAD]
+    def _retransmit_limit(self) -> int:
+        return RETRANSMIT_MULT * math.ceil(math.log2(len(self._live()) + 2))
+    def _suspicion_timeout(self) -> float:
+        return SUSPICION_MULT * max(1.0, math.log10(len(self._live()) + 1)) * self.period
+    def _set_dead(self, member: Member) -> None:
+        member.state = DEAD
+        member.suspected_at = None
+        member.dead_at = time.time()
+    def _gossip(self, update: list) -> None:
+        self._updates[update[0]] = [update, self._retransmit_limit()]
+    def _piggyback(self) -> list:
+        """
+        Returns the updates to send with the next message, the least sent first.
+        """
+        with self._lock:
+            selected = sorted(self._updates.values(), key=lambda item: -item[1])[:MAX_PIGGYBACK]
+            for item in selected:
+                item[1] -= 1
+                if item[1] <= 0:
+                    del self._updates[item[0][0]]
+            return [item[0] for item in selected]
+    def add(self, uid: str, ip: str, port: int) -> None:
+        """
+        Adds a member that joined directly, through ADDME or a manual add, and gossips it.
+        """
+        if uid == self.uid:
+            return
+        with self._lock:
+            member = self._members.get(uid)
+            if member is not None and member.state != DEAD and member.address == (ip, port):
+                return
+            incarnation = member.incarnation if member is not None else 0
+            member = Member(uid, ip, port, ALIVE, incarnation)
+            self._members[uid] = member
+            self._gossip(member.to_update())
+    def remove(self, uid: str) -> None:
+        """
+        Forgets a member locally. Gossip about it is ignored until its tombstone is dropped,
+        TOMBSTONE_TIMEOUT later; only add() brings it back before that.
+        """
+        with self._lock:
+            member = self._members.get(uid)
+            if member is not None:
+                self._set_dead(member)
+                member.removed = True
+                self._updates.pop(uid, None)
+    def suspect(self, uid: str) -> None:
+        """
+        Marks a member as SUSPECT, as if it failed a probe.
+        """
+        with self._lock:
+            member = self._members.get(uid)
+            if member is None or member.state != ALIVE:
+                return
+            member.state = SUSPECT
+            member.suspected_at = time.time()
+            self._gossip(member.to_update())
+        self._log(f'Suspecting {member}.')
+    def apply_updates(self, updates: list) -> None:
+        """
+        Merges gossiped updates, following the SWIM precedence rules: a higher incarnation
+        always wins, SUSPECT overrides ALIVE and DEAD overrides both at the same incarnation.
+        """
+        joined = []
+        died = []
+        with self._lock:
+            for update in updates:
+                uid, ip, port, state, incarnation = update
+                if uid == self.uid:
+                    if state != ALIVE and incarnation >= self.incarnation:
+                        # Refute the suspicion with a newer incarnation.
+                        self.incarnation = incarnation + 1
+                        # The address is left out, every member that suspected us knows it.
+                        self._gossip([self.uid, None, self.port, ALIVE, self.incarnation])
+                    continue
+                member = self._members.get(uid)
+                if member is not None and member.removed:
+                    continue
+                if member is None:
+                    if state == DEAD or ip is None:
+                        continue
+                    member = Member(uid, ip, port, state, incarnation)
+                    if state == SUSPECT:
+                        member.suspected_at = time.time()
+                    self._members[uid] = member
+                    self._gossip(update)
+                    joined.append(member)
+                    continue
+                rank = {ALIVE: 0, SUSPECT: 1, DEAD: 2}
+                if incarnation < member.incarnation:
+                    continue
+                if incarnation == member.incarnation and rank[state] <= rank[member.state]:
+                    continue
+                was_dead = member.state == DEAD
+                member.incarnation = incarnation
+                member.state = state
+                if ip is not None:
+                    member.ip = ip
+                    member.port = port
+                member.suspected_at = time.time() if state == SUSPECT else None
+                if state != DEAD:
+                    member.dead_at = None
+                self._gossip(member.to_update())
+                if state == DEAD and not was_dead:
+                    member.dead_at = time.time()
+                    died.append(member)
+                elif state != DEAD and was_dead:
+                    joined.append(member)
+        for member in joined:
+            self._on_alive(Peer(member.uid, member.ip, member.port))
+        for member in died:
+            self._log(f'{member} declared dead by gossip.')
+            self._on_dead(member.uid)
+    def _message(self, to: str = None, **fields) -> bytes:
+        """
+        Returns a membership message with the next updates to piggyback. Sent to the member
+        `to` while we suspect it or believe it dead, it also carries that belief, for the
+        member to refute it.
+        """
+        updates = self._piggyback()
+        with self._lock:
+            member = self._members.get(to) if to is not None else None
+            if member is not None and member.state != ALIVE and not member.removed:
+                updates = [u for u in updates if u[0] != to] + [member.to_update()]
+        fields.update({'uid': self.uid, 'port': self.port, 'updates': updates})
+        return encode_json(fields)
+    def handle_ping(self, ip: str, request: dict) -> bytes:
+        """
+        Processes a PING or PINGREQ sender's piggybacked updates and learns about the sender.
+
+        Returns:
+        - Payload of the PINGACK response.
+        """
+        self.apply_updates(request.get('updates', []))
+        self._heard_from(request['uid'], ip, int(request['port']))
+        return self._message(request['uid'])
+    def handle_pingreq(self, ip: str, request: dict) -> bytes:
+        """
+        Probes the target of a PINGREQ on behalf of the sender.
+
+        Returns:
+        - Payload of the PINGACK response if the target answered, None otherwise.
+        """
+        self.handle_ping(ip, request)
+        uid, target_ip, target_port = request['target']
+        if self._ping((target_ip, target_port), uid):
+            return self._message(request['uid'])
+        return None
+    def _heard_from(self, uid: str, ip: str, port: int) -> None:
+        """
+        Adds a member we did not know that contacted us directly. A member we know is left
+        as it is: if we suspect it or believe it dead, our response tells it so, and it
+        refutes that with a higher incarnation of its own.
+        """
+        if uid == self.uid:
+            return
+        with self._lock:
+            if uid in self._members:
+                return
+        self.apply_updates([[uid, ip, port, ALIVE, 0]])
+    def _ping(self, address: (str, int), uid: str = None) -> bool:
+        try:
+            rsp = self._request(address, MessageType.PING, self._message(uid), PING_TIMEOUT)
+        except Exception:
+            return False
+        if rsp.type != MessageType.PINGACK:
+            return False
+        self.apply_updates(rsp.json().get('updates', []))
+        return True
+    def _pingreq(self, helper: Member, target: Member) -> bool:
+        try:
+            payload = self._message(target=[target.uid, target.ip, target.port])
+            rsp = self._request(helper.address, MessageType.PINGREQ, payload, self.period)
+        except Exception:
+            return False
+        if rsp.type != MessageType.PINGACK:
+            return False
+        self.apply_updates(rsp.json().get('updates', []))
+        return True
+    def _next_target(self) -> Member:
+        with self._lock:
+            while self._probe_order:
+                member = self._members.get(self._probe_order.pop())
+                if member is not None and member.state != DEAD:
+                    return member
+            live = self._live()
+            if not live:
+                return None
+            random.shuffle(live)
+            self._probe_order = [m.uid for m in live]
+            return self._members[self._probe_order.pop()]
+    def tick(self) -> None:
+        """
+        Runs one protocol period: probes one member, directly then indirectly, and declares
+        dead the members whose suspicion timed out.
+        """
+        target = self._next_target()
+        # A suspect that answers is not cleared here: the PING told it of the suspicion,
+        # and its refutation, with a higher incarnation, reaches every member by gossip.
+        if target is not None and not self._ping(target.address, target.uid):
+            with self._lock:
+                helpers = [m for m in self._live() if m.uid != target.uid and m.state == ALIVE]
+            helpers = random.sample(helpers, min(INDIRECT_PROBES, len(helpers)))
+            reached = any(ok for _, ok, _ in fan_out(lambda helper: self._pingreq(helper, target), helpers, deadline=self.period))
+            if not reached:
+                self.suspect(target.uid)
+        self._expire_suspects()
+    def _expire_suspects(self) -> None:
+        now = time.time()
+        timeout = self._suspicion_timeout()
+        died = []
+        with self._lock:
+            for member in list(self._members.values()):
+                if member.state == SUSPECT and now - member.suspected_at > timeout:
+                    self._set_dead(member)
+                    self._gossip(member.to_update())
+                    died.append(member)
+                elif member.state == DEAD and now - member.dead_at > TOMBSTONE_TIMEOUT:
+                    del self._members[member.uid]
+        for member in died:
+            self._log(f'{member} declared dead, suspicion timed out.')
+            self._on_dead(member.uid)
@@ -1,4 +1,6 @@
 from enum import Enum
+from downloads import QUEUED, RUNNING, DONE, FAILED, CANCELLED, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+import fnmatch
 import os
 
 class MenuState(Enum):
@@ -16,6 +18,8 @@ class MenuState(Enum):
     SYSTEMINFO = 11
     PEERUPDATE = 12
     FILELISTREMOTE = 13
+    UPLOADLIMITS = 14
+    DOWNLOADS = 15
     
 
 class Menu:
@@ -36,8 +40,9 @@ class Menu:
         print('1 - Gerenciamento de Pares')
         print('2 - Gerenciamento de Arquivos')
         print('3 - Informações do Sistema')
+        print('4 - Limites de Upload')
         print('0 - Sair')
-        return Menu.read_option(3, True)
+        return Menu.read_option(4, True)
     @staticmethod
     def menu_peermanagement(ctx: 'Application') -> int:
         print('1 - Listar Pares')
@@ -52,8 +57,9 @@ class Menu:
         print('2 - Listar Arquivos Remotos')
         print('3 - Receber Arquivo na Rede')
         print('4 - Definir Pasta de Arquivos')
+        print('5 - Downloads')
         print('0 - Voltar')
-        return Menu.read_option(4, True)
+        return Menu.read_option(5, True)
     @staticmethod
     def menu_addpeer(ctx: 'Application') -> int:
         print('1 - Adicionar Par Manualmente')
@@ -75,8 +81,16 @@ class Menu:
         if len(ctx.known_peers) == 0:
             print('\tNenhum par conhecido.')
         else:
-            for peer in ctx.known_peers.values():
-                print(f'\t{peer}')
+            # Best ranked first, with the figures the ranking is based on.
+            for peer in ctx.rank_peers():
+                record = ctx.peer_stats.get((peer.ip, peer.port))
+                if record is None:
+                    print(f'\t{peer}: sem medições')
+                    continue
+                rtt = '-' if record.rtt is None else f'{record.rtt * 1000:.1f} ms'
+                throughput = '-' if record.throughput is None else f'{record.throughput / 1024 / 1024:.2f} MiB/s'
+                health = '' if record.healthy else ', sem resposta'
+                print(f'\t{peer}: RTT {rtt}, vazão {throughput}, erros {record.error_rate * 100:.0f}%{health}')
         print('0 - Voltar')
         return Menu.read_option(0, True)
     @staticmethod
@@ -93,24 +107,48 @@ class Menu:
     @staticmethod
     def menu_receivefilefromnetwork(ctx: 'Application') -> int:
         skip = False
-        print('Digite o nome do arquivo desejado:')
+        print('Digite o nome do arquivo desejado, ou um padrão como *.txt:')
         print(f'Pasta atual: \"{ctx.file_dir}\"')
         filename = input()
         if filename == '':
             skip = True
         
+        if skip != True and any(c in filename for c in '*?['):
+            skip = True
+            # A glob pattern: fetch every matching file in one batch, from the peer holding most,
+            # the best ranked one among those holding as many.
+            print("Buscando arquivos na rede...")
+            matches = {}
+            for peeruid, files in ctx.list_files_on_network().items():
+                count = sum(1 for file in files if fnmatch.fnmatchcase(file['name'], filename))
+                if count > 0:
+                    matches[peeruid] = count
+            if len(matches) == 0:
+                print('Nenhum arquivo encontrado na rede.')
+            else:
+                ranked = [peer.uid for peer in ctx.rank_peers() if peer.uid in matches]
+                peeruid = max(ranked or matches, key=matches.get)
+                print(f'{matches[peeruid]} arquivo(s) encontrado(s) no par {peeruid}.')
+                try:
+                    result = ctx.receive_files_from_network(peeruid, [filename])
+                    print(f'Arquivos recebidos com sucesso: {result}')
+                except Exception as e:
+                    print(f'Erro ao receber arquivos: {e}')
         if skip != True:
             print("Buscando arquivo na rede...")
-            filemap = ctx.list_files_on_network()
-            found = False
-            for peeruid, files in filemap.items():
-                for file in files:
-                    if file == filename:
-                        found = True
-                        print(f'Arquivo encontrado no par {peeruid}.')
-                        print('Recebendo arquivo...')
-                        ctx.receive_file_from_network(peeruid, filename)
-                        print('Arquivo recebido com sucesso.')
+            # The version of the file held by the most peers, from every peer holding it.
+            file, holders = ctx.find_sources(filename)
+            for peeruid in holders:
+                print(f'Arquivo encontrado no par {peeruid}.')
+            if len(holders) == 0:
+                print('Arquivo não encontrado na rede.')
+            else:
+                # Downloaded in the background, see Downloads.
+                try:
+                    job = ctx.downloads.add(filename, file['sha256'])
+                    print(f'Download {job.id} adicionado à fila, acompanhe em Downloads.')
+                except Exception as e:
+                    print(f'Erro ao adicionar download: {e}')
                 
         print('0 - Voltar')
         return Menu.read_option(0, True)
@@ -191,6 +229,84 @@ class Menu:
         print(f'\tPares Conhecidos: {len(ctx.known_peers)}')
         print(f'\tArquivos Disponíveis: {len(ctx.files)}')
         print(f'\tPasta de Arquivos: \"{ctx.file_dir}\"')
+        def describe_latency(seconds) -> str:
+            return '-' if seconds is None else f'{seconds * 1000:.1f} ms'
+        summary = ctx.metrics.summary()
+        print(f'\tBytes Recebidos: {summary["received"]}')
+        print(f'\tBytes Enviados: {summary["sent"]}')
+        for title, group in (('Requisições Atendidas', summary['requests']), ('Requisições Enviadas', summary['rpcs'])):
+            print(f'\t{title}:')
+            for name, entry in sorted(group.items()):
+                print(f'\t\t{name}: {entry["count"]} ({entry["errors"]} erros), p50 {describe_latency(entry["p50"])}, p99 {describe_latency(entry["p99"])}')
+        print('0 - Voltar')
+        return Menu.read_option(0, True)
+    @staticmethod
+    def menu_downloads(ctx: 'Application') -> int:
+        states = {QUEUED: 'na fila', RUNNING: 'recebendo', DONE: 'concluído', FAILED: 'falhou', CANCELLED: 'cancelado'}
+        priorities = {PRIORITY_HIGH: 'alta', PRIORITY_NORMAL: 'normal', PRIORITY_LOW: 'baixa'}
+        jobs = ctx.downloads.jobs()
+        print(f'Downloads ({ctx.downloads.active} em andamento, até {ctx.downloads.slots} simultâneos e {ctx.downloads.peer_slots} por par):')
+        if len(jobs) == 0:
+            print('\tNenhum download.')
+        for job in jobs:
+            progress = f'{job.received} bytes' if job.progress is None else f'{job.progress * 100:.1f}%'
+            line = f'\t{job.id} - {job.filename}: {states.get(job.state, job.state)}, prioridade {priorities.get(job.priority, job.priority)}'
+            if job.state == RUNNING:
+                line += f', {progress} a {job.rate / 1024 / 1024:.2f} MiB/s de {len(job.sources)} par(es)'
+            elif job.state == QUEUED and job.error is not None:
+                line += f', tentativa {job.attempts} falhou: {job.error}'
+            elif job.state == FAILED:
+                line += f': {job.error}'
+            print(line)
+        print('1 - Atualizar')
+        print('2 - Cancelar Download')
+        print('3 - Alterar Prioridade')
+        print('4 - Limpar Finalizados')
+        print('0 - Voltar')
+        option = Menu.read_option(4, True)
+        try:
+            if option == 2:
+                if not ctx.downloads.cancel(int(input('ID do download: '))):
+                    print('Download não encontrado ou já finalizado.')
+            elif option == 3:
+                job_id = int(input('ID do download: '))
+                priority = int(input('Prioridade (0 - alta, 1 - normal, 2 - baixa): '))
+                if priority not in priorities:
+                    print('Prioridade inválida.')
+                elif not ctx.downloads.set_priority(job_id, priority):
+                    print('Download não encontrado ou já finalizado.')
+            elif option == 4:
+                ctx.downloads.clear_finished()
+        except ValueError:
+            print('Valor inválido.')
+        return option
+    @staticmethod
+    def menu_uploadlimits(ctx: 'Application') -> int:
+        def read_limit(prompt: str, current):
+            while True:
+                value = input(prompt)
+                if value == '':
+                    return current
+                try:
+                    value = int(value)
+                    if value < 0:
+                        raise ValueError
+                    return value
+                except ValueError:
+                    print('Valor inválido. Tente novamente.')
+        def describe_rate(rate) -> str:
+            return 'sem limite' if not rate else f'{rate // 1024} KiB/s'
+        limits = ctx.uploads.limits()
+        print('Limites de Upload:')
+        print(f'\tEnvios simultâneos: {limits["slots"]} ({ctx.uploads.active} em andamento, {ctx.uploads.queued} na fila)')
+        print(f'\tBanda total: {describe_rate(limits["rate"])}')
+        print(f'\tBanda por par: {describe_rate(limits["peer_rate"])}')
+        print('Digite os novos limites (vazio mantém o atual, 0 remove o limite de banda):')
+        slots = max(1, read_limit('Envios simultâneos: ', limits['slots']))
+        rate = read_limit('Banda total (KiB/s): ', (limits['rate'] or 0) // 1024) * 1024
+        peer_rate = read_limit('Banda por par (KiB/s): ', (limits['peer_rate'] or 0) // 1024) * 1024
+        ctx.set_upload_limits(slots, rate or None, peer_rate or None)
+        print('Limites atualizados.')
         print('0 - Voltar')
         return Menu.read_option(0, True)
     @staticmethod
@@ -213,6 +329,6 @@ class Menu:
                     print('\tNenhum arquivo disponível.')
                 else:
                     for file in files:
-                        print(f'\t{file}')
+                        print(f'\t{file["name"]} ({file["size"]} bytes)')
         print('0 - Voltar')
         return Menu.read_option(0, True)
\ No newline at end of file
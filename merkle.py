@@ -0,0 +1,96 @@
+"""
+Merkle trees of piece hashes.
+
+A file is split into PIECE_SIZE pieces, each hashed with SHA-256, and the piece hashes are
+the leaves of a binary hash tree whose root stands for the whole list. The root is computed
+with the content hash when a file is indexed and advertised next to it in the file lists.
+A downloader fetches the piece hashes from a holder with PIECEHASHES and only uses them if
+they match the root every holder of the content hash advertised; it then checks every
+piece as it lands, so a corrupt piece is fetched again on its own, preferably from another
+peer, instead of the whole file. The SHA-256 of the whole file is still checked at the end.
+
+Leaves and inner nodes are hashed with different prefixes, so a list of inner nodes can
+never pass for a list of pieces. An odd node at the end of a level is promoted unchanged.
+"""
+
+import hashlib
+
+PIECE_SIZE = 1024 * 1024
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+def hash_file_pieces(path: str, piece_size: int = PIECE_SIZE) -> (str, [str]):
+    """
+    Returns the hex SHA-256 of a whole file and of every piece of it, the last one possibly
+    shorter, read in a single pass.
+    """
+    digest = hashlib.sha256()
+    pieces = []
+    buf = bytearray(piece_size)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+            pieces.append(hashlib.sha256(view[:n]).hexdigest())
+    return (digest.hexdigest(), pieces)
+
+def merkle_root(pieces: [str]) -> str:
+    """
+    Returns the hex root of the tree over a list of hex piece hashes.
+    """
+    level = [hashlib.sha256(LEAF_PREFIX + bytes.fromhex(h)).digest() for h in pieces]
+    if not level:
+        return hashlib.sha256(LEAF_PREFIX).hexdigest()
+    while len(level) > 1:
+        parents = [hashlib.sha256(NODE_PREFIX + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0].hex()
+
+class PieceTree:
+    """
+    The piece hashes of one version of a file.
+
+    Usage:
+    ```
+    tree = PieceTree.from_dict(rsp.json())
+    for index in tree.pieces_in(start, end):
+        ok = tree.verify(index, data)
+    ```
+    """
+    def __init__(self, size: int, piece_size: int, pieces: [str], root: str = None) -> None:
+        """
+        Raises ValueError if the number of pieces does not match the size, or the pieces
+        do not match the given root.
+        """
+        if piece_size <= 0 or size < 0 or len(pieces) != (size + piece_size - 1) // piece_size:
+            raise ValueError('Piece hashes do not match the file size.')
+        self.size = size
+        self.piece_size = piece_size
+        self.pieces = pieces
+        self.root = merkle_root(pieces)
+        if root is not None and root != self.root:
+            raise ValueError('Piece hashes do not match the root.')
+    @classmethod
+    def from_dict(cls, data: dict) -> 'PieceTree':
+        return cls(int(data['size']), int(data['piece_size']), list(data['pieces']), data['root'])
+    def to_dict(self) -> dict:
+        return {'size': self.size, 'piece_size': self.piece_size, 'root': self.root, 'pieces': self.pieces}
+    def __len__(self) -> int:
+        return len(self.pieces)
+    def piece_range(self, index: int) -> (int, int):
+        start = index * self.piece_size
+        return (start, min(start + self.piece_size, self.size))
+    def pieces_in(self, start: int, end: int) -> range:
+        """
+        Returns the indices of the pieces lying entirely within [start, end).
+        """
+        first = (start + self.piece_size - 1) // self.piece_size
+        last = len(self.pieces) if end >= self.size else end // self.piece_size
+        return range(first, max(first, last))
+    def verify(self, index: int, data) -> bool:
+        return hashlib.sha256(data).hexdigest() == self.pieces[index]
@@ -0,0 +1,246 @@
+"""
+Counters and latency histograms of the node.
+
+Every request served is counted per message type and outcome, its handler latency goes
+into a histogram per type, and its bytes in and out are counted per client address. Every
+outbound RPC is recorded the same way, per peer address, and so are the bytes of file
+transfers. Inbound traffic is keyed by the client's IP only, since its port is ephemeral;
+outbound traffic is keyed by the peer's listening "ip:port".
+
+Histograms have fixed buckets, so recording a sample is a bisect and a few dict updates
+under one lock, cheap enough to stay on. Percentiles are estimated from the buckets.
+
+The metrics are exposed in the Prometheus text format, written to a file or served over
+HTTP, as JSON in response to a STATS message, and summarized in the system info menu.
+"""
+
+import bisect
+import http.server
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Past this many peer labels, new peers are counted under OTHER_PEER.
+MAX_PEER_LABELS = 256
+OTHER_PEER = 'other'
+METRIC_HELP = {
+    'p2p_requests_total': ('counter', 'Requests served, by message type and outcome.'),
+    'p2p_request_seconds': ('histogram', 'Time spent handling requests, by message type.'),
+    'p2p_rpcs_total': ('counter', 'Outbound RPCs, by message type and outcome.'),
+    'p2p_rpc_seconds': ('histogram', 'Round-trip time of outbound RPCs, by message type.'),
+    'p2p_peer_rpcs_total': ('counter', 'Outbound RPCs, by peer and outcome.'),
+    'p2p_received_bytes_total': ('counter', 'Bytes received, by peer.'),
+    'p2p_sent_bytes_total': ('counter', 'Bytes sent, by peer.'),
+    'p2p_uptime_seconds': ('gauge', 'Seconds since the node started.'),
+}
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        # The last count is the +Inf bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    def quantile(self, q: float) -> float:
+        """
+        Estimates the q-quantile by interpolating within its bucket, None without samples.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                low = self.buckets[i - 1] if i > 0 else 0.0
+                return low + (self.buckets[i] - low) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+    def to_dict(self) -> dict:
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+class Metrics:
+    """
+    Metrics registry of one node. Safe to use from any thread.
+
+    Usage:
+    ```
+    metrics = Metrics()
+    metrics.observe_request('HELLO', '10.0.0.2', 0.0004, 16, 16, True)
+    metrics.observe_rpc('PING', '10.0.0.3:5000', 0.002, True, 120, 80)
+    text = metrics.to_prometheus()
+    ```
+    """
+    def __init__(self) -> None:
+        self.start = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._peers = set()
+        self._lock = threading.Lock()
+    def _peer(self, peer: str) -> str:
+        if peer not in self._peers:
+            if len(self._peers) >= MAX_PEER_LABELS:
+                return OTHER_PEER
+            self._peers.add(peer)
+        return peer
+    def _inc(self, name: str, labels: tuple, value: int = 1) -> None:
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+    def _observe(self, name: str, labels: tuple, value: float) -> None:
+        histogram = self._histograms.get((name, labels))
+        if histogram is None:
+            histogram = self._histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+    def observe_request(self, msg_type: str, peer: str, seconds: float, received: int, sent: int, ok: bool) -> None:
+        """
+        Records a request served to `peer`, the client's IP.
+        """
+        outcome = 'ok' if ok else 'error'
+        with self._lock:
+            peer = self._peer(peer)
+            self._inc('p2p_requests_total', (('type', msg_type), ('outcome', outcome)))
+            self._observe('p2p_request_seconds', (('type', msg_type),), seconds)
+            self._inc('p2p_received_bytes_total', (('peer', peer),), received)
+            self._inc('p2p_sent_bytes_total', (('peer', peer),), sent)
+    def observe_rpc(self, msg_type: str, peer: str, seconds: float, ok: bool, sent: int = 0, received: int = 0) -> None:
+        """
+        Records an outbound RPC to `peer`, "ip:port".
+        """
+        outcome = 'ok' if ok else 'error'
+        with self._lock:
+            peer = self._peer(peer)
+            self._inc('p2p_rpcs_total', (('type', msg_type), ('outcome', outcome)))
+            self._inc('p2p_peer_rpcs_total', (('peer', peer), ('outcome', outcome)))
+            if ok:
+                self._observe('p2p_rpc_seconds', (('type', msg_type),), seconds)
+            self._inc('p2p_sent_bytes_total', (('peer', peer),), sent)
+            self._inc('p2p_received_bytes_total', (('peer', peer),), received)
+    def add_transfer(self, peer: str, received: int = 0, sent: int = 0) -> None:
+        """
+        Records the bytes of a file transfer with `peer`, "ip:port".
+        """
+        with self._lock:
+            peer = self._peer(peer)
+            self._inc('p2p_received_bytes_total', (('peer', peer),), received)
+            self._inc('p2p_sent_bytes_total', (('peer', peer),), sent)
+    def snapshot(self) -> dict:
+        """
+        Returns every metric as a JSON-serializable dict, the payload of STATSRESPONSE.
+        """
+        with self._lock:
+            counters = [[name, dict(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, dict(labels), h.to_dict()] for (name, labels), h in self._histograms.items()]
+        return {'uptime': time.time() - self.start, 'counters': counters, 'histograms': histograms}
+    def summary(self) -> dict:
+        """
+        Returns per message type figures of the requests served and the RPCs sent.
+
+        Returns:
+        - Dict {'requests': {type: {...}}, 'rpcs': {type: {...}}, 'received', 'sent'}, each
+          type with its count, errors, and p50 and p99 latency in seconds.
+        """
+        result = {'requests': {}, 'rpcs': {}, 'received': 0, 'sent': 0}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                labels = dict(labels)
+                if name in ('p2p_requests_total', 'p2p_rpcs_total'):
+                    group = result['requests' if name == 'p2p_requests_total' else 'rpcs']
+                    entry = group.setdefault(labels['type'], {'count': 0, 'errors': 0, 'p50': None, 'p99': None})
+                    entry['count'] += value
+                    if labels['outcome'] != 'ok':
+                        entry['errors'] += value
+                elif name == 'p2p_received_bytes_total':
+                    result['received'] += value
+                elif name == 'p2p_sent_bytes_total':
+                    result['sent'] += value
+            for (name, labels), histogram in self._histograms.items():
+                group = result['requests' if name == 'p2p_request_seconds' else 'rpcs']
+                entry = group.get(dict(labels)['type'])
+                if entry is not None:
+                    entry['p50'] = histogram.quantile(0.5)
+                    entry['p99'] = histogram.quantile(0.99)
+        return result
+    def to_prometheus(self) -> str:
+        """
+        Returns every metric in the Prometheus text exposition format.
+
+        Series are sorted by their labels; the lines of a histogram series stay in their
+        order, buckets by increasing bound, then the sum and the count.
+        """
+        families = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                families.setdefault(name, []).append((labels, [f'{name}{_format_labels(labels)} {value}']))
+            for (name, labels), h in self._histograms.items():
+                lines = []
+                families.setdefault(name, []).append((labels, lines))
+                cumulative = 0
+                for bound, n in zip(h.buckets + ('+Inf',), h.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {h.sum}')
+                lines.append(f'{name}_count{_format_labels(labels)} {h.count}')
+        families['p2p_uptime_seconds'] = [((), [f'p2p_uptime_seconds {time.time() - self.start:.3f}'])]
+        out = []
+        for name in sorted(families):
+            kind, help = METRIC_HELP.get(name, ('untyped', name))
+            out.append(f'# HELP {name} {help}')
+            out.append(f'# TYPE {name} {kind}')
+            for labels, lines in sorted(families[name], key=lambda series: series[0]):
+                out.extend(lines)
+        return '\n'.join(out) + '\n'
+    def write_prometheus(self, path: str) -> None:
+        """
+        Writes the metrics to a file, atomically, for a collector like node_exporter's
+        textfile collector.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+class MetricsServer:
+    """
+    Serves the metrics in the Prometheus text format over HTTP, at any path.
+
+    Usage:
+    ```
+    server = MetricsServer(metrics, 9100)
+    server.start()
+    server.stop()
+    ```
+    """
+    def __init__(self, metrics: Metrics, port: int, host: str = '') -> None:
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format: str, *args) -> None:
+                pass
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics-http', daemon=True)
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+    def start(self) -> None:
+        self._thread.start()
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
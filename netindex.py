@@ -0,0 +1,150 @@
+"""
+Cache of the file lists of the other peers.
+
+Each peer's list is kept as a FileListReplica. It is fetched with a SUBSCRIBE request, kept
+current by the FILELISTUPDATE pushes of the peer, and the subscription is renewed in the
+background. An inverted index maps every file name, and every content hash, to the
+peers holding it, so searches are answered from memory. Lists that could not be refreshed
+for NETINDEX_TTL seconds are dropped, and when the cache holds more than NETINDEX_MAX_ENTRIES
+entries the least recently refreshed peers are evicted.
+"""
+
+from fileindex import FileListReplica
+import threading
+import time
+
+NETINDEX_TTL = 60.0
+NETINDEX_MAX_ENTRIES = 1000000
+
+class NetworkIndex:
+    """
+    Usage:
+    ```
+    index = NetworkIndex()
+    payload = index.replica(uid).request()
+    index.apply(uid, rsp.json())
+    holders = index.lookup_name('file.txt')
+    ```
+    """
+    def __init__(self, ttl: float = NETINDEX_TTL, max_entries: int = NETINDEX_MAX_ENTRIES) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._replicas = {}
+        self._fetched = {}
+        self._subscribed = {}
+        self._by_name = {}
+        self._by_hash = {}
+        self._entries = 0
+        self._lock = threading.Lock()
+    def replica(self, uid: str) -> FileListReplica:
+        with self._lock:
+            return self._replicas.setdefault(uid, FileListReplica())
+    def age(self, uid: str) -> float:
+        """
+        Returns the seconds since the peer's list was last refreshed, infinite if never.
+        """
+        fetched = self._fetched.get(uid)
+        if fetched is None:
+            return float('inf')
+        return time.time() - fetched
+    def needs_refresh(self, uid: str, max_age: float) -> bool:
+        """
+        Returns True if the peer's list, or the subscription to it, is older than `max_age`.
+        """
+        subscribed = self._subscribed.get(uid)
+        return self.age(uid) > max_age or subscribed is None or time.time() - subscribed > max_age
+    def _index(self, uid: str, entry: dict) -> None:
+        self._by_name.setdefault(entry['name'], {})[uid] = entry
+        if entry.get('sha256') is not None:
+            self._by_hash.setdefault(entry['sha256'], {}).setdefault(uid, set()).add(entry['name'])
+        self._entries += 1
+    def _unindex(self, uid: str, entry: dict) -> None:
+        holders = self._by_name.get(entry['name'], {})
+        if holders.pop(uid, None) is not None:
+            self._entries -= 1
+        if not holders:
+            self._by_name.pop(entry['name'], None)
+        if entry.get('sha256') is not None:
+            holders = self._by_hash.get(entry['sha256'], {})
+            names = holders.get(uid, set())
+            names.discard(entry['name'])
+            if not names:
+                holders.pop(uid, None)
+            if not holders:
+                self._by_hash.pop(entry['sha256'], None)
+    def apply(self, uid: str, data: dict, subscribed: bool = False) -> bool:
+        """
+        Applies a peer's FILELISTRESPONSE or FILELISTUPDATE to its replica and to the
+        inverted index. `subscribed` tells the response also renewed the subscription.
+
+        Returns:
+        - False if the delta could not be applied because earlier changes were missed. The
+          peer's list is then marked stale, so the next refresh catches up.
+        """
+        with self._lock:
+            replica = self._replicas.setdefault(uid, FileListReplica())
+            changes = replica.apply(data)
+            if changes is None:
+                self._fetched.pop(uid, None)
+                return False
+            removed, added = changes
+            for entry in removed:
+                self._unindex(uid, entry)
+            for entry in added:
+                self._index(uid, entry)
+            self._fetched[uid] = time.time()
+            if subscribed:
+                self._subscribed[uid] = self._fetched[uid]
+            self._evict(uid)
+            return True
+    def _drop(self, uid: str) -> None:
+        replica = self._replicas.pop(uid, None)
+        self._fetched.pop(uid, None)
+        self._subscribed.pop(uid, None)
+        if replica is not None:
+            for entry in replica.entries():
+                self._unindex(uid, entry)
+    def _evict(self, keep: str) -> None:
+        if self._entries <= self.max_entries:
+            return
+        for uid in sorted(self._fetched, key=self._fetched.get):
+            if uid == keep:
+                continue
+            self._drop(uid)
+            if self._entries <= self.max_entries:
+                return
+    def drop(self, uid: str) -> None:
+        with self._lock:
+            self._drop(uid)
+    def expire(self, known_uids=None) -> None:
+        """
+        Drops the lists older than the TTL, and those of peers not in `known_uids` if given.
+        """
+        with self._lock:
+            for uid in list(self._replicas):
+                if self.age(uid) > self.ttl or (known_uids is not None and uid not in known_uids):
+                    self._drop(uid)
+    def _fresh(self, holders: dict) -> dict:
+        return {uid: value for uid, value in holders.items() if self.age(uid) <= self.ttl}
+    def lookup_name(self, name: str) -> dict:
+        """
+        Returns:
+        - Dict of peer uid to its entry for the file with this name.
+        """
+        with self._lock:
+            return self._fresh(self._by_name.get(name, {}))
+    def lookup_hash(self, sha256: str) -> dict:
+        """
+        Returns:
+        - Dict of peer uid to one of its entries with this content hash, whatever the name.
+        """
+        with self._lock:
+            holders = self._fresh(self._by_hash.get(sha256, {}))
+            return {uid: self._by_name[next(iter(names))][uid] for uid, names in holders.items()}
+    def snapshot(self) -> dict:
+        """
+        Returns:
+        - Dict of peer uid to its file entries, for every peer with a fresh list.
+        """
+        with self._lock:
+            return {uid: replica.entries() for uid, replica in self._replicas.items() if self.age(uid) <= self.ttl and uid in self._fetched}
@@ -2,8 +2,30 @@
 This project aims to create a Peer-to-Peer (P2P) application in Python using sockets for the Computer Networks discipline. The application will allow connection between at least 5 devices, facilitating the exchange of files and checking the availability of desired files on the network.
 """
 
-from app import Application
+from app import Application, ENGINES
+from throttle import UPLOAD_SLOTS
+from downloads import DOWNLOAD_SLOTS, PEER_DOWNLOAD_SLOTS
+import logger
+import argparse
 
 if __name__ == '__main__':
-    app = Application()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=ENGINES, default='threaded', help='networking engine')
+    parser.add_argument('--dht', action='store_true', help='join the DHT overlay for file lookup')
+    parser.add_argument('--upload-slots', type=int, default=UPLOAD_SLOTS, help='number of files sent at once')
+    parser.add_argument('--upload-rate', type=int, default=0, help='upload bandwidth limit in KiB/s, 0 for unlimited')
+    parser.add_argument('--peer-upload-rate', type=int, default=0, help='upload bandwidth limit per peer in KiB/s, 0 for unlimited')
+    parser.add_argument('--download-slots', type=int, default=DOWNLOAD_SLOTS, help='number of queued downloads run at once')
+    parser.add_argument('--peer-download-slots', type=int, default=PEER_DOWNLOAD_SLOTS, help='number of queued downloads run at once from the same peer')
+    parser.add_argument('--metrics-file', help='file the metrics are written to in the Prometheus text format')
+    parser.add_argument('--metrics-port', type=int, help='port serving the metrics over HTTP in the Prometheus text format')
+    parser.add_argument('--log-level', choices=logger.LEVELS, default='info', help='minimum level of the messages written to log.txt')
+    args = parser.parse_args()
+    logger.set_level(logger.LEVELS[args.log_level])
+    app = Application(
+        engine=args.engine, dht=args.dht, upload_slots=args.upload_slots,
+        upload_rate=args.upload_rate * 1024 or None, peer_upload_rate=args.peer_upload_rate * 1024 or None,
+        metrics_file=args.metrics_file, metrics_port=args.metrics_port,
+        download_slots=args.download_slots, peer_download_slots=args.peer_download_slots,
+    )
     app.run()
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Per-peer round-trip time, throughput and error rate, and the ranking built on them.
+
+Every RPC sent over the connection pool or the asyncio engine records its round-trip time,
+or its failure, for the peer's address; every file transfer records its throughput. The
+figures are exponentially weighted moving averages, so they follow a peer whose link or
+load changes while remembering more than the last sample. A peer that answered with an
+error still answered: its round trip counts and it is not a failure.
+
+The ranking orders candidate peers by the time a request is expected to take: the RTT for
+a small RPC, plus the transfer time at the peer's throughput for a download, divided by the
+chance of success. Peers that failed UNHEALTHY_FAILURES times in a row come last whatever
+their figures. A peer without samples is given the median of the other candidates, so it
+is tried before the slow peers and gets the chance to be measured. Ties keep the order of
+the candidates.
+
+Usage:
+```
+stats = PeerStats()
+stats.record_rpc(('10.0.0.2', 5000), True, 0.004)
+stats.record_transfer(('10.0.0.2', 5000), 8 * 1024 * 1024, 0.9)
+peers = stats.rank(peers, size=8 * 1024 * 1024)
+```
+"""
+
+import threading
+import time
+
+RTT_ALPHA = 0.2
+THROUGHPUT_ALPHA = 0.3
+ERROR_ALPHA = 0.1
+# Transfers smaller than this measure the round trip more than the bandwidth.
+THROUGHPUT_MIN_BYTES = 64 * 1024
+UNHEALTHY_FAILURES = 3
+# Caps the retry factor 1 / (1 - error rate) of the expected time.
+MAX_ERROR_RATE = 0.9
+# Past this many addresses, the one updated least recently is forgotten.
+MAX_TRACKED_PEERS = 1024
+
+def _ewma(average: float, sample: float, alpha: float) -> float:
+    return sample if average is None else average + alpha * (sample - average)
+
+def _median(values: [float]) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+class PeerRecord:
+    """
+    Moving averages of one peer's RTT in seconds, throughput in bytes per second and
+    error rate, None until measured.
+    """
+    def __init__(self) -> None:
+        self.rtt = None
+        self.throughput = None
+        self.error_rate = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_success = None
+        self.last_update = time.time()
+    @property
+    def healthy(self) -> bool:
+        return self.consecutive_failures < UNHEALTHY_FAILURES
+    def record(self, ok: bool) -> None:
+        self.last_update = time.time()
+        self.error_rate = _ewma(self.error_rate, 0.0 if ok else 1.0, ERROR_ALPHA)
+        if ok:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.last_success = self.last_update
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+    def to_dict(self) -> dict:
+        return {
+            'rtt': self.rtt, 'throughput': self.throughput, 'error_rate': self.error_rate,
+            'successes': self.successes, 'failures': self.failures, 'healthy': self.healthy,
+        }
+
+class PeerStats:
+    """
+    PeerRecord of every peer address contacted. Safe to use from any thread.
+    """
+    def __init__(self, max_peers: int = MAX_TRACKED_PEERS) -> None:
+        self.max_peers = max_peers
+        self._records = {}
+        self._lock = threading.Lock()
+    def _record(self, address: (str, int)) -> PeerRecord:
+        address = tuple(address)
+        record = self._records.get(address)
+        if record is None:
+            if len(self._records) >= self.max_peers:
+                oldest = min(self._records, key=lambda a: self._records[a].last_update)
+                del self._records[oldest]
+            record = self._records[address] = PeerRecord()
+        return record
+    def record_rpc(self, address: (str, int), ok: bool, rtt: float = None) -> None:
+        """
+        Records an RPC to the peer at `address`, with its round-trip time if it succeeded.
+        """
+        with self._lock:
+            record = self._record(address)
+            record.record(ok)
+            if ok and rtt is not None:
+                record.rtt = _ewma(record.rtt, rtt, RTT_ALPHA)
+    def record_transfer(self, address: (str, int), size: int, seconds: float, ok: bool = True) -> None:
+        """
+        Records `size` bytes received from the peer at `address` in `seconds`. The
+        throughput is only updated by transfers of at least THROUGHPUT_MIN_BYTES.
+        """
+        with self._lock:
+            record = self._record(address)
+            record.record(ok)
+            if size >= THROUGHPUT_MIN_BYTES and seconds > 0:
+                record.throughput = _ewma(record.throughput, size / seconds, THROUGHPUT_ALPHA)
+    def get(self, address: (str, int)) -> PeerRecord:
+        with self._lock:
+            return self._records.get(tuple(address))
+    def forget(self, address: (str, int)) -> None:
+        with self._lock:
+            self._records.pop(tuple(address), None)
+    def snapshot(self) -> dict:
+        """
+        Returns a dict of "ip:port" to the figures of the peer, see PeerRecord.to_dict.
+        """
+        with self._lock:
+            return {f'{a[0]}:{a[1]}': r.to_dict() for a, r in self._records.items()}
+    def rank(self, peers: list, size: int = None) -> list:
+        """
+        Orders peers from the fastest healthy one to the slowest or failing one.
+
+        Parameters:
+        - peers: Peer objects, or anything with `ip` and `port`.
+        - size: Bytes to be downloaded from the peer, None for a small RPC ranked by RTT.
+
+        Returns:
+        - New list of the same peers.
+        """
+        with self._lock:
+            records = [self._records.get((peer.ip, peer.port)) for peer in peers]
+        measured = [r for r in records if r is not None]
+        default_rtt = _median([r.rtt for r in measured if r.rtt is not None])
+        default_throughput = _median([r.throughput for r in measured if r.throughput is not None])
+        def key(i: int):
+            record = records[i]
+            if record is None:
+                record = PeerRecord()
+            rtt = record.rtt if record.rtt is not None else default_rtt
+            expected = rtt or 0.0
+            if size:
+                throughput = record.throughput if record.throughput is not None else default_throughput
+                if throughput:
+                    expected += size / throughput
+            expected /= 1.0 - min(record.error_rate, MAX_ERROR_RATE)
+            return (not record.healthy, expected, i)
+        return [peers[i] for i in sorted(range(len(peers)), key=key)]
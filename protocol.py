@@ -0,0 +1,472 @@
+"""
+Wire protocol shared by every handler and client call.
+
+Each message is a fixed-size header followed by exactly `length` payload bytes:
+
+    version (1 byte) | type (1 byte) | flags (2 bytes) | request id (4 bytes) | length (8 bytes)
+
+All integers are big-endian. A response carries the request id of the request it answers, so
+several requests can be in flight on one long-lived connection and be answered out of order. Structured payloads are JSON, file contents travel as raw bytes.
+A FILEGETRESPONSE payload starts with a FILE_RANGE prefix (offset, total file size) followed
+by the requested bytes of the file.
+
+Payloads may be compressed with the codec negotiated between the peers, see compress.py. A
+request carries the codec its sender accepts in the ACCEPT bits of the flags, and a
+compressed payload carries its codec in the CODEC bits; Message decompresses it, up to
+MAX_DECOMPRESSED_SIZE bytes. A FILEGETRESPONSE with FLAG_CHUNKED instead carries a
+FILE_RANGE and STREAM_LENGTH prefix only, and the data follows as FILECHUNK messages of one
+compressed stream, ended by an empty FILECHUNK.
+
+A message read whole is at most MAX_MESSAGE_SIZE bytes on the wire; a longer length is
+rejected before anything is allocated. File data is streamed and not bound by it.
+
+A FILEBATCH is answered with one FILEBATCHENTRY per file, each a BATCH_ENTRY prefix with
+the length of a JSON header (name, size, sha256) followed by the header and the raw file
+bytes, and ended by a FILEBATCHRESPONSE listing the requested names that matched nothing.
+
+A DELTA carries the block signatures of a local copy of a file, see delta.py, and is
+answered with a DELTARESPONSE giving the size and hash of the peer's version, followed by
+DELTADATA messages holding the delta operations, ended by an empty DELTADATA.
+"""
+
+from enum import IntEnum
+import compress
+import json
+import os
+import socket
+import struct
+import threading
+
+PROTOCOL_VERSION = 3
+HEADER = struct.Struct('!BBHIQ')
+FILE_RANGE = struct.Struct('!QQ')
+STREAM_LENGTH = struct.Struct('!Q')
+BATCH_ENTRY = struct.Struct('!I')
+FLAG_ERROR = 0x0001
+FLAG_CHUNKED = 0x0002
+CODEC_SHIFT = 8
+CODEC_MASK = 0x0F00
+ACCEPT_SHIFT = 12
+ACCEPT_MASK = 0xF000
+RECV_CHUNK_SIZE = 64 * 1024
+SEND_CHUNK_SIZE = 256 * 1024
+# Largest payload of a message read whole; larger bodies are streamed, see recv_to_file.
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# Largest payload a compressed message may expand to.
+MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024
+
+class MessageType(IntEnum):
+    HELLO = 1
+    HELLOBACK = 2
+    ADDME = 3
+    ACK = 4
+    NACK = 5
+    BROADCASTREQUEST = 6
+    BROADCASTRESPONSE = 7
+    FILELIST = 8
+    FILELISTRESPONSE = 9
+    FILEGET = 10
+    FILEGETRESPONSE = 11
+    BUSY = 12
+    ERROR = 13
+    SUBSCRIBE = 14
+    FILELISTUPDATE = 15
+    PING = 16
+    PINGACK = 17
+    PINGREQ = 18
+    DHT_FIND_NODE = 19
+    DHT_NODES = 20
+    DHT_FIND_VALUE = 21
+    DHT_VALUE = 22
+    DHT_STORE = 23
+    FILECHUNK = 24
+    PIECEHASHES = 25
+    PIECEHASHESRESPONSE = 26
+    STATS = 27
+    STATSRESPONSE = 28
+    FILEBATCH = 29
+    FILEBATCHENTRY = 30
+    FILEBATCHRESPONSE = 31
+    DELTA = 32
+    DELTARESPONSE = 33
+    DELTADATA = 34
+
+class ProtocolError(Exception):
+    pass
+
+class PeerBusyError(ConnectionError):
+    """
+    The peer shed the request because all of its workers were busy.
+    """
+    pass
+
+class RemoteError(Exception):
+    """
+    The peer failed while handling the request.
+    """
+    pass
+
+class Message:
+    def __init__(self, msg_type: MessageType, payload: bytes = b'', flags: int = 0, request_id: int = 0) -> None:
+        # Size on the wire, before decompression.
+        self.size = HEADER.size + len(payload)
+        if flags & CODEC_MASK and not flags & FLAG_CHUNKED:
+            try:
+                payload = compress.decompress(compress.codec_name((flags & CODEC_MASK) >> CODEC_SHIFT), payload, MAX_DECOMPRESSED_SIZE)
+            except Exception as e:
+                raise ProtocolError(f'Invalid compressed payload: {e}')
+            flags &= ~CODEC_MASK
+        self.type = msg_type
+        self.payload = payload
+        self.flags = flags
+        self.request_id = request_id
+    @property
+    def is_error(self) -> bool:
+        return bool(self.flags & FLAG_ERROR)
+    def json(self):
+        """
+        Decodes the payload as JSON.
+        """
+        return json.loads(bytes(self.payload).decode())
+    def __str__(self) -> str:
+        return f'{self.type.name} #{self.request_id} (flags={self.flags:#06x}, {len(self.payload)} bytes)'
+
+def encode_header(msg_type: MessageType, length: int, flags: int = 0, request_id: int = 0) -> bytes:
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, flags, request_id, length)
+
+def decode_header(data: bytes) -> (MessageType, int, int, int):
+    """
+    Decodes a message header.
+
+    Returns:
+    - Tuple (type, flags, request id, payload length)
+    """
+    version, msg_type, flags, request_id, length = HEADER.unpack(data)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f'Unsupported protocol version {version}.')
+    try:
+        msg_type = MessageType(msg_type)
+    except ValueError:
+        raise ProtocolError(f'Unknown message type {msg_type}.')
+    return (msg_type, flags, request_id, length)
+
+def encode_json(obj) -> bytes:
+    return json.dumps(obj).encode()
+
+def accept_flags(codec: str) -> int:
+    """
+    Returns the request flags announcing that the response may be compressed with `codec`.
+    """
+    return compress.codec_id(codec) << ACCEPT_SHIFT
+
+def accepted_codec(flags: int) -> str:
+    """
+    Returns the codec a request accepts for its response, or None.
+    """
+    try:
+        return compress.codec_name((flags & ACCEPT_MASK) >> ACCEPT_SHIFT)
+    except ValueError:
+        return None
+
+def compress_payload(payload: bytes, flags: int, codec: str) -> (bytes, int):
+    """
+    Compresses a payload of at least COMPRESS_MIN_SIZE bytes with `codec`, unless it did
+    not shrink or the flags say it is an error or already compressed.
+
+    Returns:
+    - Tuple (payload, flags) to send.
+    """
+    if codec is None or len(payload) < compress.COMPRESS_MIN_SIZE or flags & (FLAG_ERROR | FLAG_CHUNKED | CODEC_MASK):
+        return (payload, flags)
+    data = compress.compress(codec, payload)
+    if len(data) >= len(payload):
+        return (payload, flags)
+    return (data, flags | compress.codec_id(codec) << CODEC_SHIFT)
+
+def send_compressed_stream(conn, f, offset: int, count: int, codec: str, throttle=None, chunk_size: int = SEND_CHUNK_SIZE) -> int:
+    """
+    Sends `count` bytes of an open binary file, starting at `offset`, as the FILECHUNK
+    messages of one stream compressed with `codec`, ended by an empty FILECHUNK. The
+    chunks are flagged FLAG_CHUNKED, so they are not compressed again on their own.
+    The file is read, and the compressed output sent, `chunk_size` bytes at a time; the
+    optional `throttle` callable is given the size of each chunk before it is sent.
+    `conn` is the Reply, or the engine's equivalent, of a chunked FILEGETRESPONSE.
+
+    Returns:
+    - Number of compressed bytes sent.
+    """
+    def send(data: bytes) -> int:
+        for start in range(0, len(data), chunk_size):
+            piece = data[start:start + chunk_size]
+            if throttle is not None:
+                throttle(len(piece))
+            conn.send(MessageType.FILECHUNK, piece, FLAG_CHUNKED)
+        return len(data)
+    compressor = compress.compressor(codec)
+    buf = bytearray(min(chunk_size, count) or 1)
+    view = memoryview(buf)
+    f.seek(offset)
+    read = 0
+    sent = 0
+    while read < count:
+        n = f.readinto(view[:min(len(buf), count - read)])
+        if not n:
+            raise ConnectionError(f'File ended after {read} of {count} bytes.')
+        read += n
+        # Some codecs buffer their input and emit it in blocks far larger than a chunk.
+        sent += send(compressor.compress(view[:n]))
+    sent += send(compressor.flush())
+    conn.send(MessageType.FILECHUNK, b'', FLAG_CHUNKED)
+    return sent
+
+def check_reply(msg_type: MessageType, payload: bytes = b'') -> None:
+    """
+    Raises PeerBusyError for a BUSY reply and RemoteError for an ERROR reply.
+    """
+    if msg_type == MessageType.BUSY:
+        raise PeerBusyError('Peer is busy.')
+    if msg_type == MessageType.ERROR:
+        raise RemoteError(bytes(payload).decode(errors='replace') or 'Remote error.')
+
+class Connection:
+    """
+    Framed message connection over a TCP socket.
+
+    Usage:
+    ```
+    with Connection.open((ip, port), timeout) as conn:
+        conn.send(MessageType.HELLO)
+        rsp = conn.recv()
+    ```
+    """
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        # Held for the whole of a response, see Reply.
+        self.send_lock = threading.Lock()
+    @classmethod
+    def open(cls, address: (str, int), timeout: float) -> 'Connection':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+        except:
+            sock.close()
+            raise
+        return cls(sock)
+    def getpeername(self) -> (str, int):
+        return self.sock.getpeername()
+    def sendall(self, data: bytes) -> None:
+        self.sock.sendall(data)
+    def send(self, msg_type: MessageType, payload: bytes = b'', flags: int = 0, request_id: int = 0) -> None:
+        """
+        Sends a whole message. The header and payload are written with a single sendall.
+        """
+        self.sock.sendall(encode_header(msg_type, len(payload), flags, request_id) + payload)
+    def send_json(self, msg_type: MessageType, obj, flags: int = 0, request_id: int = 0) -> None:
+        self.send(msg_type, encode_json(obj), flags, request_id)
+    def send_header(self, msg_type: MessageType, length: int, flags: int = 0, request_id: int = 0) -> None:
+        """
+        Sends only the header of a message whose payload will be streamed afterwards.
+        """
+        self.sock.sendall(encode_header(msg_type, length, flags, request_id))
+    def sendfile(self, f, offset: int, count: int) -> int:
+        """
+        Streams `count` bytes of an open binary file, starting at `offset`, to the peer.
+
+        Uses the kernel's zero-copy sendfile where available and falls back to
+        reading and sending fixed-size chunks otherwise, so memory use stays
+        constant regardless of the file size.
+
+        Returns:
+        - Number of bytes sent. Raises ConnectionError if the file ended early.
+        """
+        if count == 0:
+            return 0
+        if hasattr(os, 'sendfile'):
+            sent = self.sock.sendfile(f, offset, count)
+        else:
+            sent = self._sendfile_chunked(f, offset, count)
+        if sent != count:
+            raise ConnectionError(f'Sent {sent} of {count} bytes.')
+        return sent
+    def _sendfile_chunked(self, f, offset: int, count: int) -> int:
+        f.seek(offset)
+        buf = bytearray(min(SEND_CHUNK_SIZE, count))
+        view = memoryview(buf)
+        sent = 0
+        while sent < count:
+            n = f.readinto(view[:min(len(buf), count - sent)])
+            if not n:
+                break
+            self.sock.sendall(view[:n])
+            sent += n
+        return sent
+    def recv_into(self, view: memoryview) -> None:
+        """
+        Fills the given buffer completely, raising ConnectionError if the peer closes early.
+        """
+        received = 0
+        size = len(view)
+        while received < size:
+            n = self.sock.recv_into(view[received:], size - received)
+            if n == 0:
+                raise ConnectionError('Connection closed by peer.')
+            received += n
+    def recv_exact(self, size: int) -> bytearray:
+        """
+        Reads exactly `size` bytes into a preallocated buffer. Raises ProtocolError if `size`,
+        usually a length sent by the peer, is over MAX_MESSAGE_SIZE.
+        """
+        if size > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f'Message of {size} bytes over the limit of {MAX_MESSAGE_SIZE}.')
+        buf = bytearray(size)
+        self.recv_into(memoryview(buf))
+        return buf
+    def recv_to_file(self, f, length: int, progress=None) -> int:
+        """
+        Streams exactly `length` payload bytes into an open binary file.
+
+        Data is received with recv_into into a single preallocated buffer and
+        written as it arrives, so memory use does not depend on `length`.
+
+        Parameters:
+        - f: Binary file object, written at its current position.
+        - length: Number of bytes to receive.
+        - progress: Optional callable receiving the number of bytes written after each chunk.
+
+        Returns:
+        - Number of bytes written.
+        """
+        buf = bytearray(min(RECV_CHUNK_SIZE, length) or 1)
+        view = memoryview(buf)
+        received = 0
+        while received < length:
+            n = self.sock.recv_into(view, min(len(buf), length - received))
+            if n == 0:
+                raise ConnectionError(f'Connection closed after {received} of {length} bytes.')
+            f.write(view[:n])
+            received += n
+            if progress is not None:
+                progress(n)
+        return received
+    def recv_header(self) -> (MessageType, int, int):
+        """
+        Reads the header of a reply whose payload will be streamed by the caller.
+        Meant for dedicated connections, where the request id does not matter.
+        BUSY and ERROR replies are raised, see check_reply.
+        """
+        msg_type, flags, request_id, length = decode_header(self.recv_exact(HEADER.size))
+        if msg_type in (MessageType.BUSY, MessageType.ERROR):
+            check_reply(msg_type, self.recv_exact(length))
+        return (msg_type, flags, length)
+    def recv_message(self) -> Message:
+        """
+        Reads a whole message, whatever its type.
+        """
+        msg_type, flags, request_id, length = decode_header(self.recv_exact(HEADER.size))
+        payload = self.recv_exact(length)
+        return Message(msg_type, bytes(payload), flags, request_id)
+    def recv(self) -> Message:
+        """
+        Reads a whole reply. BUSY and ERROR replies are raised, see check_reply.
+        """
+        msg = self.recv_message()
+        check_reply(msg.type, msg.payload)
+        return msg
+    def close(self) -> None:
+        self.sock.close()
+    def __enter__(self) -> 'Connection':
+        return self
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+class CompressedStream:
+    """
+    Reads the FILECHUNK messages following a chunked FILEGETRESPONSE, see
+    send_compressed_stream. It has the recv_to_file of Connection, so a transfer reads
+    either one the same way.
+    """
+    def __init__(self, conn: Connection, codec: str) -> None:
+        self.conn = conn
+        self.codec = codec
+    def recv_to_file(self, f, length: int, progress=None) -> int:
+        """
+        Decompresses the stream into an open binary file, which must receive exactly
+        `length` bytes.
+
+        Returns:
+        - Number of bytes written.
+        """
+        decompressor = compress.decompressor(self.codec, length)
+        written = 0
+        while True:
+            msg_type, flags, size = self.conn.recv_header()
+            if msg_type != MessageType.FILECHUNK:
+                raise ProtocolError(f'Unexpected {msg_type.name} in a file stream.')
+            if size == 0:
+                break
+            try:
+                data = decompressor.decompress(self.conn.recv_exact(size))
+            except ValueError:
+                raise ProtocolError(f'File stream longer than {length} bytes.')
+            f.write(data)
+            written += len(data)
+            if progress is not None and data:
+                progress(len(data))
+        if written != length:
+            raise ConnectionError(f'File stream ended after {written} of {length} bytes.')
+        return written
+
+class Reply:
+    """
+    The response side of one request on a possibly shared connection.
+
+    Handlers write their response through a Reply, which stamps it with the request id.
+    The connection's send lock is taken on the first write and kept until close(), so a
+    response streamed in several writes is never interleaved with another one.
+    Large payloads are compressed with the `codec` the request accepts.
+    """
+    def __init__(self, conn: Connection, request_id: int, codec: str = None) -> None:
+        self.conn = conn
+        self.request_id = request_id
+        self.codec = codec
+        self.started = False
+        # Bytes written, for the metrics.
+        self.sent = 0
+    def _begin(self) -> None:
+        if not self.started:
+            self.conn.send_lock.acquire()
+            self.started = True
+    def getpeername(self) -> (str, int):
+        return self.conn.getpeername()
+    def sendall(self, data: bytes) -> None:
+        self._begin()
+        self.conn.sendall(data)
+        self.sent += len(data)
+    def send(self, msg_type: MessageType, payload: bytes = b'', flags: int = 0) -> None:
+        payload, flags = compress_payload(payload, flags, self.codec)
+        self._begin()
+        self.conn.send(msg_type, payload, flags, self.request_id)
+        self.sent += HEADER.size + len(payload)
+    def send_json(self, msg_type: MessageType, obj, flags: int = 0) -> None:
+        self.send(msg_type, encode_json(obj), flags)
+    def send_header(self, msg_type: MessageType, length: int, flags: int = 0) -> None:
+        self._begin()
+        self.conn.send_header(msg_type, length, flags, self.request_id)
+        self.sent += HEADER.size
+    def sendfile(self, f, offset: int, count: int) -> int:
+        self._begin()
+        sent = self.conn.sendfile(f, offset, count)
+        self.sent += sent
+        return sent
+    def close(self) -> None:
+        if self.started:
+            self.conn.send_lock.release()
+
+def request(address: (str, int), msg_type: MessageType, payload: bytes = b'', timeout: float = None) -> Message:
+    """
+    Opens a connection, sends a single message and returns the response.
+    """
+    with Connection.open(address, timeout) as conn:
+        conn.send(msg_type, payload)
+        return conn.recv()
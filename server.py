@@ -0,0 +1,87 @@
+"""
+Bounded worker pool used by the listener to serve connections concurrently.
+"""
+
+import itertools
+import queue
+import threading
+
+PRIORITY_CONTROL = 0
+PRIORITY_BULK = 1
+# Sorts after every item, so the workers finish the queued items before stopping.
+PRIORITY_STOP = 2
+
+class WorkerPool:
+    """
+    Fixed number of worker threads consuming a bounded queue.
+
+    submit() never blocks: when the queue is full it returns False, so the caller can shed
+    the load instead of stalling. Queued items are handled by priority, then in order, so
+    control messages waiting behind bulk transfers go first.
+
+    Usage:
+    ```
+    pool = WorkerPool(handler, workers=8, queue_size=64)
+    pool.start()
+    if not pool.submit(item, PRIORITY_CONTROL):
+        reject(item)
+    pool.stop()
+    ```
+    """
+    def __init__(self, handler, workers: int, queue_size: int, name: str = 'worker') -> None:
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.name = name
+        self._queue = queue.PriorityQueue(maxsize=queue_size)
+        self._sequence = itertools.count()
+        self._threads = []
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'{self.name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    def submit(self, item, priority: int = PRIORITY_CONTROL) -> bool:
+        """
+        Queues an item for the workers.
+
+        Returns:
+        - True if the item was queued, False if the queue is full.
+        """
+        try:
+            self._queue.put_nowait((priority, next(self._sequence), item))
+            return True
+        except queue.Full:
+            return False
+    def stop(self) -> None:
+        """
+        Lets the workers finish the queued items and waits for them to exit.
+        """
+        for _ in self._threads:
+            self._queue.put((PRIORITY_STOP, next(self._sequence), None))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+    @property
+    def busy(self) -> int:
+        return self._busy
+    def _run(self) -> None:
+        while True:
+            priority, sequence, item = self._queue.get()
+            if item is None:
+                return
+            with self._busy_lock:
+                self._busy += 1
+            try:
+                self.handler(item)
+            except Exception:
+                # The handler is responsible for reporting its own errors, the worker must survive.
+                pass
+            finally:
+                with self._busy_lock:
+                    self._busy -= 1
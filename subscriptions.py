@@ -0,0 +1,157 @@
+"""
+Push of file list changes to subscribed peers.
+
+A peer sends SUBSCRIBE with the version of our list it already has, and gets the changes
+since then in the response. From then on, whenever the local index changes, the Publisher
+pushes the added and removed entries in a FILELISTUPDATE. Changes are batched: a push waits
+PUSH_BATCH_DELAY seconds for more changes, and at most one push per PUSH_MIN_INTERVAL
+seconds goes to each subscriber. Since a delta is computed against the last version the
+subscriber acknowledged, a file changed several times within a batch is sent only once.
+
+Subscriptions are leases. The subscriber renews them by subscribing again, and a subscription
+that is not renewed, or whose pushes keep failing, is dropped.
+"""
+
+from protocol import MessageType, encode_json
+from fanout import fan_out
+import threading
+import time
+
+SUBSCRIPTION_LEASE = 60.0
+SUBSCRIPTION_RENEW = 20.0
+PUSH_BATCH_DELAY = 0.2
+PUSH_MIN_INTERVAL = 1.0
+PUSH_MAX_FAILURES = 3
+
+class Subscription:
+    def __init__(self, uid: str, address: (str, int), epoch: str, version: int, expires: float) -> None:
+        self.uid = uid
+        self.address = address
+        self.epoch = epoch
+        self.version = version
+        self.expires = expires
+        self.last_push = 0.0
+        self.failures = 0
+
+class Publisher:
+    """
+    Pushes the changes of a FileIndex to the subscribed peers from a background thread.
+
+    Usage:
+    ```
+    publisher = Publisher(uid, lambda: index, pool.request)
+    publisher.start()
+    publisher.subscribe(peer_uid, address, epoch, version, lease)
+    publisher.notify()
+    publisher.stop()
+    ```
+    """
+    def __init__(self, uid: str, get_index, request, log=None) -> None:
+        self.uid = uid
+        self._get_index = get_index
+        self._request = request
+        self._log = log or (lambda msg: None)
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._running = False
+        self._thread = threading.Thread(target=self._run, name='publisher', daemon=True)
+    def start(self) -> None:
+        self._running = True
+        self._thread.start()
+    def stop(self) -> None:
+        self._running = False
+        self._changed.set()
+        self._thread.join()
+    def subscribe(self, uid: str, address: (str, int), epoch: str, version: int, lease: float = SUBSCRIPTION_LEASE) -> None:
+        """
+        Registers or renews a subscription. `version` is the version of the list the
+        subscriber holds after the SUBSCRIBE response.
+        """
+        lease = min(float(lease), SUBSCRIPTION_LEASE)
+        with self._lock:
+            subscription = self._subscriptions.get(uid)
+            if subscription is None or subscription.address != address:
+                self._subscriptions[uid] = Subscription(uid, address, epoch, version, time.time() + lease)
+            else:
+                if subscription.epoch == epoch:
+                    version = max(subscription.version, version)
+                subscription.epoch = epoch
+                subscription.version = version
+                subscription.expires = time.time() + lease
+                subscription.failures = 0
+    def unsubscribe(self, uid: str) -> None:
+        with self._lock:
+            self._subscriptions.pop(uid, None)
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscriptions)
+    def notify(self) -> None:
+        """
+        Signals that the local index changed.
+        """
+        self._changed.set()
+    def _run(self) -> None:
+        while self._running:
+            self._changed.wait()
+            if not self._running:
+                return
+            # Let a burst of changes settle, so it goes out as one push.
+            time.sleep(PUSH_BATCH_DELAY)
+            self._changed.clear()
+            delay = self.flush()
+            if delay is not None:
+                # Some subscribers were pushed to too recently, retry once their interval passed.
+                time.sleep(delay)
+                self._changed.set()
+    def flush(self) -> float:
+        """
+        Pushes the pending changes to every subscriber that is due.
+
+        Returns:
+        - Seconds until the next subscriber with pending changes is due, or None.
+        """
+        now = time.time()
+        index = self._get_index()
+        with self._lock:
+            for uid in [uid for uid, s in self._subscriptions.items() if s.expires < now]:
+                del self._subscriptions[uid]
+            subscriptions = list(self._subscriptions.values())
+        due = []
+        delay = None
+        for subscription in subscriptions:
+            if subscription.epoch == index.epoch and subscription.version == index.version:
+                continue
+            wait = subscription.last_push + PUSH_MIN_INTERVAL - now
+            if wait > 0:
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            due.append(subscription)
+        for subscription, version, error in fan_out(lambda s: self._push(index, s), due):
+            if error is None and version is not None:
+                subscription.failures = 0
+                if version > subscription.version or subscription.epoch != index.epoch:
+                    subscription.version = version
+                    subscription.epoch = index.epoch
+                continue
+            subscription.failures += 1
+            if error is None or subscription.failures >= PUSH_MAX_FAILURES:
+                self._log(f'Dropping file list subscription of {subscription.uid}.')
+                self.unsubscribe(subscription.uid)
+            else:
+                delay = PUSH_MIN_INTERVAL if delay is None else min(delay, PUSH_MIN_INTERVAL)
+        return delay
+    def _push(self, index, subscription: Subscription) -> int:
+        """
+        Sends one FILELISTUPDATE.
+
+        Returns:
+        - The version pushed, or None if the subscriber refused it.
+        """
+        subscription.last_push = time.time()
+        data = index.changes_since(subscription.epoch, subscription.version)
+        data['uid'] = self.uid
+        rsp = self._request(subscription.address, MessageType.FILELISTUPDATE, encode_json(data))
+        if rsp.type != MessageType.ACK:
+            return None
+        return data['version']
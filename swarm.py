@@ -0,0 +1,270 @@
+"""
+Multi-source download of a single file from every peer that holds it.
+
+The file is split into fixed-size pieces. One worker per holder pulls the next piece from a
+shared queue, so faster peers naturally take more pieces. When the queue runs dry, idle
+workers steal the in-flight piece held by the slowest worker; whichever copy lands first
+wins and the other is cancelled. Pieces are received into memory and written to the part
+file once whole, under the downloader's lock, so a late copy never overwrites a piece that
+is already written; only then are its bytes reported as progress and counted in the
+peer's throughput. A worker whose peer keeps failing gives its piece back and stops. When
+the progress callable raises TransferCancelled, every worker stops, no peer is blamed, and
+the part file is kept for a later resume.
+
+When the Merkle root of the piece hashes is known, see merkle.py, and a holder provides
+hashes matching it, pieces follow their boundaries and each one is checked as it lands.
+A corrupt piece is put back in the queue and handed to a
+worker of another peer if there is one, so a bad peer or a flipped bit costs one piece.
+"""
+
+from peer import Peer
+from protocol import Connection, PeerBusyError
+from transfer import PartialDownload, TransferCancelled, TransferError, TransferResult, request_piece_tree, request_range, BUSY_RETRY_DELAY
+import io
+import threading
+import time
+
+PIECE_SIZE = 1024 * 1024
+PEER_MAX_FAILURES = 3
+
+class PieceCancelled(Exception):
+    pass
+
+class PieceCorrupted(OSError):
+    pass
+
+class SwarmWorker:
+    """
+    Downloads pieces from a single peer and tracks its throughput.
+    """
+    def __init__(self, peer: Peer) -> None:
+        self.peer = peer
+        self.piece = None
+        # Bytes of the pieces written; `discarded` counts those of duplicate, corrupt or
+        # cancelled pieces, thrown away.
+        self.received = 0
+        self.discarded = 0
+        self.busy_time = 0.0
+        self.failures = 0
+    @property
+    def throughput(self) -> float:
+        if self.busy_time <= 0:
+            return 0.0
+        return self.received / self.busy_time
+
+class SwarmDownloader:
+    """
+    Downloads a file from several peers in parallel.
+
+    Usage:
+    ```
+    result = SwarmDownloader(file_dir, filename, peers, timeout).run()
+    ```
+    """
+    def __init__(self, file_dir: str, filename: str, peers: [Peer], timeout: float, piece_size: int = PIECE_SIZE, log=None, sha256: str = None, root: str = None, codec_for=None, metrics=None, stats=None, progress=None) -> None:
+        self.filename = filename
+        self.sha256 = sha256
+        # Merkle root advertised for the file, the piece hashes are only requested if known.
+        self.root = root
+        self.peers = peers
+        self.timeout = timeout
+        self.piece_size = piece_size
+        self.partial = PartialDownload(file_dir, filename)
+        self._log = log or (lambda msg: None)
+        # Returns the compression codec negotiated with a peer, see compress.py.
+        self._codec_for = codec_for or (lambda peer: None)
+        # Optional metrics.Metrics, given the bytes received from every peer.
+        self._metrics = metrics
+        # Optional peerstats.PeerStats, given the throughput of every peer.
+        self._stats = stats
+        # Optional callable given the number of bytes of every piece written, from any worker.
+        self._progress = progress
+        self._lock = threading.Lock()
+        self._pending = []
+        self._in_flight = {}
+        self._done = set()
+        # Piece -> uids of the peers that sent it corrupted.
+        self._bad_sources = {}
+        self._workers = []
+        # The TransferCancelled raised by the progress callable, which stops every worker.
+        self._cancelled = None
+        self.tree = None
+    def run(self) -> TransferResult:
+        """
+        Runs the download to completion.
+
+        Returns:
+        - TransferResult for the whole file. Raises TransferError if no peer could
+          serve it, OSError if pieces are still missing after every peer gave up, or the
+          TransferCancelled raised by the progress callable.
+        """
+        start = time.time()
+        self._probe_size()
+        if self.tree is not None:
+            self.piece_size = self.tree.piece_size
+            self.partial.verify_pieces(self.tree)
+            pieces = (self.tree.piece_range(index) for index in range(len(self.tree)))
+            self._pending = [piece for piece in pieces if not self.partial.contains(*piece)]
+        else:
+            for gap_start, gap_end in self.partial.missing():
+                for piece_start in range(gap_start, gap_end, self.piece_size):
+                    self._pending.append((piece_start, min(piece_start + self.piece_size, gap_end)))
+        self._workers = [SwarmWorker(peer) for peer in self.peers]
+        threads = [threading.Thread(target=self._work, args=(worker,)) for worker in self._workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._metrics is not None:
+            for worker in self._workers:
+                self._metrics.add_transfer(f'{worker.peer.ip}:{worker.peer.port}', received=worker.received + worker.discarded)
+        if self._stats is not None:
+            for worker in self._workers:
+                if worker.busy_time > 0:
+                    self._stats.record_transfer((worker.peer.ip, worker.peer.port), worker.received, worker.busy_time, worker.failures < PEER_MAX_FAILURES)
+        if self._cancelled is not None:
+            raise self._cancelled
+        if self.partial.missing():
+            raise OSError(f'Swarm download of {self.filename} incomplete, {self.partial.covered()} of {self.partial.size} bytes on disk.')
+        self.partial.finish(self.sha256)
+        received = sum(worker.received for worker in self._workers)
+        for worker in self._workers:
+            self._log(f'Swarm {self.filename}: {worker.peer} sent {worker.received} bytes ({worker.throughput / 1024 / 1024:.2f} MiB/s).')
+        sources = ','.join(worker.peer.uid for worker in self._workers if worker.received > 0)
+        return TransferResult(self.filename, sources, self.partial.size, time.time() - start, received)
+    def _probe_size(self) -> None:
+        """
+        Asks the holders for the piece hashes of the file, which give its size, or for the
+        size only with an empty range request if the root is not known or they cannot
+        provide them.
+        """
+        error = None
+        for peer in self.peers:
+            if self.root is not None:
+                try:
+                    with Connection.open((peer.ip, peer.port), self.timeout) as conn:
+                        self.tree = request_piece_tree(conn, self.filename, self.root, self.sha256, self._codec_for(peer))
+                except (OSError, TransferError) as e:
+                    self._log(f'Swarm {self.filename}: no piece hashes from {peer} ({e}).')
+            try:
+                if self.tree is not None:
+                    size = self.tree.size
+                else:
+                    with Connection.open((peer.ip, peer.port), self.timeout) as conn:
+                        offset, size, count, stream = request_range(conn, self.filename, 0, 0, self.sha256)
+                if self.partial.size != size:
+                    self.partial.prepare(size)
+                return
+            except (OSError, TransferError) as e:
+                error = e
+        raise TransferError(f'No peer could serve {self.filename}: {error}')
+    def _next_piece(self, worker: SwarmWorker):
+        with self._lock:
+            if self._cancelled is not None:
+                return None
+            # Skip the pieces this peer sent corrupted, unless no other worker is left for them.
+            others = [w.peer.uid for w in self._workers if w is not worker and w.failures < PEER_MAX_FAILURES]
+            eligible = [
+                i for i, piece in enumerate(self._pending)
+                if worker.peer.uid not in self._bad_sources.get(piece, ())
+                or all(uid in self._bad_sources[piece] for uid in others)
+            ]
+            if eligible:
+                piece = self._pending.pop(eligible[0])
+            else:
+                # Endgame: duplicate the in-flight piece held by the slowest other worker.
+                candidates = [
+                    (owner.throughput, piece) for piece, owners in self._in_flight.items()
+                    for owner in owners if worker not in owners
+                ]
+                if not candidates:
+                    return None
+                piece = min(candidates)[1]
+            self._in_flight.setdefault(piece, set()).add(worker)
+            worker.piece = piece
+            return piece
+    def _release_piece(self, worker: SwarmWorker, piece, completed: bool) -> None:
+        with self._lock:
+            owners = self._in_flight.get(piece, set())
+            owners.discard(worker)
+            if completed:
+                self._done.add(piece)
+                self._in_flight.pop(piece, None)
+            elif not owners:
+                self._in_flight.pop(piece, None)
+                if piece not in self._done:
+                    self._pending.insert(0, piece)
+            worker.piece = None
+    def _work(self, worker: SwarmWorker) -> None:
+        while worker.failures < PEER_MAX_FAILURES:
+            piece = self._next_piece(worker)
+            if piece is None:
+                return
+            started = time.time()
+            try:
+                self._fetch_piece(worker, piece)
+                worker.failures = 0
+                self._release_piece(worker, piece, True)
+            except PieceCancelled:
+                self._release_piece(worker, piece, False)
+            except TransferCancelled as e:
+                with self._lock:
+                    self._cancelled = self._cancelled or e
+                self._release_piece(worker, piece, False)
+            except PieceCorrupted as e:
+                worker.failures += 1
+                self._log(f'Swarm {self.filename}: piece {piece} from {worker.peer} is corrupt ({e}).')
+                with self._lock:
+                    self._bad_sources.setdefault(piece, set()).add(worker.peer.uid)
+                self._release_piece(worker, piece, False)
+            except TransferError as e:
+                # The peer cannot serve this file at all, retrying will not help.
+                worker.failures = PEER_MAX_FAILURES
+                self._log(f'Swarm {self.filename}: dropping {worker.peer} ({e}).')
+                self._release_piece(worker, piece, False)
+            except OSError as e:
+                worker.failures += 1
+                self._log(f'Swarm {self.filename}: piece {piece} from {worker.peer} failed ({e}).')
+                self._release_piece(worker, piece, False)
+                if isinstance(e, PeerBusyError):
+                    # The peer's upload slots are taken, let the other workers go on meanwhile.
+                    time.sleep(BUSY_RETRY_DELAY * 2 ** (worker.failures - 1))
+            finally:
+                worker.busy_time += time.time() - started
+    def _fetch_piece(self, worker: SwarmWorker, piece) -> None:
+        piece_start, piece_end = piece
+        def check(n: int) -> None:
+            with self._lock:
+                if piece in self._done or self._cancelled is not None:
+                    raise PieceCancelled()
+        codec = self._codec_for(worker.peer)
+        buf = io.BytesIO()
+        try:
+            with Connection.open((worker.peer.ip, worker.peer.port), self.timeout) as conn:
+                offset, size, count, stream = request_range(conn, self.filename, piece_start, piece_end - piece_start, self.sha256, codec)
+                if size != self.partial.size or offset != piece_start:
+                    raise TransferError(f'{worker.peer} holds a different version of {self.filename}.')
+                if count != piece_end - piece_start:
+                    raise OSError('Short piece.')
+                stream.recv_to_file(buf, count, check)
+            data = buf.getbuffer()
+            verified = []
+            if self.tree is not None:
+                for index in self.tree.pieces_in(piece_start, piece_end):
+                    start, end = self.tree.piece_range(index)
+                    if not self.tree.verify(index, data[start - piece_start:end - piece_start]):
+                        raise PieceCorrupted('Hash mismatch.')
+                    verified.append(index)
+            with self._lock:
+                if piece in self._done:
+                    raise PieceCancelled()
+                self.partial.write(piece_start, data)
+                self.partial.verified.update(verified)
+                self._done.add(piece)
+        except BaseException:
+            worker.discarded += buf.tell()
+            raise
+        # Only written bytes count as progress, so it never goes past the size of the file.
+        worker.received += len(data)
+        if self._progress is not None:
+            self._progress(len(data))
@@ -0,0 +1,54 @@
+import os
+import unittest
+
+import compress
+
+class CodecTest(unittest.TestCase):
+    def test_ids_round_trip(self) -> None:
+        for name in compress.available_codecs():
+            self.assertEqual(compress.codec_name(compress.codec_id(name)), name)
+        self.assertEqual(compress.codec_id(None), 0)
+        self.assertIsNone(compress.codec_name(0))
+        with self.assertRaises(ValueError):
+            compress.codec_name(15)
+    def test_choose_codec_follows_our_preference(self) -> None:
+        self.assertEqual(compress.choose_codec(['lzma', 'zlib']), 'zlib')
+        self.assertIsNone(compress.choose_codec(['snappy']))
+        self.assertIsNone(compress.choose_codec([None]))
+
+class DecompressTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.data = os.urandom(1000) * 64
+    def test_round_trip(self) -> None:
+        for name in compress.available_codecs():
+            with self.subTest(codec=name):
+                compressed = compress.compress(name, self.data)
+                self.assertLess(len(compressed), len(self.data))
+                self.assertEqual(compress.decompress(name, compressed, len(self.data)), self.data)
+    def test_output_is_capped(self) -> None:
+        bomb = b'\x00' * (8 * 1024 * 1024)
+        for name in compress.available_codecs():
+            with self.subTest(codec=name):
+                with self.assertRaises(ValueError):
+                    compress.decompress(name, compress.compress(name, bomb), 1024 * 1024)
+    def test_streaming_cap_spans_chunks(self) -> None:
+        for name in compress.available_codecs():
+            with self.subTest(codec=name):
+                compressed = compress.compress(name, self.data)
+                d = compress.decompressor(name, len(self.data) - 1)
+                with self.assertRaises(ValueError):
+                    for i in range(0, len(compressed), 100):
+                        d.decompress(compressed[i:i + 100])
+    def test_streaming_in_chunks(self) -> None:
+        for name in compress.available_codecs():
+            with self.subTest(codec=name):
+                compressed = compress.compress(name, self.data)
+                d = compress.decompressor(name, len(self.data))
+                out = b''.join(d.decompress(compressed[i:i + 100]) for i in range(0, len(compressed), 100))
+                self.assertEqual(out, self.data)
+    def test_unsupported_codec(self) -> None:
+        with self.assertRaises(ValueError):
+            compress.decompressor('snappy', 10)
+
+if __name__ == '__main__':
+    unittest.main()
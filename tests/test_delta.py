@@ -0,0 +1,100 @@
+import io
+import os
+import random
+import tempfile
+import unittest
+
+import delta
+
+BLOCK = delta.BLOCK_MIN
+
+class DeltaRoundTripTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.old = random.Random(1).randbytes(64 * BLOCK)
+    def open_file(self, name: str, data: bytes):
+        path = os.path.join(self.dir.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        f = open(path, 'rb')
+        self.addCleanup(f.close)
+        return f
+    def sync(self, new: bytes) -> (bytes, list):
+        """
+        Rebuilds `new` from the old copy, returning the result and the delta operations.
+        """
+        old = self.open_file('old', self.old)
+        table = delta.signature_table(delta.signatures(old, BLOCK))
+        operations = list(delta.compute_delta(self.open_file('new', new), BLOCK, table))
+        out = io.BytesIO()
+        written = delta.apply_delta(delta.encode_frames(operations), old, out, BLOCK)
+        self.assertEqual(written, len(new))
+        return out.getvalue(), operations
+    def literal_bytes(self, operations: list) -> int:
+        return sum(len(op[1]) for op in operations if op[0] == delta.OP_LITERAL)
+    def test_identical_copy_is_one_copy(self) -> None:
+        rebuilt, operations = self.sync(self.old)
+        self.assertEqual(rebuilt, self.old)
+        self.assertEqual(operations, [(delta.OP_COPY, 0, 64)])
+    def test_in_place_change(self) -> None:
+        new = bytearray(self.old)
+        new[10 * BLOCK + 7] ^= 0xFF
+        rebuilt, operations = self.sync(bytes(new))
+        self.assertEqual(rebuilt, new)
+        self.assertEqual(self.literal_bytes(operations), BLOCK)
+    def test_insertion_and_append(self) -> None:
+        new = self.old[:20 * BLOCK + 100] + b'inserted' + self.old[20 * BLOCK + 100:] + b'tail'
+        rebuilt, operations = self.sync(new)
+        self.assertEqual(rebuilt, new)
+        self.assertLess(self.literal_bytes(operations), 3 * BLOCK)
+    def test_no_common_data(self) -> None:
+        new = os.urandom(10 * BLOCK + 5)
+        rebuilt, operations = self.sync(new)
+        self.assertEqual(rebuilt, new)
+        self.assertEqual(self.literal_bytes(operations), len(new))
+    def test_empty_new_file(self) -> None:
+        self.assertEqual(self.sync(b''), (b'', []))
+    def test_frames_never_split_an_operation(self) -> None:
+        operations = [(delta.OP_LITERAL, os.urandom(delta.FRAME_SIZE + 10)), (delta.OP_COPY, 0, 3)]
+        frames = list(delta.encode_frames(operations))
+        self.assertGreater(len(frames), 1)
+        out = io.BytesIO()
+        delta.apply_delta(frames, self.open_file('old', self.old), out, BLOCK)
+        self.assertEqual(out.getvalue(), operations[0][1] + self.old[:3 * BLOCK])
+
+class ApplyDeltaErrorTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.base = tempfile.TemporaryFile()
+        self.addCleanup(self.base.close)
+        self.base.write(os.urandom(4 * BLOCK))
+        self.base.flush()
+    def apply(self, frame: bytes) -> None:
+        delta.apply_delta([frame], self.base, io.BytesIO(), BLOCK)
+    def test_copy_beyond_the_end(self) -> None:
+        with self.assertRaises(delta.DeltaError):
+            self.apply(delta.COPY.pack(delta.OP_COPY, 3, 2))
+    def test_truncated_literal(self) -> None:
+        with self.assertRaises(delta.DeltaError):
+            self.apply(delta.LITERAL.pack(delta.OP_LITERAL, 10) + b'short')
+    def test_unknown_operation(self) -> None:
+        with self.assertRaises(delta.DeltaError):
+            self.apply(b'\x09')
+
+class DeltaRequestTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        request, packed = delta.decode_request(delta.encode_request({'name': 'a.bin', 'block_size': BLOCK}, b'sigs'))
+        self.assertEqual(request, {'name': 'a.bin', 'block_size': BLOCK})
+        self.assertEqual(bytes(packed), b'sigs')
+    def test_malformed(self) -> None:
+        with self.assertRaises(delta.DeltaError):
+            delta.decode_request(b'\x00')
+        with self.assertRaises(delta.DeltaError):
+            delta.signature_table(b'\x00' * (delta.SIGNATURE.size + 1))
+    def test_block_size_bounds(self) -> None:
+        self.assertEqual(delta.block_size_for(0), delta.BLOCK_MIN)
+        self.assertEqual(delta.block_size_for(1 << 40), delta.BLOCK_MAX)
+        self.assertEqual(delta.block_size_for(100 * 1024 * 1024) % 1024, 0)
+
+if __name__ == '__main__':
+    unittest.main()
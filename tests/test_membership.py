@@ -0,0 +1,80 @@
+import json
+import time
+import unittest
+
+import membership
+from membership import ALIVE, DEAD, SUSPECT, Membership
+
+class MembershipTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.joined = []
+        self.died = []
+        self.m = Membership('self', 5000, self.request, lambda peer: self.joined.append(peer.uid), self.died.append)
+        self.m.add('a', '10.0.0.2', 5000)
+    def request(self, address, msg_type, payload, timeout):
+        raise ConnectionError('No network in tests.')
+    def member(self, uid: str):
+        return next((m for m in self.m.members if m.uid == uid), None)
+    def test_higher_incarnation_wins(self) -> None:
+        self.m.apply_updates([['a', '10.0.0.2', 5000, SUSPECT, 0]])
+        self.assertEqual(self.member('a').state, SUSPECT)
+        # An ALIVE at the same incarnation does not clear a suspicion, a newer one does.
+        self.m.apply_updates([['a', '10.0.0.2', 5000, ALIVE, 0]])
+        self.assertEqual(self.member('a').state, SUSPECT)
+        self.m.apply_updates([['a', '10.0.0.2', 5000, ALIVE, 1]])
+        self.assertEqual((self.member('a').state, self.member('a').incarnation), (ALIVE, 1))
+        self.m.apply_updates([['a', '10.0.0.2', 5000, DEAD, 0]])
+        self.assertEqual(self.member('a').state, ALIVE)
+    def test_only_the_member_raises_its_incarnation(self) -> None:
+        self.m.suspect('a')
+        self.assertEqual((self.member('a').state, self.member('a').incarnation), (SUSPECT, 0))
+        self.m.apply_updates([['self', None, 5000, SUSPECT, 3]])
+        self.assertEqual(self.m.incarnation, 4)
+        self.assertIn(['self', None, 5000, ALIVE, 4], self.m._piggyback())
+        # A stale suspicion is not refuted again.
+        self.m.apply_updates([['self', None, 5000, SUSPECT, 2]])
+        self.assertEqual(self.m.incarnation, 4)
+    def test_messages_to_a_suspect_carry_the_suspicion(self) -> None:
+        self.m.suspect('a')
+        for _ in range(20):
+            self.m._piggyback()
+        updates = json.loads(self.m._message('a'))['updates']
+        self.assertIn(['a', '10.0.0.2', 5000, SUSPECT, 0], updates)
+    def test_suspicion_times_out(self) -> None:
+        self.m.suspect('a')
+        self.member('a').suspected_at = time.time() - 3600
+        self.m.tick()
+        self.assertEqual(self.member('a').state, DEAD)
+        self.assertEqual(self.died, ['a'])
+    def test_tombstone_blocks_stale_gossip(self) -> None:
+        self.m.apply_updates([['a', '10.0.0.2', 5000, DEAD, 0]])
+        self.assertEqual(self.died, ['a'])
+        self.m.apply_updates([['a', '10.0.0.2', 5000, ALIVE, 0]])
+        self.assertEqual(self.member('a').state, DEAD)
+        self.assertEqual(self.joined, [])
+        self.m.apply_updates([['a', '10.0.0.2', 5000, ALIVE, 1]])
+        self.assertEqual(self.member('a').state, ALIVE)
+        self.assertEqual(self.joined, ['a'])
+    def test_tombstone_is_dropped_after_its_timeout(self) -> None:
+        self.m.apply_updates([['a', '10.0.0.2', 5000, DEAD, 0]])
+        self.m._expire_suspects()
+        self.assertIsNotNone(self.member('a'))
+        self.member('a').dead_at = time.time() - membership.TOMBSTONE_TIMEOUT - 1
+        self.m._expire_suspects()
+        self.assertIsNone(self.member('a'))
+    def test_removed_member_ignores_gossip(self) -> None:
+        self.m.remove('a')
+        self.m.apply_updates([['a', '10.0.0.2', 5000, ALIVE, 5]])
+        self.assertEqual(self.member('a').state, DEAD)
+        self.assertEqual(self.joined, [])
+        self.m.add('a', '10.0.0.2', 5000)
+        self.assertEqual(self.member('a').state, ALIVE)
+    def test_dead_members_are_not_learned(self) -> None:
+        self.m.apply_updates([['b', '10.0.0.3', 5000, DEAD, 0], ['c', None, 5000, ALIVE, 0]])
+        self.assertIsNone(self.member('b'))
+        self.assertIsNone(self.member('c'))
+        self.m.apply_updates([['b', '10.0.0.3', 5000, ALIVE, 0]])
+        self.assertEqual(self.joined, ['b'])
+
+if __name__ == '__main__':
+    unittest.main()
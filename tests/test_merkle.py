@@ -0,0 +1,77 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from merkle import LEAF_PREFIX, NODE_PREFIX, PieceTree, hash_file_pieces, merkle_root
+
+def leaf(hex_hash: str) -> bytes:
+    return hashlib.sha256(LEAF_PREFIX + bytes.fromhex(hex_hash)).digest()
+
+def node(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+class HashFilePiecesTest(unittest.TestCase):
+    def test_whole_file_and_pieces_in_one_pass(self) -> None:
+        data = os.urandom(2500)
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(data)
+        self.addCleanup(os.remove, f.name)
+        sha256, pieces = hash_file_pieces(f.name, 1000)
+        self.assertEqual(sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(pieces, [hashlib.sha256(data[i:i + 1000]).hexdigest() for i in (0, 1000, 2000)])
+    def test_empty_file(self) -> None:
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            pass
+        self.addCleanup(os.remove, f.name)
+        self.assertEqual(hash_file_pieces(f.name, 1000), (hashlib.sha256().hexdigest(), []))
+
+class MerkleRootTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.pieces = [hashlib.sha256(bytes([i])).hexdigest() for i in range(3)]
+    def test_empty_and_single(self) -> None:
+        self.assertEqual(merkle_root([]), hashlib.sha256(LEAF_PREFIX).hexdigest())
+        self.assertEqual(merkle_root(self.pieces[:1]), leaf(self.pieces[0]).hex())
+    def test_odd_node_is_promoted(self) -> None:
+        a, b, c = (leaf(h) for h in self.pieces)
+        self.assertEqual(merkle_root(self.pieces), node(node(a, b), c).hex())
+    def test_order_matters(self) -> None:
+        self.assertNotEqual(merkle_root(self.pieces), merkle_root(self.pieces[::-1]))
+    def test_inner_nodes_do_not_pass_for_pieces(self) -> None:
+        a, b = (leaf(h) for h in self.pieces[:2])
+        inner = [hashlib.sha256(a + b).hexdigest()]
+        self.assertNotEqual(merkle_root(inner), merkle_root(self.pieces[:2]))
+
+class PieceTreeTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.data = os.urandom(2500)
+        self.pieces = [hashlib.sha256(self.data[i:i + 1000]).hexdigest() for i in range(0, 2500, 1000)]
+        self.tree = PieceTree(2500, 1000, self.pieces, merkle_root(self.pieces))
+    def test_rejects_a_piece_count_not_matching_the_size(self) -> None:
+        with self.assertRaises(ValueError):
+            PieceTree(3500, 1000, self.pieces)
+        with self.assertRaises(ValueError):
+            PieceTree(2500, 0, self.pieces)
+    def test_rejects_pieces_not_matching_the_root(self) -> None:
+        with self.assertRaises(ValueError):
+            PieceTree(2500, 1000, self.pieces, merkle_root(self.pieces[::-1]))
+    def test_piece_ranges(self) -> None:
+        self.assertEqual([self.tree.piece_range(i) for i in range(3)], [(0, 1000), (1000, 2000), (2000, 2500)])
+    def test_pieces_in_keeps_whole_pieces_only(self) -> None:
+        self.assertEqual(list(self.tree.pieces_in(0, 2500)), [0, 1, 2])
+        self.assertEqual(list(self.tree.pieces_in(500, 2500)), [1, 2])
+        self.assertEqual(list(self.tree.pieces_in(0, 1999)), [0])
+        self.assertEqual(list(self.tree.pieces_in(1, 999)), [])
+        # The last piece is short, a range reaching the end of the file holds it.
+        self.assertEqual(list(self.tree.pieces_in(2000, 2600)), [2])
+    def test_verify(self) -> None:
+        self.assertTrue(self.tree.verify(2, self.data[2000:]))
+        corrupt = bytearray(self.data[1000:2000])
+        corrupt[10] ^= 1
+        self.assertFalse(self.tree.verify(1, bytes(corrupt)))
+    def test_dict_round_trip(self) -> None:
+        tree = PieceTree.from_dict(self.tree.to_dict())
+        self.assertEqual((tree.size, tree.piece_size, tree.pieces, tree.root), (2500, 1000, self.pieces, self.tree.root))
+
+if __name__ == '__main__':
+    unittest.main()
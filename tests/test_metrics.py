@@ -0,0 +1,53 @@
+import unittest
+
+from metrics import LATENCY_BUCKETS, Histogram, Metrics
+
+class HistogramTest(unittest.TestCase):
+    def test_bounds_are_inclusive(self) -> None:
+        h = Histogram((1.0, 2.0))
+        for value in (0.5, 1.0, 1.5, 2.0, 3.0):
+            h.observe(value)
+        self.assertEqual(h.counts, [2, 2, 1])
+        self.assertEqual((h.count, h.sum), (5, 8.0))
+    def test_quantile(self) -> None:
+        h = Histogram((1.0, 2.0))
+        self.assertIsNone(h.quantile(0.5))
+        for value in (0.5, 1.5, 1.5, 1.5):
+            h.observe(value)
+        self.assertEqual(h.quantile(0.25), 1.0)
+        self.assertAlmostEqual(h.quantile(0.5), 1.0 + 1 / 3)
+        h.observe(10.0)
+        # Past the last bucket, the estimate is its bound.
+        self.assertEqual(h.quantile(1.0), 2.0)
+
+class PrometheusTest(unittest.TestCase):
+    def test_histogram_lines_stay_in_order(self) -> None:
+        metrics = Metrics()
+        for msg_type in ('PING', 'HELLO', 'FILEGET'):
+            metrics.observe_request(msg_type, '10.0.0.2', 0.003, 16, 16, True)
+        lines = [line for line in metrics.to_prometheus().splitlines() if line.startswith('p2p_request_seconds')]
+        # Every series is whole: its buckets by increasing bound, then its sum and count.
+        self.assertEqual(len(lines), 3 * (len(LATENCY_BUCKETS) + 3))
+        series = [lines[i:i + len(LATENCY_BUCKETS) + 3] for i in range(0, len(lines), len(LATENCY_BUCKETS) + 3)]
+        self.assertEqual([s[0].split('"')[1] for s in series], ['FILEGET', 'HELLO', 'PING'])
+        for s in series:
+            bounds = [line.split('le="')[1].split('"')[0] for line in s[:-2]]
+            self.assertEqual(bounds, [str(b) for b in LATENCY_BUCKETS] + ['+Inf'])
+            counts = [int(line.rsplit(' ', 1)[1]) for line in s[:-2]]
+            self.assertEqual(counts, sorted(counts))
+            self.assertTrue(s[-2].startswith('p2p_request_seconds_sum'))
+            self.assertTrue(s[-1].startswith('p2p_request_seconds_count'))
+    def test_families_have_help_and_type(self) -> None:
+        metrics = Metrics()
+        metrics.observe_rpc('PING', '10.0.0.3:5000', 0.002, False)
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE p2p_rpcs_total counter', text)
+        self.assertIn('p2p_rpcs_total{type="PING",outcome="error"} 1', text)
+        self.assertTrue(text.endswith('\n'))
+    def test_label_values_are_escaped(self) -> None:
+        metrics = Metrics()
+        metrics.add_transfer('a"b\\c', received=1)
+        self.assertIn('p2p_received_bytes_total{peer="a\\"b\\\\c"} 1', metrics.to_prometheus())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmark import Cluster
+from downloads import DONE, DownloadCancelled
+from swarm import PIECE_SIZE
+from transfer import PartialDownload
+import logger
+
+SIZE = 8 * PIECE_SIZE
+
+class SwarmCancelTest(unittest.TestCase):
+    """
+    Two holders of one file on loopback, the first node downloading it.
+    """
+    @classmethod
+    def setUpClass(cls) -> None:
+        logger.set_level(logger.WARNING)
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.cluster = Cluster(3, self.root)
+        self.addCleanup(self.cluster.stop)
+        self.cluster.add_file(1, 'file.bin', SIZE)
+        source = os.path.join(self.cluster.nodes[1].file_dir, 'file.bin')
+        shutil.copy(source, os.path.join(self.cluster.nodes[2].file_dir, 'file.bin'))
+        self.cluster.nodes[2].update_file_list()
+        with open(source, 'rb') as f:
+            self.data = f.read()
+        self.client = self.cluster.nodes[0]
+        self.holders = [self.cluster.nodes[1].uid, self.cluster.nodes[2].uid]
+    def test_cancel_keeps_the_part_file_and_blames_no_peer(self) -> None:
+        def progress(n: int) -> None:
+            raise DownloadCancelled('Download cancelled.')
+        with self.assertRaises(DownloadCancelled):
+            self.client.swarm_receive_file_from_network(self.holders, 'file.bin', progress=progress)
+        for record in self.client.peer_stats.snapshot().values():
+            self.assertEqual(record['failures'], 0)
+        partial = PartialDownload(self.client.file_dir, 'file.bin')
+        self.assertGreater(partial.covered(), 0)
+        self.assertLess(partial.covered(), SIZE)
+        self.assertFalse(os.path.exists(os.path.join(self.client.file_dir, 'file.bin')))
+    def test_progress_adds_up_to_the_file_size(self) -> None:
+        received = []
+        result = self.client.swarm_receive_file_from_network(self.holders, 'file.bin', progress=received.append)
+        self.assertEqual(sum(received), SIZE)
+        self.assertEqual(result.size, SIZE)
+        with open(os.path.join(self.client.file_dir, 'file.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+    def test_resumed_job_counts_the_part_file(self) -> None:
+        def progress(n: int) -> None:
+            raise DownloadCancelled('Download cancelled.')
+        with self.assertRaises(DownloadCancelled):
+            self.client.swarm_receive_file_from_network(self.holders, 'file.bin', progress=progress)
+        covered = PartialDownload(self.client.file_dir, 'file.bin').covered()
+        self.client.list_files_on_network()
+        job = self.client.downloads.add('file.bin')
+        self.client.downloads.wait(job.id, 30)
+        self.assertEqual(job.state, DONE)
+        self.assertEqual(job.resumed, covered)
+        self.assertEqual(job.received, SIZE)
+        self.assertEqual(job.progress, 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from merkle import PieceTree
+from transfer import PartialDownload, RangeSet, TransferError
+
+class RangeSetTest(unittest.TestCase):
+    def test_add_merges_overlapping_and_adjacent_ranges(self) -> None:
+        ranges = RangeSet([[10, 20], [30, 40]])
+        ranges.add(20, 25)
+        self.assertEqual(ranges.to_list(), [[10, 25], [30, 40]])
+        ranges.add(5, 35)
+        self.assertEqual(ranges.to_list(), [[5, 40]])
+        ranges.add(50, 50)
+        self.assertEqual(ranges.to_list(), [[5, 40]])
+    def test_remove_splits_ranges(self) -> None:
+        ranges = RangeSet([[0, 100]])
+        ranges.remove(40, 60)
+        self.assertEqual(ranges.to_list(), [[0, 40], [60, 100]])
+        ranges.remove(0, 50)
+        self.assertEqual(ranges.to_list(), [[60, 100]])
+    def test_covered_and_contains(self) -> None:
+        ranges = RangeSet([[0, 10], [20, 30]])
+        self.assertEqual(ranges.covered(), 20)
+        self.assertTrue(ranges.contains(20, 30))
+        self.assertFalse(ranges.contains(5, 25))
+    def test_missing(self) -> None:
+        self.assertEqual(RangeSet().missing(100), [(0, 100)])
+        self.assertEqual(RangeSet([[10, 20], [50, 100]]).missing(100), [(0, 10), (20, 50)])
+        self.assertEqual(RangeSet([[0, 100]]).missing(100), [])
+
+class PartialDownloadTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.data = os.urandom(3000)
+    def partial(self) -> PartialDownload:
+        return PartialDownload(self.dir.name, 'file.bin')
+    def test_resumes_from_the_sidecar(self) -> None:
+        partial = self.partial()
+        partial.prepare(3000)
+        partial.write(0, self.data[:1000])
+        partial.write(2000, self.data[2000:])
+        resumed = self.partial()
+        self.assertEqual(resumed.size, 3000)
+        self.assertEqual(resumed.covered(), 2000)
+        self.assertEqual(resumed.missing(), [(1000, 2000)])
+        resumed.prepare(3000)
+        self.assertEqual(resumed.covered(), 2000)
+        resumed.write(1000, self.data[1000:2000])
+        resumed.finish(hashlib.sha256(self.data).hexdigest())
+        with open(os.path.join(self.dir.name, 'file.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(resumed.sidecar_path))
+    def test_a_new_size_discards_progress(self) -> None:
+        partial = self.partial()
+        partial.prepare(3000)
+        partial.write(0, self.data[:1000])
+        resumed = self.partial()
+        resumed.prepare(4000)
+        self.assertEqual(resumed.covered(), 0)
+    def test_corrupt_pieces_are_unmarked(self) -> None:
+        pieces = [hashlib.sha256(self.data[i:i + 1000]).hexdigest() for i in range(0, 3000, 1000)]
+        tree = PieceTree(3000, 1000, pieces)
+        partial = self.partial()
+        partial.prepare(3000)
+        corrupt = bytearray(self.data)
+        corrupt[1500] ^= 1
+        partial.write(0, bytes(corrupt))
+        self.assertEqual(partial.verify_pieces(tree), [(1000, 2000)])
+        self.assertEqual(partial.verified, {0, 2})
+        self.assertEqual(partial.missing(), [(1000, 2000)])
+    def test_finish_checks_the_content_hash(self) -> None:
+        partial = self.partial()
+        with self.assertRaises(TransferError):
+            partial.prepare(3000)
+            partial.finish()
+        partial.write(0, self.data)
+        with self.assertRaises(TransferError):
+            partial.finish('0' * 64)
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name, 'file.bin')))
+        self.assertFalse(os.path.exists(partial.part_path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+"""
+Upload scheduling: slots, fair queueing and token-bucket rate limits.
+
+Every upload holds one of a bounded number of slots for its whole response. When they are
+all taken, uploads wait in a short queue, and each freed slot goes to the next waiting peer
+in round-robin order, so a peer sending many requests cannot take every slot. Uploads
+beyond the queue are answered with BUSY: uploads never hold more than slots + queue of the
+handler threads, so the small control messages that keep us in other peers' tables are
+always served.
+
+The bytes sent are drawn from a global token bucket and from one bucket per peer, bounding
+the upload bandwidth in total and for any single peer. Limits can be changed at any time
+and apply to the uploads in progress from their next chunk.
+
+Clients give up on a response that stalls for their timeout, so no wait may come close to
+it: a queued upload waits at most half of it for a slot, and the chunks of a throttled
+upload shrink with its share of the bandwidth, so that the wait before each one stays
+under half of it too.
+"""
+
+import collections
+import threading
+import time
+
+UPLOAD_SLOTS = 4
+UPLOAD_QUEUE = 2
+# Seconds a client waits for the next bytes of a response before giving up.
+CLIENT_TIMEOUT = 1.0
+THROTTLE_CHUNK_SIZE = 64 * 1024
+THROTTLE_MIN_CHUNK_SIZE = 1024
+UNTHROTTLED_CHUNK_SIZE = 4 * 1024 * 1024
+PEER_BUCKET_IDLE = 60.0
+
+class TokenBucket:
+    """
+    Allows `rate` bytes per second on average, in bursts of up to `burst` bytes.
+    A rate of None means unlimited.
+    """
+    def __init__(self, rate: int = None, burst: int = None) -> None:
+        self._lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.set_rate(rate, burst)
+    def set_rate(self, rate: int = None, burst: int = None) -> None:
+        with self._lock:
+            self.rate = rate
+            # One second of traffic by default, and never less than one chunk.
+            self.burst = burst if burst is not None else max(rate or 0, THROTTLE_CHUNK_SIZE)
+            self.tokens = self.burst
+            self.updated = time.monotonic()
+    def reserve(self, n: int) -> float:
+        """
+        Takes `n` tokens, going into debt if there are not enough, so concurrent callers
+        queue up behind each other.
+
+        Returns:
+        - Seconds to wait before sending the `n` bytes.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.last_used = now
+            if not self.rate:
+                return 0.0
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            return max(0.0, -self.tokens / self.rate)
+
+class UploadSlot:
+    """
+    One upload slot, held until released.
+
+    Usage:
+    ```
+    slot = scheduler.acquire(peer_ip)
+    with slot:
+        slot.sendfile(connection, f, offset, count)
+    ```
+    """
+    def __init__(self, scheduler: 'UploadScheduler', peer: str) -> None:
+        self.scheduler = scheduler
+        self.peer = peer
+        self.released = False
+    def throttle(self, n: int) -> None:
+        """
+        Waits until `n` more bytes may be sent.
+        """
+        wait = self.scheduler.reserve(self.peer, n)
+        if wait > 0:
+            time.sleep(wait)
+    @property
+    def chunk_size(self) -> int:
+        """
+        Bytes sent at a time, see UploadScheduler.chunk_size.
+        """
+        return self.scheduler.chunk_size(self.peer)
+    def sendfile(self, connection, f, offset: int, count: int) -> int:
+        """
+        Sends part of a file with connection.sendfile, in chunks drawn from the buckets.
+        """
+        sent = 0
+        while sent < count:
+            n = min(self.chunk_size, count - sent)
+            self.throttle(n)
+            sent += connection.sendfile(f, offset + sent, n)
+        return sent
+    def sendall(self, connection, data: bytes) -> None:
+        """
+        Sends encoded messages with connection.sendall, in chunks drawn from the buckets.
+        """
+        view = memoryview(data)
+        sent = 0
+        while sent < len(view):
+            n = min(self.chunk_size, len(view) - sent)
+            self.throttle(n)
+            connection.sendall(view[sent:sent + n])
+            sent += n
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.scheduler.release(self)
+    def __enter__(self) -> 'UploadSlot':
+        return self
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+class Waiter:
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.granted = False
+
+class UploadScheduler:
+    """
+    Upload slots and bandwidth limits of a node. Rates are in bytes per second, None for
+    unlimited.
+
+    Usage:
+    ```
+    scheduler = UploadScheduler(slots=4, queue_size=2, rate=1024 * 1024, client_timeout=1.0)
+    slot = scheduler.acquire(peer_ip)
+    if slot is None:
+        reply_busy()
+    scheduler.set_limits(4, 2, None, 256 * 1024)
+    ```
+    """
+    def __init__(self, slots: int = UPLOAD_SLOTS, queue_size: int = UPLOAD_QUEUE, rate: int = None, peer_rate: int = None, client_timeout: float = CLIENT_TIMEOUT) -> None:
+        self.slots = slots
+        self.queue_size = queue_size
+        self.rate = rate
+        self.peer_rate = peer_rate
+        # No wait of an upload reaches half of the clients' timeout, see the module docstring.
+        self.max_wait = client_timeout / 2
+        self.active = 0
+        # Peer -> number of slots it holds.
+        self._peer_active = {}
+        self._bucket = TokenBucket(rate)
+        self._peer_buckets = {}
+        self._waiting = collections.OrderedDict()
+        self._queued = 0
+        self._lock = threading.Lock()
+    @property
+    def limited(self) -> bool:
+        return bool(self.rate or self.peer_rate)
+    @property
+    def queued(self) -> int:
+        return self._queued
+    def limits(self) -> dict:
+        return {'slots': self.slots, 'queue_size': self.queue_size, 'rate': self.rate, 'peer_rate': self.peer_rate}
+    def set_limits(self, slots: int, queue_size: int, rate: int = None, peer_rate: int = None) -> None:
+        """
+        Changes every limit at once. Extra slots are granted to waiting uploads at once,
+        fewer slots take effect as uploads finish.
+        """
+        with self._lock:
+            self.slots = slots
+            self.queue_size = queue_size
+            self.rate = rate
+            self.peer_rate = peer_rate
+            self._bucket.set_rate(rate)
+            for bucket in self._peer_buckets.values():
+                bucket.set_rate(peer_rate)
+            self._grant()
+    def acquire(self, peer: str) -> UploadSlot:
+        """
+        Takes an upload slot for a peer, waiting in the queue up to max_wait seconds if
+        they are all taken.
+
+        Returns:
+        - UploadSlot, or None if the queue is full or the wait timed out.
+        """
+        with self._lock:
+            if self.active < self.slots and not self._waiting:
+                self._take(peer)
+                return UploadSlot(self, peer)
+            if self._queued >= self.queue_size:
+                return None
+            waiter = Waiter()
+            self._waiting.setdefault(peer, collections.deque()).append(waiter)
+            self._queued += 1
+        waiter.event.wait(self.max_wait)
+        with self._lock:
+            if waiter.granted:
+                return UploadSlot(self, peer)
+            waiters = self._waiting.get(peer)
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiting[peer]
+            self._queued -= 1
+            return None
+    def _take(self, peer: str) -> None:
+        self.active += 1
+        self._peer_active[peer] = self._peer_active.get(peer, 0) + 1
+    def release(self, slot: UploadSlot) -> None:
+        with self._lock:
+            self.active -= 1
+            self._peer_active[slot.peer] -= 1
+            if self._peer_active[slot.peer] == 0:
+                del self._peer_active[slot.peer]
+            self._grant()
+            self._expire_buckets()
+    def _grant(self) -> None:
+        """
+        Hands the free slots to the waiting peers, one upload per peer in turn.
+        """
+        while self.active < self.slots and self._waiting:
+            peer, waiters = next(iter(self._waiting.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self._waiting.move_to_end(peer)
+            else:
+                del self._waiting[peer]
+            self._queued -= 1
+            self._take(peer)
+            waiter.granted = True
+            waiter.event.set()
+    def _expire_buckets(self) -> None:
+        now = time.monotonic()
+        for peer in [p for p, b in self._peer_buckets.items() if now - b.last_used > PEER_BUCKET_IDLE]:
+            del self._peer_buckets[peer]
+    def chunk_size(self, peer: str) -> int:
+        """
+        Returns the bytes an upload to `peer` sends at a time: the share of the bandwidth
+        each of the uploads drawing from the same buckets gets in max_wait seconds, capped
+        at THROTTLE_CHUNK_SIZE, or UNTHROTTLED_CHUNK_SIZE without limits.
+        """
+        if not self.limited:
+            return UNTHROTTLED_CHUNK_SIZE
+        with self._lock:
+            shares = []
+            if self.rate:
+                shares.append(self.rate / max(1, self.active))
+            if self.peer_rate:
+                shares.append(self.peer_rate / max(1, self._peer_active.get(peer, 0)))
+        return max(THROTTLE_MIN_CHUNK_SIZE, min(THROTTLE_CHUNK_SIZE, int(min(shares) * self.max_wait)))
+    def reserve(self, peer: str, n: int) -> float:
+        """
+        Takes `n` bytes from the global bucket and the peer's.
+
+        Returns:
+        - Seconds to wait before sending them.
+        """
+        if not self.limited:
+            return 0.0
+        with self._lock:
+            bucket = self._peer_buckets.get(peer)
+            if bucket is None:
+                bucket = self._peer_buckets[peer] = TokenBucket(self.peer_rate)
+        return max(self._bucket.reserve(n), bucket.reserve(n))
@@ -0,0 +1,522 @@
+"""
+Client-side file transfer helpers.
+
+Downloads are written to a hidden `.<name>.part` file in the file directory. A sidecar
+`.<name>.part.json` records the total size and the byte ranges already on disk, so an
+interrupted download resumes from where it stopped, even after a restart.
+
+When the piece hashes of the file are known, see merkle.py, every piece is checked against
+them once it is on disk, and a corrupt piece is removed from the completed ranges so only
+that piece is fetched again.
+
+Many small files are fetched with one FILEBATCH instead, see request_batch, and written
+each to a hidden `.<name>.batch` file renamed once complete and verified.
+
+A file of which an older copy is on disk can be updated with a delta instead, see
+request_delta and delta.py. The new version is rebuilt in a hidden `.<name>.delta` file,
+from the old copy and the changed bytes, and replaces it once verified.
+"""
+
+from protocol import Connection, CompressedStream, Message, MessageType, FLAG_ERROR, FLAG_CHUNKED, FILE_RANGE, STREAM_LENGTH, BATCH_ENTRY, CODEC_MASK, CODEC_SHIFT, accept_flags
+from fileindex import hash_file
+from merkle import PieceTree
+import compress
+import delta
+import hashlib
+import json
+import os
+import threading
+
+SIDECAR_FLUSH_BYTES = 4 * 1024 * 1024
+# Before retrying a peer that answered BUSY, doubled on every consecutive BUSY.
+BUSY_RETRY_DELAY = 0.5
+# Batch entries up to this size are received and verified in memory, larger ones on disk.
+BATCH_INLINE_SIZE = 256 * 1024
+
+class TransferError(Exception):
+    """
+    A transfer failed for a reason that retrying will not fix, like a missing file.
+    """
+    pass
+
+class TransferCancelled(Exception):
+    """
+    Raised by a progress callable to abort a transfer. Not a failure of the peer.
+    """
+    pass
+
+class TransferResult:
+    """
+    Outcome of a completed file transfer.
+    """
+    def __init__(self, filename: str, peer_uid: str, size: int, duration: float, received: int = None, delta: bool = False) -> None:
+        self.filename = filename
+        self.peer_uid = peer_uid
+        self.size = size
+        self.duration = duration
+        self.received = size if received is None else received
+        # Whether the file was rebuilt from an older local copy, see request_delta.
+        self.delta = delta
+    @property
+    def throughput(self) -> float:
+        """
+        Average throughput in bytes per second, counting only bytes received by this transfer.
+        """
+        if self.duration <= 0:
+            return 0.0
+        return self.received / self.duration
+    def __str__(self) -> str:
+        resumed = ''
+        if self.delta:
+            resumed = f', delta of {self.received} bytes'
+        elif self.received < self.size:
+            resumed = f', {self.size - self.received} bytes resumed'
+        return f'{self.filename}: {self.size} bytes in {self.duration:.3f}s ({self.throughput / 1024 / 1024:.2f} MiB/s{resumed})'
+
+class BatchResult:
+    """
+    Outcome of a batch transfer, see request_batch.
+    """
+    def __init__(self, peer_uid: str, files: [str], failed: [str], missing: [str], size: int, duration: float) -> None:
+        self.peer_uid = peer_uid
+        # Names of the files received.
+        self.files = files
+        # Names of the files discarded because their content did not match their hash.
+        self.failed = failed
+        # Requested names and patterns the peer had no file for.
+        self.missing = missing
+        self.size = size
+        self.duration = duration
+    @property
+    def files_per_second(self) -> float:
+        if self.duration <= 0:
+            return 0.0
+        return len(self.files) / self.duration
+    def __str__(self) -> str:
+        failed = f', {len(self.failed)} corrupt' if self.failed else ''
+        missing = f', {len(self.missing)} not found' if self.missing else ''
+        return f'{len(self.files)} files, {self.size} bytes in {self.duration:.3f}s ({self.files_per_second:.0f} files/s{failed}{missing})'
+
+class RangeSet:
+    """
+    Set of half-open byte ranges [start, end), kept sorted and merged.
+    """
+    def __init__(self, ranges: list = None) -> None:
+        self.ranges = []
+        for start, end in ranges or []:
+            self.add(start, end)
+    def add(self, start: int, end: int) -> None:
+        if end <= start:
+            return
+        merged = []
+        for s, e in self.ranges:
+            if e < start or s > end:
+                merged.append([s, e])
+            else:
+                start = min(start, s)
+                end = max(end, e)
+        merged.append([start, end])
+        merged.sort()
+        self.ranges = merged
+    def remove(self, start: int, end: int) -> None:
+        if end <= start:
+            return
+        remaining = []
+        for s, e in self.ranges:
+            if s < start:
+                remaining.append([s, min(e, start)])
+            if e > end:
+                remaining.append([max(s, end), e])
+        self.ranges = remaining
+    def covered(self) -> int:
+        return sum(e - s for s, e in self.ranges)
+    def contains(self, start: int, end: int) -> bool:
+        return any(s <= start and end <= e for s, e in self.ranges)
+    def missing(self, size: int) -> list:
+        """
+        Returns the gaps in [0, size) as a list of (start, end) tuples.
+        """
+        gaps = []
+        position = 0
+        for s, e in self.ranges:
+            if s > position:
+                gaps.append((position, min(s, size)))
+            position = max(position, e)
+        if position < size:
+            gaps.append((position, size))
+        return gaps
+    def to_list(self) -> list:
+        return [list(r) for r in self.ranges]
+
+class PartialDownload:
+    """
+    A download in progress, backed by a part file and a sidecar record of completed ranges.
+
+    Safe to share between threads writing disjoint ranges.
+    """
+    def __init__(self, file_dir: str, filename: str) -> None:
+        self.file_dir = file_dir
+        self.filename = filename
+        self.path = os.path.join(file_dir, filename)
+        self.part_path = os.path.join(file_dir, f'.{filename}.part')
+        self.sidecar_path = self.part_path + '.json'
+        self.size = None
+        self.ranges = RangeSet()
+        # Pieces verified by this instance, see verify_pieces.
+        self.verified = set()
+        self._lock = threading.Lock()
+        self._load()
+    def _load(self) -> None:
+        if not os.path.exists(self.sidecar_path) or not os.path.exists(self.part_path):
+            return
+        try:
+            with open(self.sidecar_path, 'r') as f:
+                data = json.load(f)
+            self.size = int(data['size'])
+            self.ranges = RangeSet(data['ranges'])
+        except:
+            self.size = None
+            self.ranges = RangeSet()
+    def _save(self) -> None:
+        tmp_path = self.sidecar_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': self.size, 'ranges': self.ranges.to_list()}, f)
+        os.replace(tmp_path, self.sidecar_path)
+    def prepare(self, size: int) -> None:
+        """
+        Sets the total size of the file, discarding previous progress if the size changed.
+        """
+        with self._lock:
+            if self.size == size and os.path.exists(self.part_path):
+                return
+            self.size = size
+            self.ranges = RangeSet()
+            self.verified = set()
+            with open(self.part_path, 'wb') as f:
+                f.truncate(size)
+            self._save()
+    def missing(self) -> list:
+        with self._lock:
+            return self.ranges.missing(self.size)
+    def covered(self) -> int:
+        with self._lock:
+            return self.ranges.covered()
+    def contains(self, start: int, end: int) -> bool:
+        with self._lock:
+            return self.ranges.contains(start, end)
+    def is_complete(self) -> bool:
+        return self.size is not None and len(self.missing()) == 0
+    def mark(self, start: int, end: int) -> None:
+        """
+        Records [start, end) as present on disk and persists the sidecar.
+        """
+        with self._lock:
+            self.ranges.add(start, end)
+            self._save()
+    def unmark(self, start: int, end: int) -> None:
+        """
+        Records [start, end) as missing again and persists the sidecar.
+        """
+        with self._lock:
+            self.ranges.remove(start, end)
+            self._save()
+    def write(self, offset: int, data) -> None:
+        """
+        Writes `data`, received whole, at `offset` in the part file and records it as present.
+        """
+        with open(self.part_path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+        self.mark(offset, offset + len(data))
+    def verify_pieces(self, tree: PieceTree, start: int = 0, end: int = None) -> list:
+        """
+        Checks the pieces of [start, end), the whole file by default, that are on disk and
+        not verified yet against their hashes. Corrupt pieces are unmarked.
+
+        Returns:
+        - List of the (start, end) ranges of the corrupt pieces.
+        """
+        if end is None:
+            end = tree.size
+        bad = []
+        with open(self.part_path, 'rb') as f:
+            for index in tree.pieces_in(start, end):
+                piece_start, piece_end = tree.piece_range(index)
+                if index in self.verified or not self.contains(piece_start, piece_end):
+                    continue
+                if tree.verify(index, os.pread(f.fileno(), piece_end - piece_start, piece_start)):
+                    self.verified.add(index)
+                else:
+                    self.unmark(piece_start, piece_end)
+                    bad.append((piece_start, piece_end))
+        return bad
+    def receive(self, conn: Connection, offset: int, count: int, progress=None) -> int:
+        """
+        Receives `count` bytes from the connection, or the stream returned by request_range,
+        into the part file at `offset`.
+
+        Progress is recorded in the sidecar every SIDECAR_FLUSH_BYTES, after the data
+        has been flushed, so the sidecar never claims bytes that are not on disk.
+        The optional `progress` callable receives the size of each chunk written and
+        may raise to abort the transfer; bytes already written are kept.
+
+        Returns:
+        - Number of bytes received.
+        """
+        received = 0
+        unsaved = 0
+        with open(self.part_path, 'r+b') as f:
+            f.seek(offset)
+            def on_chunk(n: int) -> None:
+                nonlocal received, unsaved
+                received += n
+                unsaved += n
+                if unsaved >= SIDECAR_FLUSH_BYTES:
+                    f.flush()
+                    self.mark(offset, offset + received)
+                    unsaved = 0
+                if progress is not None:
+                    progress(n)
+            try:
+                conn.recv_to_file(f, count, on_chunk)
+            finally:
+                f.flush()
+                self.mark(offset, offset + received)
+        return received
+    def finish(self, sha256: str = None) -> None:
+        """
+        Moves the completed part file to its final name and removes the sidecar.
+
+        When the expected SHA-256 is given, the content is verified first; on a mismatch
+        the download is discarded and TransferError is raised.
+        """
+        if not self.is_complete():
+            raise TransferError('Download is not complete.')
+        if sha256 is not None and hash_file(self.part_path) != sha256:
+            self.discard()
+            raise TransferError(f'Content hash mismatch for {self.filename}.')
+        os.replace(self.part_path, self.path)
+        os.remove(self.sidecar_path)
+    def discard(self) -> None:
+        for path in (self.part_path, self.sidecar_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+def request_piece_tree(conn: Connection, filename: str, root: str, sha256: str = None, codec: str = None) -> PieceTree:
+    """
+    Sends a PIECEHASHES request and returns the piece hashes of the file.
+
+    Parameters:
+    - conn: Open connection to the serving peer.
+    - filename: Name of the requested file.
+    - root: Merkle root advertised for the file, the piece hashes must match it.
+    - sha256: Content hash of the file, see request_range.
+    - codec: Compression codec negotiated with the peer.
+
+    Raises TransferError if the peer does not have the file or its piece hashes, or sent
+    hashes that do not match the root.
+    """
+    request = {'hash': sha256} if sha256 is not None else {'name': filename}
+    conn.send_json(MessageType.PIECEHASHES, request, accept_flags(codec))
+    rsp = conn.recv()
+    if rsp.type != MessageType.PIECEHASHESRESPONSE:
+        raise TransferError('Invalid response.')
+    if rsp.is_error:
+        raise TransferError(rsp.payload.decode(errors='replace'))
+    try:
+        tree = PieceTree.from_dict(rsp.json())
+    except (KeyError, TypeError, ValueError) as e:
+        raise TransferError(f'Invalid piece hashes: {e}')
+    if tree.root != root:
+        raise TransferError('Piece hashes do not match the advertised root.')
+    return tree
+
+def request_range(conn: Connection, filename: str, offset: int = 0, length: int = None, sha256: str = None, codec: str = None) -> (int, int, int, object):
+    """
+    Sends a FILEGET for a byte range and reads the response up to the start of the data.
+
+    Parameters:
+    - conn: Open connection to the serving peer.
+    - filename: Name of the requested file.
+    - offset: First byte requested.
+    - length: Number of bytes requested, or None for the rest of the file.
+    - sha256: Content hash of the file. When given, the file is requested by hash, so the
+      peer may serve it under any name.
+    - codec: Compression codec negotiated with the peer, which may then stream the data
+      compressed.
+
+    Returns:
+    - Tuple (offset, total file size, number of data bytes, stream to read them from). The
+      stream is `conn` itself, or a CompressedStream, both with recv_to_file.
+    """
+    if sha256 is not None:
+        request = {'hash': sha256, 'offset': offset}
+    else:
+        request = {'name': filename, 'offset': offset}
+    if length is not None:
+        request['length'] = length
+    conn.send_json(MessageType.FILEGET, request, accept_flags(codec))
+    msg_type, flags, length = conn.recv_header()
+    if msg_type != MessageType.FILEGETRESPONSE:
+        raise TransferError('Invalid response.')
+    if flags & FLAG_ERROR:
+        raise TransferError(conn.recv_exact(length).decode())
+    if length < FILE_RANGE.size:
+        raise TransferError('Invalid response.')
+    offset, size = FILE_RANGE.unpack(conn.recv_exact(FILE_RANGE.size))
+    if flags & FLAG_CHUNKED:
+        if length != FILE_RANGE.size + STREAM_LENGTH.size:
+            raise TransferError('Invalid response.')
+        count, = STREAM_LENGTH.unpack(conn.recv_exact(STREAM_LENGTH.size))
+        try:
+            stream_codec = compress.codec_name((flags & CODEC_MASK) >> CODEC_SHIFT)
+        except ValueError as e:
+            raise TransferError(str(e))
+        if stream_codec is None:
+            raise TransferError('Invalid response.')
+        return (offset, size, count, CompressedStream(conn, stream_codec))
+    return (offset, size, length - FILE_RANGE.size, conn)
+
+def _read_batch_entry(conn: Connection, flags: int, length: int) -> (dict, int, bytes):
+    """
+    Reads a FILEBATCHENTRY up to the start of the file data.
+
+    Returns:
+    - Tuple (JSON header, size of the data, data). The data is only returned for a
+      compressed entry, which is read whole; otherwise the caller reads it from `conn`.
+    """
+    data = None
+    if flags & CODEC_MASK:
+        payload = memoryview(Message(MessageType.FILEBATCHENTRY, bytes(conn.recv_exact(length)), flags).payload)
+        prefix, payload = payload[:BATCH_ENTRY.size], payload[BATCH_ENTRY.size:]
+    elif length >= BATCH_ENTRY.size:
+        prefix, payload = conn.recv_exact(BATCH_ENTRY.size), None
+    else:
+        raise TransferError('Invalid response.')
+    header_length, = BATCH_ENTRY.unpack(prefix)
+    if payload is None:
+        if BATCH_ENTRY.size + header_length > length:
+            raise TransferError('Invalid response.')
+        header = conn.recv_exact(header_length)
+        count = length - BATCH_ENTRY.size - header_length
+    else:
+        header, data = payload[:header_length], payload[header_length:]
+        count = len(data)
+    try:
+        entry = json.loads(bytes(header).decode())
+        name = entry['name']
+    except (KeyError, TypeError, ValueError):
+        raise TransferError('Invalid batch entry.')
+    if os.path.basename(name) != name or name.startswith('.') or count != entry.get('size'):
+        raise TransferError(f'Invalid batch entry {name!r}.')
+    return (entry, count, data)
+
+def request_batch(conn: Connection, file_dir: str, names: [str], codec: str = None, progress=None) -> ([str], [str], [str], int):
+    """
+    Sends a FILEBATCH request and writes every file of the response into `file_dir` as
+    it arrives, replacing local files of the same name.
+
+    Parameters:
+    - conn: Open connection to the serving peer.
+    - file_dir: Directory the files are written to.
+    - names: File names or glob patterns, like `*.txt`.
+    - codec: Compression codec negotiated with the peer, which may then compress the
+      smaller files.
+    - progress: Optional callable receiving the name of each file once written.
+
+    Returns:
+    - Tuple (names received, names discarded for a hash mismatch, requested names and
+      patterns that matched no file, bytes received). Raises TransferError if the peer
+      refused the request or sent an invalid entry.
+    """
+    conn.send_json(MessageType.FILEBATCH, {'names': names}, accept_flags(codec))
+    files = []
+    failed = []
+    size = 0
+    while True:
+        msg_type, flags, length = conn.recv_header()
+        if msg_type == MessageType.FILEBATCHRESPONSE:
+            rsp = Message(msg_type, bytes(conn.recv_exact(length)), flags)
+            if rsp.is_error:
+                raise TransferError(rsp.payload.decode(errors='replace'))
+            return (files, failed, rsp.json()['missing'], size)
+        if msg_type != MessageType.FILEBATCHENTRY:
+            raise TransferError('Invalid response.')
+        entry, count, data = _read_batch_entry(conn, flags, length)
+        sha256 = entry.get('sha256')
+        tmp_path = os.path.join(file_dir, f'.{entry["name"]}.batch')
+        if data is None and count <= BATCH_INLINE_SIZE:
+            data = conn.recv_exact(count)
+        if data is not None:
+            ok = sha256 is None or hashlib.sha256(data).hexdigest() == sha256
+            if ok:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+        else:
+            with open(tmp_path, 'wb') as f:
+                conn.recv_to_file(f, count)
+            ok = sha256 is None or hash_file(tmp_path) == sha256
+            if not ok:
+                os.remove(tmp_path)
+        size += count
+        if not ok:
+            failed.append(entry['name'])
+            continue
+        os.replace(tmp_path, os.path.join(file_dir, entry['name']))
+        files.append(entry['name'])
+        if progress is not None:
+            progress(entry['name'])
+
+def request_delta(conn: Connection, path: str, filename: str, sha256: str = None, codec: str = None) -> (int, int):
+    """
+    Sends a DELTA request with the block signatures of the local copy at `path`, and
+    rebuilds the peer's version of the file in its place.
+
+    Parameters:
+    - conn: Open connection to the serving peer.
+    - path: Path of the local copy.
+    - filename: Name of the requested file.
+    - sha256: Content hash of the file, see request_range.
+    - codec: Compression codec negotiated with the peer.
+
+    Returns:
+    - Tuple (size of the file, bytes received). Raises TransferError if the peer does not
+      have the file or the rebuilt file does not match, and the local copy is left as is.
+    """
+    tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.delta')
+    with open(path, 'rb') as base:
+        block_size = delta.block_size_for(os.fstat(base.fileno()).st_size)
+        request = {'hash': sha256} if sha256 is not None else {'name': filename}
+        request['block_size'] = block_size
+        conn.send(MessageType.DELTA, delta.encode_request(request, delta.signatures(base, block_size)), accept_flags(codec))
+        rsp = conn.recv()
+        if rsp.type != MessageType.DELTARESPONSE:
+            raise TransferError('Invalid response.')
+        if rsp.is_error:
+            raise TransferError(rsp.payload.decode(errors='replace'))
+        info = rsp.json()
+        received = rsp.size
+        def frames():
+            nonlocal received
+            while True:
+                msg = conn.recv()
+                if msg.type != MessageType.DELTADATA:
+                    raise TransferError('Invalid response.')
+                received += msg.size
+                if not msg.payload:
+                    return
+                yield msg.payload
+        try:
+            with open(tmp_path, 'wb') as out:
+                size = delta.apply_delta(frames(), base, out, block_size)
+            expected = sha256 if sha256 is not None else info.get('sha256')
+            if size != info['size'] or (expected is not None and hash_file(tmp_path) != expected):
+                raise TransferError(f'Content hash mismatch for {filename}.')
+        except BaseException as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if isinstance(e, delta.DeltaError):
+                raise TransferError(str(e))
+            raise
+    os.replace(tmp_path, path)
+    return (size, received)
@@ -0,0 +1,183 @@
+"""
+Incremental watchers of the shared directory.
+
+On Linux, InotifyWatcher asks the kernel for the names that changed and only stats those.
+Elsewhere, or when inotify is unavailable, ScanWatcher lists the directory with scandir and
+diffs sizes and modification times against the previous listing.
+
+Both keep `files`, a dict of every shared file name to its (size, mtime_ns), and report the
+changes since the previous poll in the format expected by FileIndex.update.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import stat
+import struct
+import sys
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 64 * 1024
+
+def is_shared(name: str) -> bool:
+    # Hidden files hold partial downloads and node metadata, they are never shared.
+    return not name.startswith('.')
+
+def stat_file(path: str) -> (int, int):
+    """
+    Returns the (size, mtime_ns) of a regular file, or None if it is missing or not a file.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+def scan_directory(path: str) -> dict:
+    """
+    Returns a dict of every shared file in the directory to its (size, mtime_ns).
+    """
+    files = {}
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if not is_shared(entry.name):
+                    continue
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        files[entry.name] = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return files
+
+def diff_files(old: dict, new: dict) -> dict:
+    changes = {name: state for name, state in new.items() if old.get(name) != state}
+    for name in old:
+        if name not in new:
+            changes[name] = None
+    return changes
+
+class ScanWatcher:
+    """
+    Watches a directory by listing it on every poll.
+
+    Usage:
+    ```
+    watcher = ScanWatcher(path)
+    changes = watcher.poll()
+    watcher.close()
+    ```
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.files = {}
+    def poll(self) -> dict:
+        """
+        Returns the changes since the previous poll: a dict of file name to its new
+        (size, mtime_ns), or to None for removed files. The first poll reports every file.
+        """
+        files = scan_directory(self.path)
+        changes = diff_files(self.files, files)
+        self.files = files
+        return changes
+    def close(self) -> None:
+        pass
+
+class InotifyWatcher:
+    """
+    Watches a directory with inotify, through ctypes.
+
+    The watch is registered before the first listing, so no change is missed between the
+    two. When the kernel queue overflows or the directory itself is moved or deleted, the
+    next poll falls back to a full listing.
+    """
+    _libc = None
+    def __init__(self, path: str) -> None:
+        if InotifyWatcher._libc is None:
+            InotifyWatcher._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc = InotifyWatcher._libc
+        self.path = path
+        self.files = {}
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed.')
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch failed for {path}.')
+        self._rescan = True
+    def _read_events(self) -> set:
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, INOTIFY_READ_SIZE)
+            except BlockingIOError:
+                return names
+            if not data:
+                return names
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+                pos += INOTIFY_EVENT.size
+                name = data[pos:pos + length].rstrip(b'\0')
+                pos += length
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    self._rescan = True
+                elif name:
+                    names.add(os.fsdecode(name))
+    def poll(self) -> dict:
+        """
+        Returns the changes since the previous poll, like ScanWatcher.poll, only looking at
+        the files named by the kernel's events.
+        """
+        names = self._read_events()
+        if self._rescan:
+            self._rescan = False
+            files = scan_directory(self.path)
+            changes = diff_files(self.files, files)
+            self.files = files
+            return changes
+        changes = {}
+        for name in names:
+            if not is_shared(name):
+                continue
+            state = stat_file(os.path.join(self.path, name))
+            if state != self.files.get(name):
+                changes[name] = state
+                if state is None:
+                    del self.files[name]
+                else:
+                    self.files[name] = state
+        return changes
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def create_watcher(path: str):
+    """
+    Returns an InotifyWatcher on Linux, or a ScanWatcher when inotify is not available.
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError):
+            pass
+    return ScanWatcher(path)